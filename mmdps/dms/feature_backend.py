@@ -0,0 +1,249 @@
+"""
+Feature storage backends of MMDPDatabase.
+
+A backend stores static (Net, Attr) and dynamic (DynamicNet, DynamicAttr)
+features, in collections named by atlas and feature, like MongoDB does.
+	mongodb: MongoDBDatabase in mongodb_database, needs a MongoDB server.
+	local: LocalDatabase in local_database, a SQLite index and npy files in a
+		local folder, needs no server.
+A cache can sit in front of the backend:
+	redis: RedisDatabase in redis_database, needs a Redis server.
+	none: NoCache, nothing is cached.
+The backend and cache are chosen by name, or by MMDPS_DMS_BACKEND and
+MMDPS_DMS_CACHE. The default cache of the local backend is none.
+
+dbname is one of SA (static attr), SN (static net), DA (dynamic attr), DN (dynamic net).
+"""
+import os
+import abc
+import weakref
+from mmdps.proc import netattr, atlas
+
+BACKENDS = ('mongodb', 'local')
+CACHES = ('redis', 'none')
+
+class FeatureBackend(abc.ABC):
+	"""
+	The interface of feature backends, a backend missing any of the abstract
+	methods cannot be created.
+	Saves raise MultipleRecordException if the record exists, unless overwrite.
+	Gets raise NoRecordFoundException if there is no record.
+	"""
+	def getcol(self, atlas_name, attrname, window_length=None, step_size=None):
+		if (window_length, step_size) != (None, None):
+			return '%s-%s-(%d,%d)' % (atlas_name, attrname, window_length, step_size)
+		else:
+			return '%s-%s' % (atlas_name, attrname)
+
+	@abc.abstractmethod
+	def save_static_attr(self, attr, comment={}, overwrite=False):
+		""" Save an Attr to SA """
+
+	@abc.abstractmethod
+	def save_static_net(self, net, comment={}, overwrite=False):
+		""" Save a Net to SN """
+
+	@abc.abstractmethod
+	def save_static(self, dbname, obj, comment={}, overwrite=False):
+		""" Save a Net or Attr to dbname, SA or SN """
+
+	def save_static_many(self, dbname, objs, comment={}, overwrite=False):
+		"""
+		Save many Net or Attr to dbname (SA or SN), the records may be in different collections.
+		Return the objs skipped because their record exists, none if overwrite.
+		"""
+		skipped = []
+		for obj in objs:
+			try:
+				self.save_static(dbname, obj, comment, overwrite)
+			except MultipleRecordException:
+				skipped.append(obj)
+		return skipped
+
+	@abc.abstractmethod
+	def save_dynamic_attr(self, attr, comment={}, overwrite=False):
+		""" Save a DynamicAttr to DA """
+
+	@abc.abstractmethod
+	def save_dynamic_net(self, net, comment={}, overwrite=False):
+		""" Save a DynamicNet to DN """
+
+	@abc.abstractmethod
+	def remove_static_attr(self, scan, atlas_name, feature, comment={}):
+		""" Remove the static attr record, if any """
+
+	@abc.abstractmethod
+	def remove_static_net(self, scan, atlas_name, feature, comment={}):
+		""" Remove the static net record, if any """
+
+	@abc.abstractmethod
+	def remove_dynamic_attr(self, scan, atlas_name, feature, window_length, step_size, comment={}):
+		""" Remove the dynamic attr record, if any """
+
+	@abc.abstractmethod
+	def remove_dynamic_net(self, scan, atlas_name, feature, window_length, step_size, comment={}):
+		""" Remove the dynamic net record, if any """
+
+	@abc.abstractmethod
+	def get_static_attr(self, scan, atlas_name, feature, comment={}):
+		""" Return the Attr of the scan """
+
+	@abc.abstractmethod
+	def get_static_net(self, scan, atlas_name, comment={}):
+		""" Return the BOLD.net Net of the scan """
+
+	@abc.abstractmethod
+	def get_dynamic_attr(self, scan, atlas_name, feature, window_length, step_size, comment={}, start=None, stop=None):
+		""" Return the DynamicAttr of the scan, only slices in [start, stop) if given """
+
+	@abc.abstractmethod
+	def get_dynamic_net(self, scan, atlas_name, window_length, step_size, comment={}, start=None, stop=None):
+		""" Return the BOLD.net DynamicNet of the scan, only slices in [start, stop) if given """
+
+	@abc.abstractmethod
+	def load_static_values(self, dbname, scan_list, atlas_name, feature, comment={}):
+		""" Return a dict of scan -> np array for the scans of scan_list found """
+
+	@abc.abstractmethod
+	def load_dynamic_values(self, dbname, scan_list, atlas_name, feature, window_length, step_size, comment={}):
+		""" Return a dict of scan -> (slices, ...) np array for the scans of scan_list found """
+
+def create_backend(data_source, backend=None, **kwargs):
+	""" Create the feature backend by name, kwargs go to its constructor """
+	backend = backend or os.environ.get('MMDPS_DMS_BACKEND', 'mongodb')
+	if backend == 'mongodb':
+		from mmdps.dms import mongodb_database
+		return mongodb_database.MongoDBDatabase(data_source, **kwargs)
+	elif backend == 'local':
+		from mmdps.dms import local_database
+		return local_database.LocalDatabase(data_source, **kwargs)
+	raise Exception('Unknown feature backend %s, should be one of %s' % (backend, BACKENDS))
+
+def create_cache(cache=None, backend=None):
+	""" Create the cache by name, the default depends on the backend """
+	backend = backend or os.environ.get('MMDPS_DMS_BACKEND', 'mongodb')
+	cache = cache or os.environ.get('MMDPS_DMS_CACHE', 'redis' if backend == 'mongodb' else 'none')
+	if cache == 'redis':
+		from mmdps.dms import redis_database
+		return redis_database.RedisDatabase()
+	elif cache == 'none':
+		return NoCache()
+	raise Exception('Unknown feature cache %s, should be one of %s' % (cache, CACHES))
+
+def static_key(data_source, subject_scan, atlas_name, feature_name, comment):
+	key = data_source + ':' + subject_scan + ':' + atlas_name + ':' + feature_name + ':0'
+	if comment is not None:
+		key += ':' + str(comment)
+	return key
+
+def dynamic_key(data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment):
+	key = data_source + ':' + subject_scan + ':' + atlas_name + ':' + feature_name +':1:'+ str(window_length) + ':' + str(step_size)
+	if comment is not None:
+		key += ':' + str(comment)
+	return key
+
+def delete_cached(cache, data_source, scan, atlas_name, feature, comment={}, window_length=None, step_size=None):
+	"""
+	Delete the cached value of a feature written to the backend. Call it in the process
+	that writes, so that readers in other processes do not get the old value.
+	"""
+	if window_length is None:
+		cache.delete_static_value(data_source, scan, atlas_name, feature, comment)
+	else:
+		cache.delete_dynamic_value(data_source, scan, atlas_name, feature, window_length, step_size, comment)
+
+def to_netattr(subject_scan, atlas_name, feature_name, value):
+	""" Net for 2-D values, Attr for 1-D values """
+	if value.ndim == 1:
+		return netattr.Attr(value, atlas.get(atlas_name), subject_scan, feature_name)
+	else:
+		return netattr.Net(value, atlas.get(atlas_name), subject_scan, feature_name)
+
+def to_dynamic_netattr(subject_scan, atlas_name, feature_name, window_length, step_size, value):
+	""" value is (slices, ...), DynamicNet for 3-D values, DynamicAttr for 2-D values """
+	if value.ndim == 2:
+		return netattr.DynamicAttr(value.swapaxes(0,1), atlas.get(atlas_name), window_length, step_size, subject_scan, feature_name)
+	else:
+		return netattr.DynamicNet(value.swapaxes(0,2).swapaxes(0,1), atlas.get(atlas_name), window_length, step_size, subject_scan, feature_name)
+
+class NoCache:
+	"""
+	The cache that caches nothing, with the feature value methods of RedisDatabase.
+	"""
+	def get_static_values(self, data_source, scan_list, atlas_name, feature_name, comment = {}):
+		return [None] * len(scan_list)
+
+	def set_static_values(self, data_source, atlas_name, feature_name, scan_list, values_list, comment = {}):
+		pass
+
+	def get_dynamic_values(self, data_source, scan_list, atlas_name, feature_name, window_length, step_size, comment = {}):
+		return [None] * len(scan_list)
+
+	def set_dynamic_values(self, data_source, atlas_name, feature_name, window_length, step_size, scan_list, values_list, comment = {}):
+		pass
+
+	def delete_static_value(self, data_source, subject_scan, atlas_name, feature_name, comment = {}):
+		pass
+
+	def delete_dynamic_value(self, data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment = {}):
+		pass
+
+	def get_write_count(self, data_source, atlas_name, feature_name, window_length = None, step_size = None):
+		return None
+
+	def cache_stats(self):
+		return None
+
+write_listeners = []
+
+def add_write_listener(listener):
+	"""
+	Call listener(data_source, scan, atlas_name, feature, comment, window_length, step_size)
+	after a feature is saved or removed in this process, window_length and step_size are
+	None for static features. listener can be a weakref.WeakMethod.
+	"""
+	write_listeners.append(listener)
+
+def remove_write_listener(listener):
+	if listener in write_listeners:
+		write_listeners.remove(listener)
+
+def notify_write(data_source, scan, atlas_name, feature, comment, window_length=None, step_size=None):
+	for listener in list(write_listeners):
+		if isinstance(listener, weakref.WeakMethod):
+			func = listener()
+			if func is None:
+				remove_write_listener(listener)
+				continue
+		else:
+			func = listener
+		func(data_source, scan, atlas_name, feature, comment, window_length, step_size)
+
+class MultipleRecordException(Exception):
+	"""
+	"""
+	def __init__(self, name, suggestion = ''):
+		super(MultipleRecordException, self).__init__()
+		self.name = name
+		self.suggestion = suggestion
+
+	def __str__(self):
+		return 'Multiple record found for %s. %s' % (self.name, self.suggestion)
+
+	def __repr__(self):
+		return 'Multiple record found for %s. %s' % (self.name, self.suggestion)
+
+
+class NoRecordFoundException(Exception):
+	"""
+	"""
+	def __init__(self, name, suggestion = ''):
+		super(NoRecordFoundException, self).__init__()
+		self.name = name
+		self.suggestion = ''
+
+	def __str__(self):
+		return 'No record found for %s. %s' % (self.name, self.suggestion)
+
+	def __repr__(self):
+		return 'No record found for %s. %s' % (self.name, self.suggestion)
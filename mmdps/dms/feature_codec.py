@@ -0,0 +1,142 @@
+"""
+Binary codec for feature values stored in MongoDB and Redis.
+
+A record is a small header followed by the raw little-endian array buffer:
+	magic b'MMDF', version, flags, compression, ndim (1 byte each),
+	dtype string length (1 byte), dtype string (like '<f8'),
+	shape (ndim little-endian uint64),
+	payload.
+
+For arrays whose last two axes are square and symmetric (networks), only the
+upper triangle (with the diagonal) is stored. The payload can be compressed
+with zlib, zstd or lz4, zstd and lz4 need the zstandard and lz4 packages.
+
+Records that do not start with the magic are pickles from before, and are
+still decoded with pickle.
+
+Defaults for encode can be set in the environment:
+	MMDPS_FEATURE_FLOAT32=1 stores float64 arrays as float32.
+	MMDPS_FEATURE_COMPRESSION=zstd|lz4|zlib compresses the payload.
+"""
+import os
+import struct
+import pickle
+import zlib
+import numpy as np
+
+MAGIC = b'MMDF'
+VERSION = 1
+FLAG_SYMMETRIC = 1
+
+COMPRESSIONS = {None: 0, 'zlib': 1, 'zstd': 2, 'lz4': 3}
+COMPRESSION_NAMES = dict((v, k) for k, v in COMPRESSIONS.items())
+
+_header = struct.Struct('<4sBBBBB')
+
+def default_float32():
+	return os.environ.get('MMDPS_FEATURE_FLOAT32', '0') == '1'
+
+def default_compression():
+	return os.environ.get('MMDPS_FEATURE_COMPRESSION', '') or None
+
+def is_encoded(buf):
+	"""Whether buf is a record of this codec (and not a legacy pickle)."""
+	return bytes(buf[:4]) == MAGIC
+
+def is_symmetric(arr):
+	"""Whether the last two axes of arr are square and symmetric, nan equal to nan."""
+	if arr.ndim < 2 or arr.shape[-1] != arr.shape[-2]:
+		return False
+	return np.array_equal(arr, np.swapaxes(arr, -1, -2), equal_nan = arr.dtype.kind in 'fc')
+
+def _compress(payload, compression):
+	if compression == 'zlib':
+		return zlib.compress(payload)
+	elif compression == 'zstd':
+		import zstandard
+		return zstandard.ZstdCompressor().compress(payload)
+	elif compression == 'lz4':
+		import lz4.frame
+		return lz4.frame.compress(payload)
+	raise Exception('Unknown compression %s, should be one of zlib, zstd, lz4' % compression)
+
+def _decompress(payload, compression):
+	if compression == 'zlib':
+		return zlib.decompress(payload)
+	elif compression == 'zstd':
+		import zstandard
+		return zstandard.ZstdDecompressor().decompress(payload)
+	elif compression == 'lz4':
+		import lz4.frame
+		return lz4.frame.decompress(payload)
+	raise Exception('Unknown compression %s' % compression)
+
+def encode(arr, float32 = None, symmetric = 'auto', compression = 'default'):
+	"""
+	Encode a np array (or the data of a netattr object) to bytes.
+	- float32: store float64 as float32, None to use MMDPS_FEATURE_FLOAT32.
+	- symmetric: True to pack the upper triangle of the last two axes, 'auto' to check.
+	- compression: None, 'zlib', 'zstd' or 'lz4', 'default' to use MMDPS_FEATURE_COMPRESSION.
+	"""
+	arr = np.asarray(getattr(arr, 'data', arr))
+	if arr.dtype == object:
+		raise Exception('Cannot encode object arrays, use pickle')
+	if float32 is None:
+		float32 = default_float32()
+	if compression == 'default':
+		compression = default_compression()
+	if float32 and arr.dtype == np.float64:
+		arr = arr.astype(np.float32)
+	arr = arr.astype(arr.dtype.newbyteorder('<'), copy = False)
+	flags = 0
+	if symmetric == 'auto':
+		symmetric = is_symmetric(arr)
+	if symmetric:
+		flags |= FLAG_SYMMETRIC
+		iu, ju = np.triu_indices(arr.shape[-1])
+		payload = np.ascontiguousarray(arr[..., iu, ju]).tobytes()
+	else:
+		payload = np.ascontiguousarray(arr).tobytes()
+	if compression is not None:
+		payload = _compress(payload, compression)
+	dtypestr = arr.dtype.str.encode('ascii')
+	header = _header.pack(MAGIC, VERSION, flags, COMPRESSIONS[compression], arr.ndim, len(dtypestr))
+	shape = struct.pack('<%dQ' % arr.ndim, *arr.shape)
+	return header + dtypestr + shape + payload
+
+def decode(buf, copy = True):
+	"""
+	Decode bytes made by encode, or a legacy pickle.
+	With copy=False, uncompressed unpacked records are read-only views of buf,
+	use it when the values are copied anyway, like stacking.
+	"""
+	if not is_encoded(buf):
+		return pickle.loads(buf)
+	magic, version, flags, compression, ndim, dtypelen = _header.unpack_from(buf, 0)
+	if version > VERSION:
+		raise Exception('Feature record version %d is newer than this codec (%d)' % (version, VERSION))
+	pos = _header.size
+	dtype = np.dtype(bytes(buf[pos:pos + dtypelen]).decode('ascii'))
+	pos += dtypelen
+	shape = struct.unpack_from('<%dQ' % ndim, buf, pos)
+	pos += 8 * ndim
+	payload = memoryview(buf)[pos:]
+	if compression != 0:
+		payload = _decompress(payload, COMPRESSION_NAMES[compression])
+	values = np.frombuffer(payload, dtype = dtype)
+	if not flags & FLAG_SYMMETRIC:
+		values = values.reshape(shape)
+		return values.copy() if copy else values
+	n = shape[-1]
+	iu, ju = np.triu_indices(n)
+	values = values.reshape(tuple(shape[:-2]) + (len(iu),))
+	arr = np.empty(shape, dtype = dtype)
+	arr[..., iu, ju] = values
+	arr[..., ju, iu] = values
+	return arr
+
+def encode_any(obj):
+	"""Encode np arrays with encode, anything else with pickle, like temp data."""
+	if isinstance(obj, np.ndarray) and obj.dtype != object:
+		return encode(obj)
+	return pickle.dumps(obj)
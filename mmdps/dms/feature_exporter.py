@@ -2,16 +2,99 @@
 Export all features to feature database.
 
 Use this exporter to export features from the calculation folder to feature database.
+
+The (atlas, scans) tasks run in a process pool, each worker process keeps one
+backend client for all its tasks, and static features are saved with one bulk
+write per collection and task. The written features are deleted from the cache,
+like Redis, so readers in other processes get the new values. The exported
+features are recorded in a manifest in the output folder, with the mtime and
+size of their source files, so a rerun skips the features whose sources did
+not change, unless force.
 """
 import os
+import json
 import shutil
+import multiprocessing
 
-from mmdps.util.loadsave import load_json_ordered, load_txt, load_csvmat
+from mmdps.util.loadsave import load_json_ordered, load_txt, load_mat, load_npymat, npymat_path, stack_is_current
 from mmdps.util import path
-from mmdps.dms import mongodb_database
-from mmdps.proc import netattr
+from mmdps.dms import feature_backend
+from mmdps.proc import netattr, parabase
 from mmdps import rootconfig
 
+MANIFEST_NAME = '.export_manifest.json'
+
+def fingerprint(files):
+	"""The [file, mtime_ns, size] list of the source files of a feature."""
+	ret = []
+	for file in files:
+		st = os.stat(file)
+		ret.append([file, st.st_mtime_ns, st.st_size])
+	return ret
+
+def existing_files(file):
+	"""The feature file and its npy sidecar that exist, load_mat reads either of them."""
+	return [f for f in dict.fromkeys([file, npymat_path(file)]) if os.path.isfile(f)]
+
+class ExportManifest:
+	"""
+	The exported features, key -> fingerprint of their source files.
+
+	Saved as json, the key is destination|mriscan|atlasname|feature_name.
+	"""
+	def __init__(self, filepath):
+		self.filepath = filepath
+		self.entries = {}
+		if os.path.isfile(filepath):
+			with open(filepath) as f:
+				self.entries = json.load(f)
+
+	def group(self, destination):
+		"""The entries of destination, (mriscan, atlasname) -> entries."""
+		groups = {}
+		for key, value in self.entries.items():
+			key_destination, mriscan, atlasname, feature_name = key.rsplit('|', 3)
+			if key_destination == destination:
+				groups.setdefault((mriscan, atlasname or None), {})[key] = value
+		return groups
+
+	def update(self, entries):
+		self.entries.update(entries)
+
+	def save(self):
+		"""Write to a temp file and rename, the manifest is never half written."""
+		path.makedirs_file(self.filepath)
+		tmpfile = self.filepath + '.tmp'
+		with open(tmpfile, 'w') as f:
+			json.dump(self.entries, f)
+		os.replace(tmpfile, self.filepath)
+
+def manifest_key(destination, mriscan, atlasname, feature_name):
+	return '|'.join((destination, mriscan, atlasname or '', feature_name))
+
+# backend clients of this process, (data_source, backend) -> client
+worker_backends = {}
+
+def worker_backend(data_source, backend = None):
+	"""The backend client of this process, created the first time."""
+	if (data_source, backend) not in worker_backends:
+		worker_backends[(data_source, backend)] = feature_backend.create_backend(data_source, backend)
+	return worker_backends[(data_source, backend)]
+
+# cache clients of this process, backend -> client
+worker_caches = {}
+
+def worker_cache(backend = None):
+	"""The cache client of this process, created the first time, see feature_backend.create_cache."""
+	if backend not in worker_caches:
+		worker_caches[backend] = feature_backend.create_cache(None, backend)
+	return worker_caches[backend]
+
+def delete_cached(rdb, data_source, feature):
+	"""Delete the cached value of a feature written to the backend, readers of other processes then read the new one."""
+	feature_backend.delete_cached(rdb, data_source, feature.scan, feature.atlasobj.name, feature.feature_name, {},
+		getattr(feature, 'window_length', None), getattr(feature, 'step_size', None))
+
 class MRIScanProcMRIScanAtlasExporter:
 	"""
 	The feature exporter for mriscan processing.
@@ -28,6 +111,26 @@ class MRIScanProcMRIScanAtlasExporter:
 		self.input_folders = self.mainconfig['input_folders']
 		self.modal = modal
 		self.is_dynamic = self.dataconfig['dynamic']['is_dynamic']
+		self.force = False
+		self.destination = 'folder'
+		# manifest entries of this mriscan and atlas, and the entries exported by this run
+		self.manifest_entries = {}
+		self.exported = {}
+
+	def is_up_to_date(self, feature_name, in_file_list):
+		"""Whether the feature was exported from the same source files before."""
+		if self.force or len(in_file_list) == 0:
+			return False
+		key = manifest_key(self.destination, self.mriscan, self.atlasname, feature_name)
+		return self.manifest_entries.get(key) == fingerprint(in_file_list)
+
+	def is_stale(self, feature_name):
+		"""Whether the feature was exported before, from source files changed since."""
+		return manifest_key(self.destination, self.mriscan, self.atlasname, feature_name) in self.manifest_entries
+
+	def mark_exported(self, feature_name, in_file_list):
+		key = manifest_key(self.destination, self.mriscan, self.atlasname, feature_name)
+		self.exported[key] = fingerprint(in_file_list)
 
 	def fullinfolder(self, modal, *p):
 		"""full file for input folder."""
@@ -44,6 +147,10 @@ class MRIScanProcMRIScanAtlasExporter:
 			return os.path.join(self.output_root_folder, self.mriscan, *p)
 
 	def get_dynamic_file_path(self, feature_config):
+		"""
+		The window files file-start.end, like corrcoef-0.100.csv, and their outputs.
+		This is the layout of loader.load_single_dynamic_network.
+		"""
 		modal = feature_config['modal']
 		file_list = []
 		out_file_list = []
@@ -53,13 +160,17 @@ class MRIScanProcMRIScanAtlasExporter:
 		step_size = self.dataconfig['dynamic']['step_size']
 		window_idx = 0
 		while True:
-			file_path = file_base + '_%d_%d' % (window_idx, window_idx + window_length) + feature_config.get('file_type')
-			if not os.path.isfile(file_path):
+			file_path = file_base + '-%d.%d' % (window_idx, window_idx + window_length) + feature_config.get('file_type')
+			if not existing_files(file_path):
 				return file_list, out_file_list
 			file_list.append(file_path)
-			out_file_list.append(out_file_base + '_%d_%d' % (window_idx, window_idx + window_length) + feature_config.get('file_type'))
+			out_file_list.append(out_file_base + '-%d.%d' % (window_idx, window_idx + window_length) + feature_config.get('file_type'))
 			window_idx += step_size
 
+	def get_dynamic_stack_path(self, feature_config):
+		"""The npy file of all windows stacked, like corrcoef.npy, and its output."""
+		return self.fullinfolder(feature_config['modal'], feature_config.get('file') + '.npy'), self.fulloutfolder(feature_config['out_file_name'] + '.npy')
+
 	def get_static_file_path(self, feature_config):
 		modal = feature_config['modal']
 		return [self.fullinfolder(modal, feature_config.get('file') + feature_config.get('file_type'))], [self.fulloutfolder(feature_config['out_file_name'] + feature_config.get('file_type'))]
@@ -76,17 +187,31 @@ class MRIScanProcMRIScanAtlasExporter:
 
 	def run_feature(self, feature_name, feature_config):
 		"""
-		Export one feature.
+		Export one feature, copying the feature files, their npy sidecars and
+		the stack of a dynamic feature, whichever exist.
 		feature_name is used in sub-classes
 		"""
+		if self.modal is not None and feature_config['modal'] != self.modal:
+			return
 		in_file_list, out_file_list = self.get_feature_file_path(feature_config)
+		copies = []
 		for file, filedst in zip(in_file_list, out_file_list):
-			if not os.path.isfile(file):
+			files = existing_files(file)
+			if not files:
 				print('==Not Exist:', file)
-				continue
-			path.makedirs_file(filedst)
-			#print('Copy:', file, filedst)
-			shutil.copy2(file, filedst)
+			# keep the binary sidecar along with the csv
+			copies.extend((src, filedst if src == file else npymat_path(filedst)) for src in files)
+		if self.is_dynamic and feature_config['modal'] == 'BOLD':
+			stackfile, stackdst = self.get_dynamic_stack_path(feature_config)
+			if os.path.isfile(stackfile):
+				copies.append((stackfile, stackdst))
+		existing = [src for src, dst in copies]
+		if not existing or self.is_up_to_date(feature_name, existing):
+			return
+		for src, dst in copies:
+			path.makedirs_file(dst)
+			shutil.copy2(src, dst)
+		self.mark_exported(feature_name, existing)
 
 	def run(self):
 		"""Export all features."""
@@ -104,88 +229,146 @@ class MRIScanProcMRIScanAtlasExporter:
 class MRIScanProcMMDPDatabaseExporter(MRIScanProcMRIScanAtlasExporter):
 	"""
 	The feature exporter for mriscan processing. 
-	Export features to MMDPDatabase (MongoDB Database)
+	Export features to MMDPDatabase (MongoDB Database, or another feature backend)
 	Only export for one mriscan and one atlas.
 	"""
-	def __init__(self, mriscan, atlasname, mainconfig, dataconfig, data_source, modal = None, force = False):
+	def __init__(self, mriscan, atlasname, mainconfig, dataconfig, data_source, modal = None, force = False, backend = None, mdb = None, batch = None, rdb = None):
 		"""
 		If force == True, will overwrite existing features in the database
+		backend is mongodb or local, see feature_backend
+		mdb is the backend client to use, created if None.
+		rdb is the cache client to delete the written features from, the default cache of backend if None.
+		If batch is a dict, static features are put in batch[(dbname, overwrite)]
+		instead of saved, save them with flush_batch.
+		Features exported before from changed source files are overwritten.
 		"""
 		super().__init__(mriscan, atlasname, mainconfig, dataconfig, modal)
 		self.data_source = data_source
-		self.mdb = mongodb_database.MongoDBDatabase(data_source)
+		self.mdb = mdb if mdb is not None else feature_backend.create_backend(data_source, backend)
+		self.rdb = rdb if rdb is not None else worker_cache(backend)
 		self.force = force
+		self.batch = batch
+		self.destination = 'database:%s:%s' % (backend or os.environ.get('MMDPS_DMS_BACKEND', 'mongodb'), data_source)
+
+	def overwrite(self, feature_name):
+		return self.force or self.is_stale(feature_name)
+
+	def save_static(self, dbname, feature):
+		"""Save or batch the feature, return False if it was skipped because it exists."""
+		overwrite = self.overwrite(feature.feature_name)
+		if self.batch is not None:
+			self.batch.setdefault((dbname, overwrite), []).append(feature)
+			return True
+		try:
+			self.mdb.save_static(dbname, feature, overwrite = overwrite)
+			delete_cached(self.rdb, self.data_source, feature)
+			return True
+		except feature_backend.MultipleRecordException:
+			print('!!!Already Exist: %s %s %s. Skipped' % (self.mriscan, self.atlasname, feature.feature_name))
+			return False
 
 	def run_feature(self, feature_name, feature_config):
 		"""
 		Override super run_feature.
-		Stores csv files to MongoDB directly
+		Stores csv files to MongoDB directly, or their npy sidecars, see load_mat.
+		A dynamic net is read from its stack when it is not older than the window files.
 		"""
 		if feature_config['file_type'] != '.csv':
 			# only supports csv features
 			return
+		if self.modal is not None and feature_config['modal'] != self.modal:
+			return
 		in_file_list, out_file_list = self.get_feature_file_path(feature_config)
 		if self.is_dynamic and feature_config['modal'] == 'BOLD':
-			if len(in_file_list) < 1:
+			stackfile = self.get_dynamic_stack_path(feature_config)[0]
+			use_stack = feature_name.find('net') != -1 and stack_is_current(stackfile, in_file_list)
+			# the files read, fingerprinted in the manifest
+			read_files = [stackfile] if use_stack else [f for file in in_file_list for f in existing_files(file)]
+			if len(read_files) < 1:
 				print('==Not Exist:', self.mriscan, self.atlasname, feature_name)
 				return
-			if feature_name.find('net') != -1:
-				feature = netattr.DynamicNet(None, self.atlasname, self.dataconfig['dynamic']['window_length'], self.dataconfig['dynamic']['step_size'], scan = self.mriscan, feature_name = feature_name)
-				for file in in_file_list:
-					feature.append_one_slice(load_csvmat(file))
-				try:
-					self.mdb.save_dynamic_net(feature)
-				except mongodb_database.MultipleRecordException:
-					if self.force:
-						# delete and overwrite
-						self.mdb.remove_dynamic_net(self.mriscan, self.dataconfig['dynamic']['window_length'], self.dataconfig['dynamic']['step_size'], self.atlasname)
-						self.mdb.save_dynamic_net(feature)
-					else:
-						print('!!!Already Exist: %s %s %s. Skipped' % (self.mriscan, self.atlasname, feature_name))
-			else:
-				feature = netattr.DynamicAttr(None, self.atlasname, self.dataconfig['dynamic']['window_length'], self.dataconfig['dynamic']['step_size'], scan = self.mriscan, feature_name = feature_name)
-				for file in in_file_list:
-					feature.append_one_slice(load_csvmat(file))
-				try:
-					self.mdb.save_dynamic_attr(feature)
-				except mongodb_database.MultipleRecordException:
-					if self.force:
-						# delete and overwrite
-						self.mdb.remove_dynamic_attr(self.mriscan, feature_name, self.dataconfig['dynamic']['window_length'], self.dataconfig['dynamic']['step_size'], self.atlasname)
-						self.mdb.save_dynamic_attr(feature)
-					else:
-						print('!!!Already Exist: %s %s %s. Skipped' % (self.mriscan, self.atlasname, feature_name))
+			if self.is_up_to_date(feature_name, read_files):
+				return
+			window_length, step_size = self.dataconfig['dynamic']['window_length'], self.dataconfig['dynamic']['step_size']
+			try:
+				if use_stack:
+					feature = netattr.DynamicNet(load_npymat(stackfile), self.atlasname, window_length, step_size, scan = self.mriscan, feature_name = feature_name)
+					self.mdb.save_dynamic_net(feature, overwrite = self.overwrite(feature_name))
+				elif feature_name.find('net') != -1:
+					feature = netattr.DynamicNet.from_slices(map(load_mat, in_file_list), self.atlasname, window_length, step_size, scan = self.mriscan, feature_name = feature_name, num_slices = len(in_file_list))
+					self.mdb.save_dynamic_net(feature, overwrite = self.overwrite(feature_name))
+				else:
+					feature = netattr.DynamicAttr.from_slices(map(load_mat, in_file_list), self.atlasname, window_length, step_size, scan = self.mriscan, feature_name = feature_name, num_slices = len(in_file_list))
+					self.mdb.save_dynamic_attr(feature, overwrite = self.overwrite(feature_name))
+			except feature_backend.MultipleRecordException:
+				print('!!!Already Exist: %s %s %s. Skipped' % (self.mriscan, self.atlasname, feature_name))
+				return
+			delete_cached(self.rdb, self.data_source, feature)
+			self.mark_exported(feature_name, read_files)
 		elif self.is_dynamic:
 			# dynamic but not BOLD feature
 			return
 		else:
 			# not dynamic
 			for file in in_file_list:
-				if not os.path.isfile(file):
+				read_files = existing_files(file)
+				if not read_files:
 					print('==Not Exist:', self.mriscan, self.atlasname, feature_name)
 					continue
+				if self.is_up_to_date(feature_name, read_files):
+					continue
 				if feature_name.find('net') != -1:
-					feature = netattr.Net(load_csvmat(file), self.atlasname, self.mriscan, feature_name)
-					try:
-						self.mdb.save_static_net(feature)
-					except mongodb_database.MultipleRecordException:
-						if self.force:
-							# delete and overwrite
-							self.mdb.remove_static_net(self.mriscan, self.atlasname, feature_name)
-							self.mdb.save_static_net(feature)
-						else:
-							print('!!!Already Exist: %s %s %s. Skipped' % (self.mriscan, self.atlasname, feature_name))
+					saved = self.save_static('SN', netattr.Net(load_mat(file), self.atlasname, self.mriscan, feature_name))
 				else:
-					feature = netattr.Attr(load_csvmat(file), self.atlasname, self.mriscan, feature_name)
-					try:
-						self.mdb.save_static_attr(feature)
-					except mongodb_database.MultipleRecordException:
-						if self.force:
-							# delete and overwrite
-							self.mdb.remove_static_attr(self.mriscan, self.atlasname, feature_name)
-							self.mdb.save_static_attr(feature)
-						else:
-							print('!!!Already Exist: %s %s %s. Skipped' % (self.mriscan, self.atlasname, feature_name))
+					saved = self.save_static('SA', netattr.Attr(load_mat(file), self.atlasname, self.mriscan, feature_name))
+				if saved:
+					self.mark_exported(feature_name, read_files)
+
+def flush_batch(mdb, batch, rdb = None):
+	"""
+	Save the batched static features, one bulk write per collection, and delete
+	the written ones from the rdb cache. Return the features skipped because they exist.
+	"""
+	skipped = []
+	for (dbname, overwrite), features in batch.items():
+		skipped_many = mdb.save_static_many(dbname, features, overwrite = overwrite)
+		for feature in skipped_many:
+			print('!!!Already Exist: %s %s %s. Skipped' % (feature.scan, feature.atlasobj.name, feature.feature_name))
+		skipped.extend(skipped_many)
+		if rdb is not None:
+			skipped_ids = set(id(feature) for feature in skipped_many)
+			for feature in features:
+				if id(feature) not in skipped_ids:
+					delete_cached(rdb, mdb.data_source, feature)
+	batch.clear()
+	return skipped
+
+def export_task(args):
+	"""
+	Export the features of some mriscans with one atlas, in a worker process.
+	args is (exporter config, atlasname, mriscans, manifest entries).
+	Return the manifest entries exported.
+	"""
+	config, atlasname, mriscans, manifest_entries = args
+	if config['database']:
+		mdb = worker_backend(config['data_source'], config['backend'])
+		rdb = worker_cache(config['backend'])
+		batch = {}
+	exported = {}
+	for mriscan in mriscans:
+		if not config['database']:
+			atlas_exporter = MRIScanProcMRIScanAtlasExporter(mriscan, atlasname, config['mainconfig'], config['dataconfig'], config['modal'])
+		else:
+			atlas_exporter = MRIScanProcMMDPDatabaseExporter(mriscan, atlasname, config['mainconfig'], config['dataconfig'], config['data_source'], config['modal'], config['force'], config['backend'], mdb, batch, rdb)
+		atlas_exporter.force = config['force']
+		atlas_exporter.manifest_entries = manifest_entries
+		atlas_exporter.run()
+		exported.update(atlas_exporter.exported)
+	if config['database']:
+		for feature in flush_batch(mdb, batch, rdb):
+			# only the records written are exported
+			exported.pop(manifest_key(atlas_exporter.destination, feature.scan, atlasname, feature.feature_name), None)
+	return exported
 
 class MRIScanProcExporter:
 	"""
@@ -193,8 +376,12 @@ class MRIScanProcExporter:
 
 	Export features in all mriscans.
 	"""
-	def __init__(self, mainconfig, dataconfig, modal = None, database = False, data_source = None, force = False):
-		"""Init the exporter using mainconfig and dataconfig."""
+	def __init__(self, mainconfig, dataconfig, modal = None, database = False, data_source = None, force = False, backend = None, processes = None, chunk_size = 16):
+		"""
+		Init the exporter using mainconfig and dataconfig.
+		processes is the size of the process pool, 1 to run in this process.
+		chunk_size is the number of mriscans of one task.
+		"""
 		self.mainconfig = mainconfig
 		self.dataconfig = dataconfig
 		if mainconfig.get('atlas_list', None) is None or mainconfig.get('atlas_list', None) == 'all':
@@ -217,25 +404,63 @@ class MRIScanProcExporter:
 		self.database = database
 		self.data_source = data_source
 		self.force = force
+		self.backend = backend
+		self.processes = processes
+		self.chunk_size = chunk_size
+		if database:
+			self.destination = 'database:%s:%s' % (backend or os.environ.get('MMDPS_DMS_BACKEND', 'mongodb'), data_source)
+		else:
+			self.destination = 'folder'
+		self.manifest = ExportManifest(os.path.join(mainconfig['output_folder'], MANIFEST_NAME))
+
+	def task_config(self):
+		return dict(mainconfig = self.mainconfig, dataconfig = self.dataconfig, modal = self.modal, database = self.database,
+			data_source = self.data_source, force = self.force, backend = self.backend)
+
+	def tasks(self):
+		"""The export_task args, mriscans of each atlas in chunks."""
+		config = self.task_config()
+		atlas_list = list(self.atlas_list)
+		if 'unatlased' in self.dataconfig:
+			atlas_list.append(None)
+		groups = self.manifest.group(self.destination)
+		argvec = []
+		for atlasname in atlas_list:
+			for pos in range(0, len(self.mriscans), self.chunk_size):
+				mriscans = self.mriscans[pos:pos + self.chunk_size]
+				manifest_entries = {}
+				for mriscan in mriscans:
+					manifest_entries.update(groups.get((mriscan, atlasname), {}))
+				argvec.append((config, atlasname, mriscans, manifest_entries))
+		return argvec
 
 	def run_mriscan_atlas(self, mriscan, atlasname):
 		"""Run one mriscan and one atlas to export."""
-		if not self.database:
-			atlas_exporter = MRIScanProcMRIScanAtlasExporter(mriscan, atlasname, self.mainconfig, self.dataconfig, self.modal)
-		else:
-			atlas_exporter = MRIScanProcMMDPDatabaseExporter(mriscan, atlasname, self.mainconfig, self.dataconfig, self.data_source, self.modal, self.force)
-		atlas_exporter.run()
+		exported = export_task((self.task_config(), atlasname, [mriscan], self.manifest.group(self.destination).get((mriscan, atlasname), {})))
+		self.manifest.update(exported)
+		self.manifest.save()
 
 	def run(self):
-		"""Run the export."""
-		for atlasname in self.atlas_list:
-			# atlased
-			for mriscan in self.mriscans:
-				self.run_mriscan_atlas(mriscan, atlasname)
-		if 'unatlased' in self.dataconfig:
-			# unatlased
-			for mriscan in self.mriscans:
-				self.run_mriscan_atlas(mriscan, None)
+		"""
+		Run the export. The manifest is saved after every task, so an
+		interrupted export resumes where it stopped.
+		"""
+		argvec = self.tasks()
+		processes = parabase.get_processes(self.processes)
+		ntotal = len(argvec)
+		if processes == 1 or ntotal <= 1:
+			self.collect(map(export_task, argvec), ntotal)
+		else:
+			with multiprocessing.Pool(processes) as pool:
+				self.collect(pool.imap_unordered(export_task, argvec), ntotal)
+
+	def collect(self, results, ntotal):
+		nfinished = 0
+		for exported in results:
+			nfinished += 1
+			self.manifest.update(exported)
+			self.manifest.save()
+			print('Export task finished, %d exported, %d/%d' % (len(exported), nfinished, ntotal))
 
 def check_modal(modal, mainconfigfile):
 	mainconfig = load_json_ordered(mainconfigfile)
@@ -0,0 +1,162 @@
+"""
+Embedded feature backend, no database server needed.
+
+Features are stored in a local folder, one npy file per record, and indexed
+in a SQLite file:
+	folder/data_source/index.sqlite
+	folder/data_source/SN/brodmann_lrce-BOLD.net/CMSA_01.npy
+Dynamic features are stored as one (slices, ...) npy file.
+
+Records are read into memory, a slice range of a dynamic feature is read
+through a short-lived memory map, so only that part of the file is touched.
+No map is kept open, so records can be overwritten or removed on Windows
+while loaded features are in use.
+
+The folder is MMDPS_LOCAL_FEATURE_DB, or featuredb next to the mmdpdb file.
+"""
+import os
+import json
+import hashlib
+import sqlite3
+import numpy as np
+
+from mmdps.dms import feature_backend
+from mmdps.dms.feature_backend import MultipleRecordException, NoRecordFoundException, notify_write
+from mmdps.proc import atlas, netattr
+from mmdps.util.loadsave import save_npymat
+from mmdps import rootconfig
+
+def default_folder():
+	return os.environ.get('MMDPS_LOCAL_FEATURE_DB') or os.path.join(os.path.dirname(os.path.abspath(rootconfig.dms.mmdpdb_filepath)), 'featuredb')
+
+class LocalDatabase(feature_backend.FeatureBackend):
+	def __init__(self, data_source, folder=None):
+		""" Open (or create) the local feature database of data_source in folder """
+		self.data_source = data_source
+		self.folder = os.path.join(folder or default_folder(), data_source)
+		os.makedirs(self.folder, exist_ok=True)
+		self.conn = sqlite3.connect(os.path.join(self.folder, 'index.sqlite'), check_same_thread=False)
+		with self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS features (dbname TEXT, col TEXT, scan TEXT, comment TEXT, file TEXT, '
+				'PRIMARY KEY (dbname, col, scan, comment))')
+
+	def comment_key(self, comment):
+		return json.dumps(comment, sort_keys=True)
+
+	def record_file(self, dbname, col, scan, comment):
+		""" The npy file of a record, relative to folder """
+		name = scan
+		if comment:
+			name += '.' + hashlib.sha1(self.comment_key(comment).encode('utf-8')).hexdigest()[:12]
+		return os.path.join(dbname, col, name + '.npy')
+
+	def find_files(self, dbname, col, scan_list, comment):
+		""" Return a dict of scan -> full npy file of the scans found """
+		ret = {}
+		scan_list = list(scan_list)
+		# stay below the SQLite variable limit
+		for pos in range(0, len(scan_list), 500):
+			part = scan_list[pos:pos + 500]
+			rows = self.conn.execute('SELECT scan, file FROM features WHERE dbname = ? AND col = ? AND comment = ? AND scan IN (%s)' % ','.join('?' * len(part)),
+				[dbname, col, self.comment_key(comment)] + part)
+			for scan, file in rows:
+				ret[scan] = os.path.join(self.folder, file)
+		return ret
+
+	def exist_query(self, dbname, scan, atlas_name, feature, comment={}, window_length=None, step_size=None):
+		""" return the npy file of the record, None if not found """
+		col = self.getcol(atlas_name, feature, window_length, step_size)
+		return self.find_files(dbname, col, [scan], comment).get(scan)
+
+	def save_record(self, dbname, col, scan, value, comment, overwrite):
+		file = self.record_file(dbname, col, scan, comment)
+		if not overwrite and self.find_files(dbname, col, [scan], comment):
+			raise MultipleRecordException(scan, 'Please check again.')
+		save_npymat(os.path.join(self.folder, file), value)
+		with self.conn:
+			self.conn.execute('INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?)', (dbname, col, scan, self.comment_key(comment), file))
+
+	def remove_record(self, dbname, col, scan, comment):
+		files = self.find_files(dbname, col, [scan], comment)
+		with self.conn:
+			self.conn.execute('DELETE FROM features WHERE dbname = ? AND col = ? AND scan = ? AND comment = ?', (dbname, col, scan, self.comment_key(comment)))
+		for file in files.values():
+			if os.path.isfile(file):
+				os.remove(file)
+
+	def load_record(self, dbname, col, scan, comment, start=None, stop=None):
+		""" Load the record, only slices in [start, stop) if given """
+		file = self.find_files(dbname, col, [scan], comment).get(scan)
+		if file is None:
+			raise NoRecordFoundException((scan, col))
+		if start is None and stop is None:
+			return np.load(file)
+		return np.array(np.load(file, mmap_mode='r')[start:stop])
+
+	def save_static(self, dbname, obj, comment={}, overwrite=False):
+		col = self.getcol(obj.atlasobj.name, obj.feature_name)
+		self.save_record(dbname, col, obj.scan, obj.data, comment, overwrite)
+		notify_write(self.data_source, obj.scan, obj.atlasobj.name, obj.feature_name, comment)
+
+	def save_static_attr(self, attr, comment={}, overwrite=False):
+		self.save_static('SA', attr, comment, overwrite)
+
+	def save_static_net(self, net, comment={}, overwrite=False):
+		self.save_static('SN', net, comment, overwrite)
+
+	def save_dynamic(self, dbname, obj, slices, comment={}, overwrite=False):
+		col = self.getcol(obj.atlasobj.name, obj.feature_name, obj.window_length, obj.step_size)
+		self.save_record(dbname, col, obj.scan, slices, comment, overwrite)
+		notify_write(self.data_source, obj.scan, obj.atlasobj.name, obj.feature_name, comment, obj.window_length, obj.step_size)
+
+	def save_dynamic_attr(self, attr, comment={}, overwrite=False):
+		self.save_dynamic('DA', attr, attr.data.T, comment, overwrite)
+
+	def save_dynamic_net(self, net, comment={}, overwrite=False):
+		self.save_dynamic('DN', net, np.moveaxis(net.data, 2, 0), comment, overwrite)
+
+	def remove_static_attr(self, scan, atlas_name, feature, comment={}):
+		self.remove_record('SA', self.getcol(atlas_name, feature), scan, comment)
+		notify_write(self.data_source, scan, atlas_name, feature, comment)
+
+	def remove_static_net(self, scan, atlas_name, feature, comment={}):
+		self.remove_record('SN', self.getcol(atlas_name, feature), scan, comment)
+		notify_write(self.data_source, scan, atlas_name, feature, comment)
+
+	def remove_dynamic_attr(self, scan, atlas_name, feature, window_length, step_size, comment={}):
+		self.remove_record('DA', self.getcol(atlas_name, feature, window_length, step_size), scan, comment)
+		notify_write(self.data_source, scan, atlas_name, feature, comment, window_length, step_size)
+
+	def remove_dynamic_net(self, scan, atlas_name, feature, window_length, step_size, comment={}):
+		self.remove_record('DN', self.getcol(atlas_name, feature, window_length, step_size), scan, comment)
+		notify_write(self.data_source, scan, atlas_name, feature, comment, window_length, step_size)
+
+	def get_static_attr(self, scan, atlas_name, feature, comment={}):
+		"""  Return to an attr object  directly """
+		data = self.load_record('SA', self.getcol(atlas_name, feature), scan, comment)
+		return netattr.Attr(data, atlas.get(atlas_name), scan, feature)
+
+	def get_static_net(self, scan, atlas_name, comment={}):
+		"""  Return to an static net object directly  """
+		data = self.load_record('SN', self.getcol(atlas_name, 'BOLD.net'), scan, comment)
+		return netattr.Net(data, atlas.get(atlas_name), scan, 'BOLD.net')
+
+	def get_dynamic_attr(self, scan, atlas_name, feature, window_length, step_size, comment={}, start=None, stop=None):
+		""" Return to dynamic attr object directly, only slices in [start, stop) if given """
+		slices = self.load_record('DA', self.getcol(atlas_name, feature, window_length, step_size), scan, comment, start, stop)
+		return netattr.DynamicAttr(slices.T, atlas.get(atlas_name), window_length, step_size, scan, feature)
+
+	def get_dynamic_net(self, scan, atlas_name, window_length, step_size, comment={}, start=None, stop=None):
+		""" Return to dynamic net object directly, only slices in [start, stop) if given """
+		slices = self.load_record('DN', self.getcol(atlas_name, 'BOLD.net', window_length, step_size), scan, comment, start, stop)
+		return netattr.DynamicNet(np.moveaxis(slices, 0, 2), atlas.get(atlas_name), window_length, step_size, scan, 'BOLD.net')
+
+	def load_static_values(self, dbname, scan_list, atlas_name, feature, comment={}):
+		""" Return a dict of scan -> np array for the scans of scan_list found """
+		files = self.find_files(dbname, self.getcol(atlas_name, feature), scan_list, comment)
+		return dict((scan, np.load(file)) for scan, file in files.items())
+
+	def load_dynamic_values(self, dbname, scan_list, atlas_name, feature, window_length, step_size, comment={}):
+		""" Return a dict of scan -> (slices, ...) np array for the scans of scan_list found """
+		files = self.find_files(dbname, self.getcol(atlas_name, feature, window_length, step_size), scan_list, comment)
+		return dict((scan, np.load(file)) for scan, file in files.items())
@@ -8,13 +8,18 @@ mmdpdb is the database of MMDPS, containing 3 databased.
 	2. MongoDB keeps all extracted features like networks
 	   and attributes. 
 	3. Redis is a high-speed cache that starts up upon request. 
+MongoDB and Redis can be replaced by a local backend and no cache,
+see feature_backend.
 
 """
 import os
 import datetime
+import weakref
+import collections
+import numpy as np
 
 from sqlalchemy import create_engine, exists, and_
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, joinedload
 
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 
@@ -23,17 +28,113 @@ from mmdps.dms import tables
 from mmdps.util import loadsave
 from mmdps import rootconfig
 
-from mmdps.dms import mongodb_database, redis_database
+from mmdps.dms import feature_backend
+
+class FeatureCache:
+	"""
+	In-process LRU cache of feature values, bounded by max_bytes.
+	Cached arrays are made read-only and returned without copy, copy them before modifying.
+	A value can be cached with the write count of its collection, see
+	RedisDatabase.get_write_count, it is stale once the count changes.
+	"""
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.values = collections.OrderedDict()
+		self.write_counts = {}
+		self.nbytes = 0
+		self.stats = dict(hits = 0, misses = 0, evictions = 0, stale = 0)
+
+	def get(self, key, write_count = None):
+		value = self.values.get(key)
+		if value is not None and write_count is not None and self.write_counts[key] != write_count:
+			self.discard(key)
+			self.stats['stale'] += 1
+			value = None
+		if value is None:
+			self.stats['misses'] += 1
+		else:
+			self.values.move_to_end(key)
+			self.stats['hits'] += 1
+		return value
+
+	def put(self, key, value, write_count = None):
+		"""Cache value and return it, read-only. Values bigger than max_bytes are not cached."""
+		value.flags.writeable = False
+		self.discard(key)
+		if value.nbytes > self.max_bytes:
+			return value
+		self.values[key] = value
+		self.write_counts[key] = write_count
+		self.nbytes += value.nbytes
+		while self.nbytes > self.max_bytes:
+			oldkey, old = self.values.popitem(last = False)
+			del self.write_counts[oldkey]
+			self.nbytes -= old.nbytes
+			self.stats['evictions'] += 1
+		return value
+
+	def discard(self, key):
+		value = self.values.pop(key, None)
+		if value is not None:
+			del self.write_counts[key]
+			self.nbytes -= value.nbytes
+
+	def clear(self):
+		self.values.clear()
+		self.write_counts.clear()
+		self.nbytes = 0
+
+	def fetch(self, keys, fetch_missing, write_count = None):
+		"""
+		Return the values of keys, in order.
+		fetch_missing(indexes) returns the values of keys[indexes] not in the cache,
+		or cached with another write_count. None write_count is not checked.
+		"""
+		values = [self.get(key, write_count) for key in keys]
+		missing = [i for i, value in enumerate(values) if value is None]
+		if missing:
+			for i, value in zip(missing, fetch_missing(missing)):
+				values[i] = self.put(keys[i], value, write_count)
+		return values
+
+	def cache_stats(self):
+		return dict(self.stats, bytes = self.nbytes, max_bytes = self.max_bytes, entries = len(self.values))
 
 class MMDPDatabase:
-	def __init__(self, data_source = 'Changgung', username = None, password = None):
-		self.rdb = redis_database.RedisDatabase()
+	def __init__(self, data_source = 'Changgung', username = None, password = None, local_cache_bytes = None, backend = None, cache = None):
+		"""
+		local_cache_bytes enables an in-process cache of that size in front of redis
+		(or MMDPS_LOCAL_CACHE_BYTES), see FeatureCache. With redis, every get checks the
+		write count of the collection, so writes of other processes are seen if they
+		delete the cached values, like the exporter does. Without redis, only the
+		writes of this process are seen.
+		backend is mongodb or local, cache is redis or none, see feature_backend.
+		"""
+		self.rdb = feature_backend.create_cache(cache, backend)
 		if username is None:
-			self.mdb = mongodb_database.MongoDBDatabase(data_source = data_source)
+			self.mdb = feature_backend.create_backend(data_source, backend)
 		else:
-			self.mdb = mongodb_database.MongoDBDatabase(data_source = data_source, user = username, pwd = password)
+			self.mdb = feature_backend.create_backend(data_source, backend, user = username, pwd = password)
 		self.sdb = SQLiteDB()
 		self.data_source = data_source
+		# features that missed the cache and were read from the backend
+		self.backend_stats = dict(queries = 0, scans = 0)
+		if local_cache_bytes is None and os.environ.get('MMDPS_LOCAL_CACHE_BYTES'):
+			local_cache_bytes = int(os.environ['MMDPS_LOCAL_CACHE_BYTES'])
+		self.local_cache = None if local_cache_bytes is None else FeatureCache(local_cache_bytes)
+		feature_backend.add_write_listener(weakref.WeakMethod(self.on_feature_write))
+
+	def on_feature_write(self, data_source, scan, atlas_name, feature, comment, window_length, step_size):
+		"""Drop the cached copies of a feature written to the backend in this process."""
+		if data_source != self.data_source:
+			return
+		feature_backend.delete_cached(self.rdb, data_source, scan, atlas_name, feature, comment, window_length, step_size)
+		if window_length is None:
+			key = feature_backend.static_key(data_source, scan, atlas_name, feature, comment)
+		else:
+			key = feature_backend.dynamic_key(data_source, scan, atlas_name, feature, window_length, step_size, comment)
+		if self.local_cache is not None:
+			self.local_cache.discard(key)
 
 	def get_feature(self, scan_list, atlasobj, feature_name, comment = {}):
 		"""
@@ -41,6 +142,7 @@ class MMDPDatabase:
 		Using scan name , altasobj/altasobj name, feature name and data source(the default is Changgung) to query data from Redis.
 		If the data is not in Redis, try to query data from Mongodb and store the data in Redis.
 		If the query succeeds, return a Net or Attr class, if not, rasie an arror.
+		All scans are fetched together, see fetch_static_values.
 		"""
 		#wrong input check
 		return_single = False
@@ -52,29 +154,56 @@ class MMDPDatabase:
 
 		if (not (type(scan_list) is list or type(scan_list) is str) or type(atlasobj) is not str or type(feature_name) is not str):
 			raise Exception("Please input in the format as follows : scan must be str or a list of str, atlas and feature must be str")
-		ret_list = []
-		for scan in scan_list:
-			res = self.rdb.get_static_value(self.data_source, scan, atlasobj, feature_name, comment)
-			if res is not None:
-				ret_list.append(res)
-			else:
-				if feature_name.find('.net') == -1:
-					doc = self.mdb.total_query('SA', scan, atlasobj, feature_name, comment)
-				else:
-					doc = self.mdb.total_query('SN', scan, atlasobj, feature_name, comment)
-				doc = list(doc)
-				# doc =self.mdb.total_query('SA',scan,atlasobj,feature_name,comment)
-				# doc =self.mdb,total_query('SN',scan,atlasobj,feature_name,comment)
-				if len(doc) != 0:
-					ret_list.append(self.rdb.set_value(doc[0],self.data_source, atlasobj, feature_name))
-				else:
-					raise mongodb_database.NoRecordFoundException('No such item in redis and mongodb: ' + scan + ' ' + atlasobj + ' ' + feature_name)
-					# raise Exception('No such item in redis and mongodb: ' + scan +' '+ atlasobj +' '+ feature_name)
+		values = self.fetch_static_values(scan_list, atlasobj, feature_name, comment)
+		ret_list = [feature_backend.to_netattr(scan, atlasobj, feature_name, value) for scan, value in zip(scan_list, values)]
 		if return_single:
 			return ret_list[0]
 		else:
 			return ret_list
 
+	def get_feature_stack(self, scan_list, atlasobj, feature_name, comment = {}):
+		"""
+		Like get_feature for a list of scans, return (stack, ret_list).
+		stack is a (scans, ...) np array, and the data of every Net or Attr in ret_list is a view into it.
+		"""
+		if type(atlasobj) is atlas.Atlas:
+			atlasobj = atlasobj.name
+		stack = np.stack(self.fetch_static_values(list(scan_list), atlasobj, feature_name, comment))
+		ret_list = [feature_backend.to_netattr(scan, atlasobj, feature_name, stack[i]) for i, scan in enumerate(scan_list)]
+		return stack, ret_list
+
+	def fetch_static_values(self, scan_list, atlas_name, feature_name, comment = {}):
+		"""
+		Fetch the static feature values of scan_list, in order.
+		Values in the local cache are read-only and are not fetched again,
+		unless the write count of the collection changed.
+		"""
+		if self.local_cache is None:
+			return self.fetch_remote_static_values(scan_list, atlas_name, feature_name, comment)
+		keys = [feature_backend.static_key(self.data_source, scan, atlas_name, feature_name, comment) for scan in scan_list]
+		write_count = self.rdb.get_write_count(self.data_source, atlas_name, feature_name)
+		return self.local_cache.fetch(keys, lambda indexes: self.fetch_remote_static_values([scan_list[i] for i in indexes], atlas_name, feature_name, comment), write_count)
+
+	def fetch_remote_static_values(self, scan_list, atlas_name, feature_name, comment = {}):
+		"""
+		Fetch the static feature values of scan_list from the cache and the backend, in order.
+		With redis and mongodb, one Redis MGET for all scans, one MongoDB $in query for
+		the misses, and one pipelined Redis write to back-fill them.
+		"""
+		values = self.rdb.get_static_values(self.data_source, scan_list, atlas_name, feature_name, comment)
+		missing = sorted(set(scan for scan, value in zip(scan_list, values) if value is None))
+		if len(missing) == 0:
+			return values
+		dbname = 'SA' if feature_name.find('.net') == -1 else 'SN'
+		self.backend_stats['queries'] += 1
+		self.backend_stats['scans'] += len(missing)
+		found = self.mdb.load_static_values(dbname, missing, atlas_name, feature_name, comment)
+		notfound = [scan for scan in missing if scan not in found]
+		if notfound:
+			raise feature_backend.NoRecordFoundException('No such item in the cache and the backend: ' + ', '.join(notfound) + ' ' + atlas_name + ' ' + feature_name)
+		self.rdb.set_static_values(self.data_source, atlas_name, feature_name, missing, [found[scan] for scan in missing], comment)
+		return [found[scan] if value is None else value for scan, value in zip(scan_list, values)]
+
 	def get_dynamic_feature(self, scan_list, atlasobj, feature_name, window_length, step_size, comment = {}):
 		"""
 		Designed for dynamic networks and attributes query.
@@ -82,6 +211,7 @@ class MMDPDatabase:
 			to query data from Redis.
 		If the data is not in Redis, try to query data from Mongodb and store the data in Redis.
 		If the query succeeds, return a DynamicNet or DynamicAttr class, if not, rasie an arror.
+		All scans are fetched together, see fetch_dynamic_values.
 		"""
 		return_single = False
 		if type(scan_list) is str:
@@ -91,31 +221,67 @@ class MMDPDatabase:
 			atlasobj = atlasobj.name
 		if (not (type(scan_list) is list or type(scan_list) is str) or type(atlasobj) is not str or type(feature_name) is not str or type(window_length) is not int or type(step_size) is not int):
 			raise Exception("Please input in the format as follows : scan must be str or a list of str, atlas and feature must be str, window length and step size must be int")
-		ret_list = []
-		for scan in scan_list:
-			res = self.rdb.get_dynamic_value(self.data_source, scan, atlasobj, feature_name, window_length, step_size, comment)
-			if res is not None:
-				ret_list.append(res)
-			else:
-				# doc = self.mdb.total_query('DA',scan, atlasobj, feature_name, comment, window_length, step_size)
-				# doc = self.mdb.total_query('DN',scan, atlasobj, feature_name, comment, window_length, step_size)
-				if feature_name.find('.net') == -1:
-					doc = self.mdb.total_query('DA', scan, atlasobj, feature_name, comment, window_length, step_size)
-				else:
-					doc = self.mdb.total_query('DN', scan, atlasobj, feature_name, comment, window_length, step_size)
-				doc = list(doc)
-				if len(doc) != 0:
-					mat = self.rdb.set_value(doc,self.data_source, atlasobj, feature_name, window_length, step_size)
-					ret_list.append(mat)
-				else:
-					raise mongodb_database.NoRecordFoundException('No such item in redis or mongodb: ' + scan + ' ' + atlasobj + ' ' + feature_name + ' ' + str(window_length) + ' ' + str(step_size))
-					# raise Exception('No such item in both redis and mongodb: ' + scan +' '+ atlasobj +' '+ feature_name +' '+
-					# 			 ' '+ str(window_length) +' '+ str(step_size))
+		values = self.fetch_dynamic_values(scan_list, atlasobj, feature_name, window_length, step_size, comment)
+		ret_list = [feature_backend.to_dynamic_netattr(scan, atlasobj, feature_name, window_length, step_size, value) for scan, value in zip(scan_list, values)]
 		if return_single:
 			return ret_list[0]
 		else:
 			return ret_list
 
+	def get_dynamic_feature_stack(self, scan_list, atlasobj, feature_name, window_length, step_size, comment = {}):
+		"""
+		Like get_dynamic_feature for a list of scans, return (stack, ret_list).
+		stack is a (scans, slices, ...) np array, all scans must have the same slice count.
+		"""
+		if type(atlasobj) is atlas.Atlas:
+			atlasobj = atlasobj.name
+		values = self.fetch_dynamic_values(list(scan_list), atlasobj, feature_name, window_length, step_size, comment)
+		if len(set(value.shape for value in values)) > 1:
+			raise Exception('Cannot stack dynamic features of different slice counts')
+		stack = np.stack(values)
+		ret_list = [feature_backend.to_dynamic_netattr(scan, atlasobj, feature_name, window_length, step_size, stack[i]) for i, scan in enumerate(scan_list)]
+		return stack, ret_list
+
+	def fetch_dynamic_values(self, scan_list, atlas_name, feature_name, window_length, step_size, comment = {}):
+		"""
+		Fetch the dynamic feature values of scan_list, in order, each one a (slices, ...) np array.
+		Values in the local cache are read-only and are not fetched again,
+		unless the write count of the collection changed.
+		"""
+		if self.local_cache is None:
+			return self.fetch_remote_dynamic_values(scan_list, atlas_name, feature_name, window_length, step_size, comment)
+		keys = [feature_backend.dynamic_key(self.data_source, scan, atlas_name, feature_name, window_length, step_size, comment) for scan in scan_list]
+		write_count = self.rdb.get_write_count(self.data_source, atlas_name, feature_name, window_length, step_size)
+		return self.local_cache.fetch(keys, lambda indexes: self.fetch_remote_dynamic_values([scan_list[i] for i in indexes], atlas_name, feature_name, window_length, step_size, comment), write_count)
+
+	def fetch_remote_dynamic_values(self, scan_list, atlas_name, feature_name, window_length, step_size, comment = {}):
+		"""
+		Fetch the dynamic feature values of scan_list from the cache and the backend, in order.
+		With redis and mongodb, Redis is read in two pipelines, misses are fetched with
+		one MongoDB $in query and back-filled in one pipelined write.
+		"""
+		values = self.rdb.get_dynamic_values(self.data_source, scan_list, atlas_name, feature_name, window_length, step_size, comment)
+		missing = sorted(set(scan for scan, value in zip(scan_list, values) if value is None))
+		if len(missing) == 0:
+			return values
+		dbname = 'DA' if feature_name.find('.net') == -1 else 'DN'
+		self.backend_stats['queries'] += 1
+		self.backend_stats['scans'] += len(missing)
+		found = self.mdb.load_dynamic_values(dbname, missing, atlas_name, feature_name, window_length, step_size, comment)
+		notfound = [scan for scan in missing if scan not in found]
+		if notfound:
+			raise feature_backend.NoRecordFoundException('No such item in the cache or the backend: ' + ', '.join(notfound) + ' ' + atlas_name + ' ' + feature_name + ' ' + str(window_length) + ' ' + str(step_size))
+		self.rdb.set_dynamic_values(self.data_source, atlas_name, feature_name, window_length, step_size, missing, [found[scan] for scan in missing], comment)
+		return [found[scan] if value is None else value for scan, value in zip(scan_list, values)]
+
+	def cache_stats(self):
+		"""
+		Return the cache statistics, the counters of the local cache, of redis
+		(see RedisDatabase.cache_stats, None without a cache) and the backend reads of the misses.
+		"""
+		local = None if self.local_cache is None else self.local_cache.cache_stats()
+		return dict(local = local, redis = self.rdb.cache_stats(), backend = dict(self.backend_stats))
+
 	def get_temp_feature(self, feature_collection, feature_name):
 		pass
 
@@ -302,6 +468,34 @@ class SQLiteDB:
 		one_person = session.query(tables.Person).filter_by(name = person_name).one()
 		return session.query(tables.MRIScan).filter_by(person_id = one_person.id)
 
+	def get_covariates(self, scans, names = ('age', 'gender')):
+		"""
+		Covariates of scans as a (len(scans), len(names)) array, in the order of scans.
+		Use it as mattool.corr(..., covariates = ...) for partial correlation.
+		- age: age in years at the scan date
+		- gender: 1 for M, 0 for F
+		Unknown values are nan.
+		"""
+		session = self.new_session()
+		db_scans = session.query(tables.MRIScan).options(joinedload(tables.MRIScan.person)).filter(tables.MRIScan.filename.in_(list(scans))).all()
+		scan_dict = {db_scan.filename: db_scan for db_scan in db_scans}
+		ret = np.full((len(scans), len(names)), np.nan)
+		for i, scan in enumerate(scans):
+			db_scan = scan_dict.get(scan)
+			if db_scan is None or db_scan.person is None:
+				print('No person found for scan %s' % scan)
+				continue
+			person = db_scan.person
+			for j, name in enumerate(names):
+				if name == 'age':
+					if person.birth is not None and db_scan.date is not None:
+						ret[i, j] = (db_scan.date - person.birth).days / 365.25
+				elif name == 'gender':
+					ret[i, j] = {'M': 1, 'F': 0}.get(person.gender, np.nan)
+				else:
+					raise Exception('Unknown covariate %s, should be age or gender' % name)
+		return ret
+
 	def delete_scan(self, session, mriscanFilename):
 		db_scan = session.query(tables.MRIScan).filter_by(filename = mriscanFilename).one()
 		session.delete(db_scan)
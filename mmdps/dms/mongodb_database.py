@@ -11,11 +11,11 @@ static document
 	"atlas": "brodmann_lrce",
 	"feature": "BOLD.inter.BC",
 	"dynamic": 0,
-	"value": "...actual csv str...",
+	"value": "...binary value, see feature_codec...",
 	"comment": {"...descriptive str..."}
 }
 
-dynamic document
+dynamic document, the slices are stored in chunks of consecutive slices
 {
 	"data_source":"Changgung",
 	"scan": "CMSA_01",
@@ -24,21 +24,104 @@ dynamic document
 	"dynamic": 1, 
 	"window_length": 22,
 	"step_size": 1,
-	"slice_num": the num of the slice 0,1,2,3…
-	"value": "...actual csv str...",
+	"chunk": the num of the chunk 0,1,2,3…
+	"slice_start": the first slice in the chunk,
+	"slice_stop": one past the last slice in the chunk,
+	"slice_count": the total num of slices,
+	"value": "...binary (slices, ...) value, see feature_codec...",
 	"comment": {"...descriptive str..."}
 }
+Older dynamic documents store one slice each, with "slice" instead of the chunk
+fields, and are still read.
 '''
 
 import os
+import numpy as np
 import pymongo
+from pymongo.errors import DuplicateKeyError, BulkWriteError, OperationFailure
 import pickle
 import json
 import scipy.io as scio
 from mmdps.proc import atlas, netattr
+from mmdps.dms import feature_codec, feature_backend
+from mmdps.dms.feature_backend import MultipleRecordException, NoRecordFoundException, add_write_listener, remove_write_listener, notify_write
 from mmdps import rootconfig
 
-class MongoDBDatabase:
+DYNAMIC_CHUNK_BYTES = 8 * 1024 * 1024
+
+def chunk_slice_count(slices):
+	"""The num of slices in one chunk, so that a chunk is about DYNAMIC_CHUNK_BYTES."""
+	slicebytes = max(slices[0].nbytes, 1) if len(slices) > 0 else 1
+	return max(1, DYNAMIC_CHUNK_BYTES // slicebytes)
+
+def dynamic_chunk_docs(scan, slices, comment={}):
+	""" Split the (slices, ...) array into chunk documents """
+	total = len(slices)
+	step = chunk_slice_count(slices)
+	docs = []
+	for chunk, start in enumerate(range(0, total, step)):
+		stop = min(start + step, total)
+		value = feature_codec.encode(slices[start:stop])
+		docs.append(dict(scan=scan, value=value, chunk=chunk, slice_start=start, slice_stop=stop, slice_count=total, comment=comment))
+	return docs
+
+def slice_range_query(start=None, stop=None):
+	""" The query of documents holding slices in [start, stop), for both chunked and per-slice documents """
+	if start is None and stop is None:
+		return {}
+	start = 0 if start is None else start
+	chunked = {'slice_stop': {'$gt': start}}
+	single = {'slice': {'$gte': start}}
+	if stop is not None:
+		chunked['slice_start'] = {'$lt': stop}
+		single['slice']['$lt'] = stop
+	return {'$or': [chunked, single]}
+
+def assemble_slices(docs, start=None, stop=None, slice_last=False):
+	"""
+	Decode the dynamic documents of one scan into one preallocated array.
+	The result is (slices, ...), or (..., slices) if slice_last.
+	Only slices in [start, stop) are kept, docs may hold more. The result has
+	no slices if none of them is in [start, stop), like the local backend.
+	"""
+	if len(docs) == 0:
+		return None
+	chunked = 'chunk' in docs[0]
+	if chunked:
+		total = docs[0]['slice_count']
+		docs = sorted(docs, key=lambda doc: doc['chunk'])
+	else:
+		docs = sorted(docs, key=lambda doc: doc['slice'])
+		total = docs[-1]['slice'] + 1
+	start = 0 if start is None else max(start, 0)
+	stop = total if stop is None else min(stop, total)
+	out = None
+	for doc in docs:
+		if chunked:
+			docstart, docstop = doc['slice_start'], doc['slice_stop']
+		else:
+			docstart, docstop = doc['slice'], doc['slice'] + 1
+		lo, hi = max(docstart, start), min(docstop, stop)
+		if lo >= hi:
+			continue
+		value = feature_codec.decode(doc['value'], copy=False)
+		if not chunked:
+			value = value[np.newaxis]
+		value = value[lo - docstart:hi - docstart]
+		if out is None:
+			shape = value.shape[1:] + (stop - start,) if slice_last else (stop - start,) + value.shape[1:]
+			out = np.empty(shape, dtype=value.dtype)
+		if slice_last:
+			out[..., lo - start:hi - start] = np.moveaxis(value, 0, -1)
+		else:
+			out[lo - start:hi - start] = value
+	if out is None:
+		value = feature_codec.decode(docs[0]['value'], copy=False)
+		shape = value.shape[1:] if chunked else value.shape
+		out = np.empty(shape + (0,) if slice_last else (0,) + shape, dtype=value.dtype)
+	return out
+
+class MongoDBDatabase(feature_backend.FeatureBackend):
 
 	def __init__(self, data_source, host=rootconfig.dms.mongo_host, user=None, pwd=None, dbname=None, port=27017):
 		""" Connect to mongo server """
@@ -60,6 +143,44 @@ class MongoDBDatabase:
 		self.EEG_db = self.client[self.data_source + '_EEG']
 		self.temp_db = self.client[self.data_source + '_TEMP']
 		self.temp_collection = self.temp_db['Temp-collection']
+		# (dbname, col) -> whether inserts are guarded by unique indexes
+		self.indexed = {}
+
+	def ensure_indexes(self, dbname, col):
+		"""
+		Create the indexes of a feature collection, (scan, comment) for static ones,
+		(scan, comment, chunk) and (scan, comment, slice) for dynamic ones.
+		They are unique, so that inserting the same record twice fails. If the collection
+		already has duplicates, or old per-slice dynamic documents, non-unique indexes
+		are used and inserts check for an existing record first.
+		"""
+		collection = self.getdb(dbname)[col]
+		if dbname in ('DA', 'DN'):
+			specs = [(('scan', 'comment', 'chunk'), 'chunk'), (('scan', 'comment', 'slice'), 'slice')]
+			unique = collection.find_one({'slice': {'$exists': True}}, {'_id': 1}) is None
+		else:
+			specs = [(('scan', 'comment'), None)]
+			unique = True
+		for fields, partial in specs:
+			keys = [(field, pymongo.ASCENDING) for field in fields]
+			kwargs = {} if partial is None else dict(partialFilterExpression={partial: {'$exists': True}})
+			try:
+				collection.create_index(keys, unique=True, **kwargs)
+			except OperationFailure as e:
+				print('Unique index not created on %s %s, use a non-unique one: %s' % (dbname, col, e))
+				unique = False
+				try:
+					collection.create_index(keys, **kwargs)
+				except OperationFailure:
+					# an index with the same keys already exists
+					pass
+		self.indexed[(dbname, col)] = unique
+
+	def collection(self, dbname, col):
+		""" Return a feature collection, its indexes are ensured the first time it is touched """
+		if (dbname, col) not in self.indexed:
+			self.ensure_indexes(dbname, col)
+		return self.getdb(dbname)[col]
 
 	def query(self, dbname, colname, filter_query):
 		db = self.client[dbname]
@@ -71,9 +192,8 @@ class MongoDBDatabase:
 		""" return only one of query records """
 		""" return None if no matching doucment is found """
 		query = dict(scan=scan, comment=comment)
-		db = self.getdb(dbname)
 		col = self.getcol(atlas_name, feature, window_length, step_size)
-		return db[col].find_one(query)
+		return self.getdb(dbname)[col].find_one(query, {'value': 0})
 
 	def total_query(self, dbname, scan, atlas_name, feature, comment={}, window_length=None, step_size=None):
 		""" dbname could be SA SN DA DN TMEP """
@@ -83,86 +203,145 @@ class MongoDBDatabase:
 		col = self.getcol(atlas_name, feature, window_length, step_size)
 		return db[col].find(query)
 
-	def getcol(self, atlas_name, attrname, window_length=None, step_size=None):
-		if (window_length, step_size) != (None, None):
-			return '%s-%s-(%d,%d)' % (atlas_name, attrname, window_length, step_size)
-		else:
-			return '%s-%s' % (atlas_name, attrname)
+	def bulk_query(self, dbname, scan_list, atlas_name, feature, comment={}, window_length=None, step_size=None):
+		""" dbname could be SA SN DA DN """
+		""" return the records of all scans in scan_list with one $in query """
+		""" dynamic records are chunks or slices, see assemble_slices """
+		query = dict(scan={'$in': list(scan_list)}, comment=comment)
+		col = self.getcol(atlas_name, feature, window_length, step_size)
+		return list(self.collection(dbname, col).find(query, {'_id': 0}))
+
+	def load_static_values(self, dbname, scan_list, atlas_name, feature, comment={}):
+		""" Return a dict of scan -> np array for the scans of scan_list found, with one $in query """
+		values = {}
+		for doc in self.bulk_query(dbname, scan_list, atlas_name, feature, comment):
+			values.setdefault(doc['scan'], feature_codec.decode(doc['value']))
+		return values
+
+	def load_dynamic_values(self, dbname, scan_list, atlas_name, feature, window_length, step_size, comment={}):
+		""" Return a dict of scan -> (slices, ...) np array for the scans of scan_list found, with one $in query """
+		docs = {}
+		for doc in self.bulk_query(dbname, scan_list, atlas_name, feature, comment, window_length, step_size):
+			docs.setdefault(doc['scan'], []).append(doc)
+		return dict((scan, assemble_slices(scan_docs)) for scan, scan_docs in docs.items())
 
 	def getdb(self, dbname):
 		""" dbname could be SA SN DA DN EEG TEMP"""
 		db = self.data_source + '_' + dbname
 		return self.client[db]
 
-	def save_static_attr(self, attr, comment={}):
-		atlas_name = attr.atlasobj.name
-		attrname = attr.feature_name
-		col = self.getcol(atlas_name, attrname)
-		if self.exist_query('SA', attr.scan, atlas_name, attrname, comment) != None:
-			raise MultipleRecordException(attr.scan, 'Please check again.')
-		attrdata = pickle.dumps(attr.data)
-		doc = dict(scan=attr.scan, value=attrdata, comment=comment)
-		self.sadb[col].insert_one(doc)
+	def save_static(self, dbname, obj, comment={}, overwrite=False):
+		"""
+		Save a Net or Attr. If the record exists, raise MultipleRecordException,
+		or replace it if overwrite.
+		"""
+		col = self.getcol(obj.atlasobj.name, obj.feature_name)
+		query = dict(scan=obj.scan, comment=comment)
+		doc = dict(scan=obj.scan, value=feature_codec.encode(obj.data), comment=comment)
+		collection = self.collection(dbname, col)
+		if overwrite:
+			collection.replace_one(query, doc, upsert=True)
+		else:
+			if not self.indexed[(dbname, col)] and collection.find_one(query, {'_id': 1}) is not None:
+				raise MultipleRecordException(obj.scan, 'Please check again.')
+			try:
+				collection.insert_one(doc)
+			except DuplicateKeyError:
+				raise MultipleRecordException(obj.scan, 'Please check again.')
+		notify_write(self.data_source, obj.scan, obj.atlasobj.name, obj.feature_name, comment)
+
+	def save_static_many(self, dbname, objs, comment={}, overwrite=False):
+		"""
+		Save many Net or Attr with one bulk write per collection.
+		Return the objs skipped because their record exists, none if overwrite.
+		"""
+		groups = {}
+		for obj in objs:
+			groups.setdefault(self.getcol(obj.atlasobj.name, obj.feature_name), []).append(obj)
+		skipped = []
+		for col, colobjs in groups.items():
+			collection = self.collection(dbname, col)
+			if not overwrite and not self.indexed[(dbname, col)]:
+				found = set(doc['scan'] for doc in collection.find(dict(scan={'$in': [obj.scan for obj in colobjs]}, comment=comment), {'scan': 1}))
+				skipped += [obj for obj in colobjs if obj.scan in found]
+				colobjs = [obj for obj in colobjs if obj.scan not in found]
+			if len(colobjs) == 0:
+				continue
+			docs = [dict(scan=obj.scan, value=feature_codec.encode(obj.data), comment=comment) for obj in colobjs]
+			failed = set()
+			if overwrite:
+				collection.bulk_write([pymongo.ReplaceOne(dict(scan=doc['scan'], comment=comment), doc, upsert=True) for doc in docs], ordered=False)
+			else:
+				try:
+					collection.insert_many(docs, ordered=False)
+				except BulkWriteError as e:
+					errors = e.details.get('writeErrors', [])
+					if any(error.get('code') != 11000 for error in errors):
+						raise
+					failed = set(error['index'] for error in errors)
+			for idx, obj in enumerate(colobjs):
+				if idx in failed:
+					skipped.append(obj)
+				else:
+					notify_write(self.data_source, obj.scan, obj.atlasobj.name, obj.feature_name, comment)
+		return skipped
+
+	def save_static_attr(self, attr, comment={}, overwrite=False):
+		self.save_static('SA', attr, comment, overwrite)
 
 	def remove_static_attr(self, scan, atlas_name, feature, comment={}):
 		col = self.getcol(atlas_name, feature)
 		query = dict(scan=scan, comment=comment)
 		self.sadb[col].find_one_and_delete(query)
+		notify_write(self.data_source, scan, atlas_name, feature, comment)
 
-	def save_static_net(self, net, comment={}):
-		atlas_name = net.atlasobj.name
-		attrname = net.feature_name
-		col = self.getcol(atlas_name, attrname)
-		if self.exist_query('SN', net.scan, atlas_name, attrname, comment) != None:
-			raise MultipleRecordException(net.scan, 'Please check again.')
-		netdata = pickle.dumps(net.data)
-		doc = dict(scan=net.scan, value=netdata, comment=comment)
-		self.sndb[col].insert_one(doc)
+	def save_static_net(self, net, comment={}, overwrite=False):
+		self.save_static('SN', net, comment, overwrite)
 
 	def remove_static_net(self, scan, atlas_name, feature, comment={}):
 		col = self.getcol(atlas_name, feature)
 		query = dict(scan=scan, comment=comment)
 		self.sndb[col].find_one_and_delete(query)
+		notify_write(self.data_source, scan, atlas_name, feature, comment)
 
-	def save_dynamic_attr(self, attr, comment={}):
+	def save_dynamic(self, dbname, obj, slices, comment={}, overwrite=False):
+		"""
+		Save the (slices, ...) array of a DynamicNet or DynamicAttr as chunk documents.
+		If the record exists, raise MultipleRecordException, or replace it if overwrite.
+		"""
+		col = self.getcol(obj.atlasobj.name, obj.feature_name, obj.window_length, obj.step_size)
+		query = dict(scan=obj.scan, comment=comment)
+		collection = self.collection(dbname, col)
+		if overwrite:
+			collection.delete_many(query)
+		elif not self.indexed[(dbname, col)] and collection.find_one(query, {'_id': 1}) is not None:
+			raise MultipleRecordException(obj.scan, 'Please check again.')
+		try:
+			collection.insert_many(dynamic_chunk_docs(obj.scan, slices, comment))
+		except BulkWriteError as e:
+			if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+				raise
+			raise MultipleRecordException(obj.scan, 'Please check again.')
+		notify_write(self.data_source, obj.scan, obj.atlasobj.name, obj.feature_name, comment, obj.window_length, obj.step_size)
+
+	def save_dynamic_attr(self, attr, comment={}, overwrite=False):
 		""" Attr could be Dynamic Attr instance """
-		atlas_name = attr.atlasobj.name
-		attrname = attr.feature_name
-		(wl, ss) = (attr.window_length, attr.step_size)
-		col = self.getcol(atlas_name, attrname, wl, ss)
-		if self.exist_query('DA', attr.scan, atlas_name, attrname, wl, ss) != None:
-			raise MultipleRecordException(
-				attr.scan, 'Please check again.')
-		docs = []
-		for idx in range(attr.data.shape[1]):
-			value = pickle.dumps(attr.data[:, idx])
-			doc = dict(scan=attr.scan, value=value, slice=idx, comment=comment)
-			docs.append(doc)
-		self.dadb[col].insert_many(docs)
+		self.save_dynamic('DA', attr, attr.data.T, comment, overwrite)
 
 	def remove_dynamic_attr(self, scan, atlas_name, feature, window_length, step_size, comment={}):
 		col = self.getcol(atlas_name, feature, window_length, step_size)
 		query = dict(scan=scan, comment=comment)
 		self.dadb[col].delete_many(query)
+		notify_write(self.data_source, scan, atlas_name, feature, comment, window_length, step_size)
 
-	def save_dynamic_net(self, net, comment={}):
-		atlas_name = net.atlasobj.name
-		attrname = net.feature_name
-		(wl, ss) = (net.window_length, net.step_size)
-		col = self.getcol(atlas_name, attrname, wl, ss)
-		if self.exist_query('DN', net.scan, atlas_name, attrname, wl, ss) != None:
-			raise MultipleRecordException(net.scan, 'Please check again.')
-		docs = []
-		for idx in range(net.data.shape[2]):
-			value = pickle.dumps(net.data[:, :, idx])
-			doc = dict(scan=net.scan, value=value, slice=idx, comment=comment)
-			docs.append(doc)
-		self.dndb[col].insert_many(docs)
+	def save_dynamic_net(self, net, comment={}, overwrite=False):
+		self.save_dynamic('DN', net, np.moveaxis(net.data, 2, 0), comment, overwrite)
 
 	def remove_dynamic_net(self, scan, atlas_name, feature, window_length, step_size, comment={}):
 		col = self.getcol(atlas_name, feature, window_length, step_size)
 		query = dict(scan=scan, comment=comment)
 		self.dndb[col].delete_many(query)
+		notify_write(self.data_source, scan, atlas_name, feature, comment, window_length, step_size)
 
 	def loadmat(self, path):
 		""" load mat, return data dict"""
@@ -224,64 +403,59 @@ class MongoDBDatabase:
 		"""  Return to an attr object  directly """
 		query = dict(scan=scan, comment=comment)
 		col = self.getcol(atlas_name, feature)
-		count = self.sadb[col].count_documents(query)
-		if count == 0:
+		records = list(self.collection('SA', col).find(query, {'_id': 0, 'value': 1}).limit(2))
+		if len(records) == 0:
 			raise NoRecordFoundException(scan+atlas_name+feature)
-		elif count > 1:
+		elif len(records) > 1:
 			raise MultipleRecordException(scan+atlas_name+feature)
 		else:
-			AttrData = pickle.loads(self.sadb[col].find_one(query)['value'])
+			AttrData = feature_codec.decode(records[0]['value'])
 			atlasobj = atlas.get(atlas_name)
 			attr = netattr.Attr(AttrData, atlasobj, scan, feature)
 			return attr
 
-	def get_dynamic_attr(self, scan, atlas_name, feature, window_length, step_size, comment={}):
+	def get_dynamic_attr(self, scan, atlas_name, feature, window_length, step_size, comment={}, start=None, stop=None):
 		""" Return to dynamic attr object directly """
+		""" Only slices in [start, stop) are loaded if given """
 		query = dict(scan=scan, comment=comment)
+		query.update(slice_range_query(start, stop))
 		col = self.getcol(atlas_name, feature, window_length, step_size)
-		count = self.dadb[col].find(query)
-		if count == 0:
+		records = list(self.collection('DA', col).find(query, {'_id': 0, 'scan': 0, 'comment': 0}))
+		if len(records) == 0:
 			raise NoRecordFoundException(scan + atlas_name + feature)
 		else:
-			records = self.dadb[col].find(
-				query).sort([('slice', pymongo.ASCENDING)])
 			atlasobj = atlas.get(atlas_name)
-			attr = netattr.DynamicAttr(
-				None, atlasobj, window_length, step_size, scan, feature)
-			for record in records:
-				attr.append_one_slice(pickle.loads(record['value']))
-			return attr
+			data = assemble_slices(records, start, stop, slice_last=True)
+			return netattr.DynamicAttr(data, atlasobj, window_length, step_size, scan, feature)
 
 	def get_static_net(self, scan, atlas_name, comment={}):
 		"""  Return to an static net object directly  """
 		query = dict(scan=scan, comment=comment)
 		col = self.getcol(atlas_name, 'BOLD.net')
-		count = self.sndb[col].count_documents(query)
-		if count == 0:
+		records = list(self.collection('SN', col).find(query, {'_id': 0, 'value': 1}).limit(2))
+		if len(records) == 0:
 			raise NoRecordFoundException(scan+atlas_name+'BOLD.net')
-		elif count > 1:
+		elif len(records) > 1:
 			raise MultipleRecordException(scan+atlas_name+'BOLD.net')
 		else:
-			NetData = pickle.loads(self.sndb[col].find_one(query)['value'])
+			NetData = feature_codec.decode(records[0]['value'])
 			atlasobj = atlas.get(atlas_name)
 			net = netattr.Net(NetData, atlasobj, scan, 'BOLD.net')
 			return net
 
-	def get_dynamic_net(self, scan, atlas_name, window_length, step_size, comment={}):
-		""" Return to dynamic attr object directly """
+	def get_dynamic_net(self, scan, atlas_name, window_length, step_size, comment={}, start=None, stop=None):
+		""" Return to dynamic net object directly """
+		""" Only slices in [start, stop) are loaded if given """
 		query = dict(scan=scan, comment=comment)
+		query.update(slice_range_query(start, stop))
 		col = self.getcol(atlas_name, 'BOLD.net', window_length, step_size)
-		if self.dndb[col].find_one(query) == None:
-			raise NoRecordFoundException((scan, atlas, 'BOLD.net'))
+		records = list(self.collection('DN', col).find(query, {'_id': 0, 'scan': 0, 'comment': 0}))
+		if len(records) == 0:
+			raise NoRecordFoundException((scan, atlas_name, 'BOLD.net'))
 		else:
-			records = self.dndb[col].find(query).sort(
-				[('slice', pymongo.ASCENDING)])
 			atlasobj = atlas.get(atlas_name)
-			net = netattr.DynamicNet(
-				None, atlasobj, window_length, step_size, scan, 'BOLD.net')
-			for record in records:
-				net.append_one_slice(pickle.loads(record['value']))
-			return net
+			data = assemble_slices(records, start, stop, slice_last=True)
+			return netattr.DynamicNet(data, atlasobj, window_length, step_size, scan, 'BOLD.net')
 
 	def put_temp_data(self, temp_data, description_dict, overwrite=False):
 		"""
@@ -296,7 +470,7 @@ class MongoDBDatabase:
 				description_dict, 'Please consider a new name')
 		elif count > 0 and overwrite:
 			self.temp_collection.delete_many(description_dict)
-		description_dict.update(dict(value=pickle.dumps(temp_data)))
+		description_dict.update(dict(value=feature_codec.encode_any(temp_data)))
 		self.temp_collection.insert_one(description_dict)
 
 	def remove_temp_data(self, description_dict={}):
@@ -328,35 +502,5 @@ class MongoDBDatabase:
 		# db[col].create_index(index, pymongo.ASCENDING)
 
 
-class MultipleRecordException(Exception):
-	"""
-	"""
-	def __init__(self, name, suggestion = ''):
-		super(MultipleRecordException, self).__init__()
-		self.name = name
-		self.suggestion = suggestion
-
-	def __str__(self):
-		return 'Multiple record found for %s. %s' % (self.name, self.suggestion)
-
-	def __repr__(self):
-		return 'Multiple record found for %s. %s' % (self.name, self.suggestion)
-
-
-class NoRecordFoundException(Exception):
-	"""
-	"""
-	def __init__(self, name, suggestion = ''):
-		super(NoRecordFoundException, self).__init__()
-		self.name = name
-		self.suggestion = ''
-
-	def __str__(self):
-		return 'No record found for %s. %s' % (self.name, self.suggestion)
-
-	def __repr__(self):
-		return 'No record found for %s. %s' % (self.name, self.suggestion)
-
-
 if __name__ == '__main__':
 	pass
@@ -3,21 +3,96 @@
 Redis is a high-speed high-performance cache database.
 A Redis database would be created on-the-fly and (possibly)
 destroyed after usage.
+
+Cache policy:
+Feature values in datadb always expire after expire_time, and reading them
+refreshes the expiration. Lists in cachedb and hashes in hashdb only expire
+if cache_expire_time is given. maxmemory and maxmemory-policy are set on the
+server if given (or MMDPS_REDIS_MAXMEMORY and MMDPS_REDIS_POLICY are set).
+They are server wide in Redis, use a volatile-* policy (like volatile-lru)
+to only evict keys with an expiration, so that only feature values are evicted.
+Hits, misses and bytes are counted per logical db, see cache_stats.
+
+Deleting a feature value also increments the write counter of its collection
+in datadb, which never expires, so processes with a local copy of the value
+can tell it is stale, see get_write_count.
 """
 from redis import StrictRedis
 import os, sys
 import pickle
 import numpy as np
 from mmdps.proc import netattr, atlas
+from mmdps.dms import feature_codec, feature_backend
 
 class RedisDatabase:
 	"""
 	docstring for RedisDatabase
 	"""
 
-	def __init__(self, expire_time = 1800):
+	DBNAMES = ('datadb', 'cachedb', 'hashdb')
+
+	def __init__(self, expire_time = 1800, cache_expire_time = None, maxmemory = None, policy = None):
 		self.expire_time = max(expire_time, 1800)
+		self.cache_expire_time = cache_expire_time
+		self.stats = dict((dbname, dict(hits = 0, misses = 0, bytes_read = 0, bytes_written = 0)) for dbname in self.DBNAMES)
 		self.start_redis()
+		self.set_memory_policy(maxmemory or os.environ.get('MMDPS_REDIS_MAXMEMORY'), policy or os.environ.get('MMDPS_REDIS_POLICY'))
+
+	def set_memory_policy(self, maxmemory = None, policy = None):
+		"""
+		Set the memory budget (like 2gb or bytes) and the eviction policy (like volatile-lru,
+		allkeys-lru, volatile-lfu) of the redis server.
+		"""
+		try:
+			if maxmemory is not None:
+				self.datadb.config_set('maxmemory', maxmemory)
+			if policy is not None:
+				self.datadb.config_set('maxmemory-policy', policy)
+		except Exception as e:
+			print('Unable to set redis memory policy, error message: ' + str(e))
+
+	def count(self, dbname, values):
+		"""Count hits, misses and bytes read of the values read from dbname, None is a miss."""
+		stats = self.stats[dbname]
+		for value in values:
+			if value is None:
+				stats['misses'] += 1
+			else:
+				stats['hits'] += 1
+				stats['bytes_read'] += len(value)
+
+	def count_written(self, dbname, values):
+		self.stats[dbname]['bytes_written'] += sum(len(value) for value in values)
+
+	def cache_stats(self):
+		"""
+		Return the hit, miss and byte counters of this process per logical db,
+		and the memory and eviction info of the server.
+		"""
+		ret = dict((dbname, dict(stats)) for dbname, stats in self.stats.items())
+		for stats in ret.values():
+			total = stats['hits'] + stats['misses']
+			stats['hit_rate'] = stats['hits'] / total if total else None
+		try:
+			memory = self.datadb.info('memory')
+			server = self.datadb.info('stats')
+			ret['server'] = dict(used_memory = memory.get('used_memory'), maxmemory = memory.get('maxmemory'),
+				maxmemory_policy = memory.get('maxmemory_policy'), keyspace_hits = server.get('keyspace_hits'),
+				keyspace_misses = server.get('keyspace_misses'), evicted_keys = server.get('evicted_keys'),
+				expired_keys = server.get('expired_keys'))
+			ret['server']['keys'] = dict((dbname, getattr(self, dbname).dbsize()) for dbname in self.DBNAMES)
+		except Exception:
+			ret['server'] = None
+		return ret
+
+	def reset_stats(self):
+		for stats in self.stats.values():
+			for key in stats:
+				stats[key] = 0
+
+	def refresh_cache_expire(self, db, key):
+		if self.cache_expire_time is not None:
+			db.expire(key, self.cache_expire_time)
 
 	def is_redis_running(self):
 		try:
@@ -76,7 +151,8 @@ class RedisDatabase:
 		if type(obj) is dict:
 			key = self.generate_static_key(data_source, obj['scan'], atlas, feature, obj['comment'])
 			self.datadb.set(key, obj['value'], ex=self.expire_time)
-			return self.trans_netattr(obj['scan'], atlas, feature, pickle.loads(obj['value']))
+			self.count_written('datadb', [obj['value']])
+			return self.trans_netattr(obj['scan'], atlas, feature, feature_codec.decode(obj['value']))
 		elif type(obj) is list:
 			value = []
 			scan = obj[0]['scan']
@@ -89,14 +165,17 @@ class RedisDatabase:
 				pipe.set(key_all + ':0', length, ex=self.expire_time - 200)
 				for i in range(length):  # 使用查询关键字保证升序
 					pipe.set(key_all + ':' + str(i + 1), (obj[i]['value']), ex=self.expire_time)
-					value.append(pickle.loads(obj[i]['value']))
+					self.count_written('datadb', [obj[i]['value']])
+					value.append(feature_codec.decode(obj[i]['value'], copy = False))
 				pipe.execute()
 			except Exception as e:
 				raise Exception('An error occur when tring to set value in redis, error message: ' + str(e))
 			return self.trans_dynamic_netattr(scan, atlas, feature, window_length, step_size, np.array(value))
 		elif type(obj) is netattr.Net or type(obj) is netattr.Attr:
 			key = self.generate_static_key(data_source, obj.scan, obj.atlasobj.name, obj.feature_name, {})
-			self.datadb.set(key, pickle.dumps(obj.data))
+			value = feature_codec.encode(obj.data)
+			self.datadb.set(key, value, ex=self.expire_time)
+			self.count_written('datadb', [value])
 		elif type(obj) is netattr.DynamicNet or type(obj) is netattr.DynamicAttr:
 			key_all = self.generate_dynamic_key(data_source, obj.scan, obj.atlasobj.name, obj.feature_name, obj.window_length, obj.step_size, {})
 			length=obj.data.shape[2]
@@ -110,25 +189,45 @@ class RedisDatabase:
 				pipe.set(key_all + ':0', length, ex=self.expire_time - 200)
 				for i in range(length):  # 使用查询关键字保证升序
 					if flag:
-						pipe.set(key_all + ':' + str(i + 1), pickle.dumps(obj.data[:, :, i]), ex=self.expire_time)
+						value = feature_codec.encode(obj.data[:, :, i])
 					else:
-						pipe.set(key_all + ':' + str(i + 1), obj.data[:, i], ex=self.expire_time)
+						value = feature_codec.encode(obj.data[:, i])
+					pipe.set(key_all + ':' + str(i + 1), value, ex=self.expire_time)
+					self.count_written('datadb', [value])
 				pipe.execute()
 			except Exception as e:
 				raise Exception('An error occur when tring to set value in redis, error message: ' + str(e))
 
 	def generate_static_key(self, data_source, subject_scan, atlas_name, feature_name, comment):
-		key = data_source + ':' + subject_scan + ':' + atlas_name + ':' + feature_name + ':0'
-		if comment is not None:
-			key += ':' + str(comment)
-		return key
+		return feature_backend.static_key(data_source, subject_scan, atlas_name, feature_name, comment)
 
 	def generate_dynamic_key(self, data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment):
-		key = data_source + ':' + subject_scan + ':' + atlas_name + ':' + feature_name +':1:'+ str(window_length) + ':' + str(step_size)
-		if comment is not None:
-			key += ':' + str(comment)
+		return feature_backend.dynamic_key(data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment)
+
+	def generate_write_count_key(self, data_source, atlas_name, feature_name, window_length = None, step_size = None):
+		key = 'writes:' + data_source + ':' + atlas_name + ':' + feature_name
+		if window_length is not None:
+			key += ':' + str(window_length) + ':' + str(step_size)
 		return key
 
+	def get_write_count(self, data_source, atlas_name, feature_name, window_length = None, step_size = None):
+		"""The number of values of the collection deleted so far, by any process."""
+		res = self.datadb.get(self.generate_write_count_key(data_source, atlas_name, feature_name, window_length, step_size))
+		return 0 if res is None else int(res)
+
+	def delete_static_value(self, data_source, subject_scan, atlas_name, feature_name, comment = {}):
+		pipe = self.datadb.pipeline(transaction = False)
+		pipe.delete(self.generate_static_key(data_source, subject_scan, atlas_name, feature_name, comment))
+		pipe.incr(self.generate_write_count_key(data_source, atlas_name, feature_name))
+		pipe.execute()
+
+	def delete_dynamic_value(self, data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment = {}):
+		"""Delete the slice count key, the slices are then misses and expire by themselves."""
+		pipe = self.datadb.pipeline(transaction = False)
+		pipe.delete(self.generate_dynamic_key(data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment) + ':0')
+		pipe.incr(self.generate_write_count_key(data_source, atlas_name, feature_name, window_length, step_size))
+		pipe.execute()
+
 	def get_static_value(self, data_source, subject_scan, atlas_name, feature_name, comment = {}):
 		"""
 		Using data source, scan name, altasobj name, feature name to query static networks and attributes from Redis.
@@ -136,19 +235,98 @@ class RedisDatabase:
 		"""
 		key = self.generate_static_key(data_source, subject_scan, atlas_name, feature_name, comment)
 		res = self.datadb.get(key)
-		self.datadb.expire(key, self.expire_time)
+		self.count('datadb', [res])
 		if res is not None:
-			return self.trans_netattr(subject_scan, atlas_name, feature_name, pickle.loads(res))
+			self.datadb.expire(key, self.expire_time)
+			return self.trans_netattr(subject_scan, atlas_name, feature_name, feature_codec.decode(res))
 		else:
 			return None
 
+	def get_static_values(self, data_source, scan_list, atlas_name, feature_name, comment = {}):
+		"""
+		Bulk version of get_static_value, one MGET for all scans.
+		Return a list of np arrays in the order of scan_list, None for scans not in Redis.
+		The expiration time of the found keys is refreshed in one pipeline.
+		"""
+		if len(scan_list) == 0:
+			return []
+		keys = [self.generate_static_key(data_source, scan, atlas_name, feature_name, comment) for scan in scan_list]
+		res = self.datadb.mget(keys)
+		self.count('datadb', res)
+		pipe = self.datadb.pipeline(transaction = False)
+		for key, value in zip(keys, res):
+			if value is not None:
+				pipe.expire(key, self.expire_time)
+		pipe.execute()
+		return [None if value is None else feature_codec.decode(value) for value in res]
+
+	def set_static_values(self, data_source, atlas_name, feature_name, scan_list, values_list, comment = {}):
+		"""
+		Bulk version of set_value for static values, one pipelined write.
+		values_list holds one np array per scan in scan_list.
+		"""
+		pipe = self.datadb.pipeline(transaction = False)
+		for scan, values in zip(scan_list, values_list):
+			value = feature_codec.encode(values)
+			pipe.set(self.generate_static_key(data_source, scan, atlas_name, feature_name, comment), value, ex=self.expire_time)
+			self.count_written('datadb', [value])
+		pipe.execute()
+
+	def get_dynamic_values(self, data_source, scan_list, atlas_name, feature_name, window_length, step_size, comment = {}):
+		"""
+		Bulk version of get_dynamic_value. The slice counts of all scans are read in one
+		pipeline, and all slices of the found scans in another.
+		Return a list of (slices, ...) np arrays in the order of scan_list, None for scans not in Redis.
+		"""
+		if len(scan_list) == 0:
+			return []
+		keys_all = [self.generate_dynamic_key(data_source, scan, atlas_name, feature_name, window_length, step_size, comment) for scan in scan_list]
+		lengths = self.datadb.mget([key_all + ':0' for key_all in keys_all])
+		pipe = self.datadb.pipeline(transaction = False)
+		for key_all, length in zip(keys_all, lengths):
+			if length is not None:
+				for i in range(1, int(length) + 1):
+					pipe.get(key_all + ':' + str(i))
+					pipe.expire(key_all + ':' + str(i), self.expire_time)
+				pipe.expire(key_all + ':0', self.expire_time - 200)
+		res = pipe.execute()
+		ret = []
+		pos = 0
+		for length in lengths:
+			if length is None:
+				ret.append(None)
+				self.count('datadb', [None])
+				continue
+			length = int(length)
+			# every slice has a get and an expire reply, then one expire for the length key
+			slices = res[pos:pos + 2 * length:2]
+			pos += 2 * length + 1
+			if any(value is None for value in slices):
+				# partly expired, treat as a miss
+				ret.append(None)
+				self.count('datadb', [None])
+			else:
+				self.count('datadb', [b''.join(slices)])
+				ret.append(np.array([feature_codec.decode(value, copy = False) for value in slices]))
+		return ret
+
+	def set_dynamic_values(self, data_source, atlas_name, feature_name, window_length, step_size, scan_list, values_list, comment = {}):
+		"""
+		Bulk version of set_value for dynamic values, one pipelined write.
+		values_list holds one (slices, ...) np array per scan in scan_list.
+		"""
+		pipe = self.datadb.pipeline(transaction = False)
+		for scan, values in zip(scan_list, values_list):
+			key_all = self.generate_dynamic_key(data_source, scan, atlas_name, feature_name, window_length, step_size, comment)
+			pipe.set(key_all + ':0', len(values), ex=self.expire_time - 200)
+			for i in range(len(values)):
+				value = feature_codec.encode(values[i])
+				pipe.set(key_all + ':' + str(i + 1), value, ex=self.expire_time)
+				self.count_written('datadb', [value])
+		pipe.execute()
+
 	def trans_netattr(self,subject_scan, atlas_name, feature_name, value):
-		if value.ndim == 1:  # 这里要改一下
-			arr = netattr.Attr(value, atlas.get(atlas_name),subject_scan, feature_name)
-			return arr
-		else:
-			net = netattr.Net(value, atlas.get(atlas_name), subject_scan, feature_name)
-			return net
+		return feature_backend.to_netattr(subject_scan, atlas_name, feature_name, value)
 
 	def get_dynamic_value(self, data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment = {}):
 		"""
@@ -171,23 +349,20 @@ class RedisDatabase:
 				pipe.multi()
 				value = []
 				for i in range(length):
-					value.append(pickle.loads(res[i]))
+					value.append(feature_codec.decode(res[i], copy = False))
 					pipe.expire(key_all + ':' + str(i+1), self.expire_time)
 				pipe.expire(key_all + ':0', self.expire_time - 200)
 				pipe.execute()
 			except Exception as e:
 				raise Exception('An error occur when tring to update expiration time in redis, error message: ' + str(e))
+			self.count('datadb', [b''.join(res)])
 			return self.trans_dynamic_netattr(subject_scan, atlas_name, feature_name, window_length, step_size, np.array(value))
 		else:
+			self.count('datadb', [None])
 			return None
 
 	def trans_dynamic_netattr(self, subject_scan, atlas_name, feature_name, window_length, step_size, value):
-		if value.ndim == 2:  # 这里要改一下
-			arr = netattr.DynamicAttr(value.swapaxes(0,1), atlas.get(atlas_name), window_length, step_size, subject_scan, feature_name)
-			return arr
-		else:
-			net = netattr.DynamicNet(value.swapaxes(0,2).swapaxes(0,1), atlas.get(atlas_name), window_length, step_size, subject_scan, feature_name)
-			return net
+		return feature_backend.to_dynamic_netattr(subject_scan, atlas_name, feature_name, window_length, step_size, value)
 
 	def exists_key(self,data_source, subject_scan, atlas_name, feature_name, isdynamic = False, window_length = 0, step_size = 0, comment ={}):
 		"""
@@ -210,8 +385,11 @@ class RedisDatabase:
 		Note: please check the existence of the cache_key, or it will cover the origin entry.
 		"""
 		self.cachedb.delete(key)
-		for i in value:
-			self.cachedb.rpush(key, pickle.dumps(i))
+		values = [pickle.dumps(i) for i in value]
+		if values:
+			self.cachedb.rpush(key, *values)
+		self.count_written('cachedb', values)
+		self.refresh_cache_expire(self.cachedb, key)
 		#self.cachedb.save()
 		return self.cachedb.llen(key)
 
@@ -220,7 +398,10 @@ class RedisDatabase:
 		Append value to a list as the last one in Redis with cache_key.
 		If the given key is empty in Redis, a new list will be created.
 		"""
-		self.cachedb.rpush(key, pickle.dumps(value))
+		value = pickle.dumps(value)
+		self.cachedb.rpush(key, value)
+		self.count_written('cachedb', [value])
+		self.refresh_cache_expire(self.cachedb, key)
 		#self.cachedb.save()
 		return self.cachedb.llen(key)
 
@@ -229,6 +410,9 @@ class RedisDatabase:
 		Return a list with given cache_key in Redis.
 		"""
 		res = self.cachedb.lrange(key, start, end)
+		self.count('cachedb', res if res else [None])
+		if res:
+			self.refresh_cache_expire(self.cachedb, key)
 		lst=[]
 		for x in res:
 			lst.append(pickle.loads(x))
@@ -269,6 +453,8 @@ class RedisDatabase:
 		for i in hash:
 			hash[i]=pickle.dumps(hash[i])
 		self.hashdb.hmset(name,hash)
+		self.count_written('hashdb', hash.values())
+		self.refresh_cache_expire(self.hashdb, name)
 
 	def set_hash(self,name, item1, item2=''):
 		"""
@@ -282,8 +468,12 @@ class RedisDatabase:
 			for i in item1:
 				item1[i] = pickle.dumps(item1[i])
 			self.hashdb.hmset(name,item1)
+			self.count_written('hashdb', item1.values())
 		else:
-			self.hashdb.hset(name, item1, pickle.dumps(item2))
+			item2 = pickle.dumps(item2)
+			self.hashdb.hset(name, item1, item2)
+			self.count_written('hashdb', [item2])
+		self.refresh_cache_expire(self.hashdb, name)
 
 	def get_hash(self,name,keys=[]):
 		"""
@@ -293,8 +483,10 @@ class RedisDatabase:
 				the value_list is the same sequence as key_list.
 			3.Return a value with a given hash_name and a key in Redis.
 		"""
+		self.refresh_cache_expire(self.hashdb, name)
 		if not keys:
 			res = self.hashdb.hgetall(name)
+			self.count('hashdb', res.values() if res else [None])
 			hash={}
 			for i in res:
 				hash[i.decode()]=pickle.loads(res[i])
@@ -302,11 +494,14 @@ class RedisDatabase:
 		else:
 			if type(keys) is list:
 				res = self.hashdb.hmget(name, keys)
+				self.count('hashdb', res)
 				for i in range(len(res)):
 					res[i]=pickle.loads(res[i])
 				return res
 			else:
-				return pickle.loads(self.hashdb.hget(name, keys))
+				res = self.hashdb.hget(name, keys)
+				self.count('hashdb', [res])
+				return pickle.loads(res)
 
 	def exists_hash(self,name):
 		"""
@@ -5,6 +5,8 @@ Analysis and Report
 from mmdps.proc import loader, netattr
 from mmdps.dms import mmdpdb, tables
 from mmdps.vis import line
+from mmdps.util import mattool, stats_utils
+import numpy as np
 
 class GroupAnalysisAssistant():
 	"""docstring for GroupAnalysisAssistant"""
@@ -54,45 +56,55 @@ class GroupAnalysisAssistant():
 		stats_network, comp_p_network = netattr.networks_comparisons(self.group_nets[group2_name], self.group_nets[group1_name], comparison_method)
 		return stats_network, comp_p_network
 
-	def correlate_sigdiff_BOLD_network(self, group1_name, group2_name, scoreLoader, score1_name, score2_name, comp_p_network, correlation_method):
+	def correlate_sigdiff_BOLD_network(self, group1_name, group2_name, scoreLoader, score1_name, score2_name, comp_p_network, correlation_method, covariates = None):
 		"""
 		Only significant different connections will be correlated to scores.
 		Correlation coefficient and p_vals of significant correlated links will be stored to r_network and corr_p_network
+		correlation_method can be one of stats_utils.CORRELATION_METHODS (function or name), which run
+		on all connections at once. stats_utils.correlation_Kendall runs per connection with the p value
+		of scipy, the name 'kendall' runs batched with the asymptotic p value. covariates (subjects of group1 then group2, k) give partial correlation,
+		see mmdpdb.SQLiteDB.get_covariates.
 		"""
 		group1 = self.study.get_group(group1_name)
 		group2 = self.study.get_group(group2_name)
 		r_network = netattr.zero_net(self.atlasobj)
 		corr_p_network = netattr.one_net(self.atlasobj)
-		for xidx in range(self.atlasobj.count):
-			for yidx in range(xidx, self.atlasobj.count):
-				if comp_p_network.data[xidx, yidx] > 0.05:
-					continue
-				FC_list = [net.data[xidx, yidx] for net in self.group_nets[group1.name]] + [net.data[xidx, yidx] for net in self.group_nets[group2.name]]
-				score_list = [scoreLoader[subject][score1_name] for subject in group1.getSubjectNameList()] + [scoreLoader[subject][score2_name] for subject in group2.getSubjectNameList()]
-				r, p = correlation_method(FC_list, score_list)
-				if p < 0.05:
-					r_network.data[xidx, yidx] = r
-					r_network.data[yidx, xidx] = r
-					corr_p_network.data[xidx, yidx] = p
-					corr_p_network.data[yidx, xidx] = p
+		score_list = [scoreLoader[subject][score1_name] for subject in group1.getSubjectNameList()] + [scoreLoader[subject][score2_name] for subject in group2.getSubjectNameList()]
+		xidxs, yidxs = np.nonzero(np.triu(comp_p_network.data <= 0.05))
+		if len(xidxs) == 0:
+			return r_network, corr_p_network
+		nets = self.group_nets[group1.name] + self.group_nets[group2.name]
+		FC_stack = np.stack([net.data[xidxs, yidxs] for net in nets])
+		method = stats_utils.correlation_method_name(correlation_method)
+		if method is not None:
+			r, p = mattool.corr(FC_stack, np.array(score_list, dtype = float), method, covariates)
+			r, p = r[:, 0], p[:, 0]
+		elif covariates is not None:
+			raise Exception('covariates need one of stats_utils.CORRELATION_METHODS')
+		else:
+			r = np.zeros(len(xidxs))
+			p = np.ones(len(xidxs))
+			for i in range(len(xidxs)):
+				r[i], p[i] = correlation_method(list(FC_stack[:, i]), score_list)
+		sig = p < 0.05
+		r_network.data[xidxs[sig], yidxs[sig]] = r[sig]
+		r_network.data[yidxs[sig], xidxs[sig]] = r[sig]
+		corr_p_network.data[xidxs[sig], yidxs[sig]] = p[sig]
+		corr_p_network.data[yidxs[sig], xidxs[sig]] = p[sig]
 		return r_network, corr_p_network
 
 	def generate_network_result_comp(self, stats_network, comp_p_network):
 		result_list = []
-		for xidx, xtick in enumerate(self.atlasobj.ticks):
-			for yidx in range(xidx, self.atlasobj.count):
-				ytick = self.atlasobj.ticks[yidx]
-				if comp_p_network.data[xidx, yidx] < 0.05:
-					result_list.append(dict(area1 = xtick, area2 = ytick, stat = stats_network.data[xidx, yidx], p_val = comp_p_network.data[xidx, yidx]))
+		ticks = self.atlasobj.ticks
+		for xidx, yidx in zip(*np.nonzero(np.triu(comp_p_network.data < 0.05))):
+			result_list.append(dict(area1 = ticks[xidx], area2 = ticks[yidx], stat = stats_network.data[xidx, yidx], p_val = comp_p_network.data[xidx, yidx]))
 		return result_list
 
 	def generate_network_result_comp_corr(self, stats_network, comp_p_network, r_network, corr_p_network):
 		result_list = []
-		for xidx, xtick in enumerate(self.atlasobj.ticks):
-			for yidx in range(xidx, self.atlasobj.count):
-				ytick = self.atlasobj.ticks[yidx]
-				if comp_p_network.data[xidx, yidx] < 0.05 and corr_p_network.data[xidx, yidx] < 0.05:
-					result_list.append(dict(area1 = xtick, area2 = ytick, stat = stats_network.data[xidx, yidx], p_val = comp_p_network.data[xidx, yidx], corr_r = r_network.data[xidx, yidx], corr_p = corr_p_network.data[xidx, yidx]))
+		ticks = self.atlasobj.ticks
+		for xidx, yidx in zip(*np.nonzero(np.triu((comp_p_network.data < 0.05) & (corr_p_network.data < 0.05)))):
+			result_list.append(dict(area1 = ticks[xidx], area2 = ticks[yidx], stat = stats_network.data[xidx, yidx], p_val = comp_p_network.data[xidx, yidx], corr_r = r_network.data[xidx, yidx], corr_p = corr_p_network.data[xidx, yidx]))
 		return result_list
 
 	def plot_BOLD_attr_line(self, group1_name, group2_name, title, outfilepath):
@@ -5,18 +5,170 @@ Access brain atlases.
 """
 
 import os
+import functools
 import numpy as np
+from scipy import sparse
 # from .. import rootconfig
 # from ..util import loadsave
 # from ..vis import bnv
 # from ..util import dataop
 from mmdps import rootconfig
-from mmdps.util import loadsave, dataop
+from mmdps.util import loadsave, dataop, path
 from mmdps.vis.bnv import BNVNode
 import nibabel as nib
 
 atlas_list = ['brodmann_lr', 'brodmann_lrce', 'aal', 'aicha', 'bnatlas']
 
+class RegionVoxelIndex:
+	"""
+	Label to voxel index of one atlas volume, in CSR layout.
+
+	order holds the flattened voxel indexes sorted by region, and
+	order[offsets[i]:offsets[i+1]] are the voxels of the ith region in regions.
+	Build it once per atlas volume and reuse it for every image in the same space.
+	All reductions are single bincount or sparse product passes over the voxels.
+	"""
+	def __init__(self, order, offsets, shape, regions = None):
+		"""Init the index using voxel order, region offsets and volume shape."""
+		self.order = order
+		self.offsets = offsets
+		self.shape = tuple(int(d) for d in shape)
+		self.regions = regions
+		self.nvoxels = int(np.prod(self.shape))
+		self.count = len(offsets) - 1
+		self.counts = np.diff(offsets)
+		self._regionids = None
+		self._voxelregions = None
+		self._averaging_matrix = None
+
+	@classmethod
+	def from_labels(cls, labeldata, regions):
+		"""
+		Build the index from label data, in one pass.
+		regions are the label values in region order, like atlasobj.regions.
+		Voxels whose label is not in regions are left out.
+		"""
+		labels = np.asarray(labeldata).ravel()
+		regions = np.asarray(regions)
+		sorter = np.argsort(regions, kind='stable')
+		sortedregions = regions[sorter]
+		pos = np.searchsorted(sortedregions, labels)
+		pos[pos == len(regions)] = 0
+		valid = sortedregions[pos] == labels
+		regionidx = sorter[pos[valid]]
+		voxels = np.flatnonzero(valid)
+		order = voxels[np.argsort(regionidx, kind='stable')]
+		counts = np.bincount(regionidx, minlength=len(regions))
+		offsets = np.zeros(len(regions) + 1, dtype=np.int64)
+		np.cumsum(counts, out=offsets[1:])
+		return cls(order, offsets, np.shape(labeldata), regions)
+
+	@classmethod
+	def load(cls, npzfile, sourcefile = None, regions = None):
+		"""
+		Load an index saved by save.
+		Return None if npzfile is missing, or stale with respect to sourcefile or regions.
+		"""
+		if not os.path.isfile(npzfile):
+			return None
+		with np.load(npzfile) as saved:
+			if sourcefile is not None and not np.array_equal(saved['source_stamp'], file_stamp(sourcefile)):
+				return None
+			if regions is not None and not np.array_equal(saved['regions'], np.asarray(regions)):
+				return None
+			return cls(saved['order'], saved['offsets'], saved['shape'], saved['regions'])
+
+	def save(self, npzfile, sourcefile = None):
+		"""
+		Save the index to npzfile, stamped with the mtime and size of sourcefile.
+		The file is written aside and renamed, so concurrent readers never see half a file.
+		"""
+		stamp = file_stamp(sourcefile) if sourcefile is not None else np.zeros(2, dtype=np.int64)
+		tmpfile = '%s.%d.tmp' % (npzfile, os.getpid())
+		with open(tmpfile, 'wb') as f:
+			np.savez(f, order=self.order, offsets=self.offsets, shape=np.array(self.shape), regions=np.asarray(self.regions), source_stamp=stamp)
+		os.replace(tmpfile, npzfile)
+
+	def region_voxels(self, regionidx):
+		"""The flattened voxel indexes of the region at regionidx."""
+		return self.order[self.offsets[regionidx]:self.offsets[regionidx+1]]
+
+	def regionids(self):
+		"""The region index of every voxel in order."""
+		if self._regionids is None:
+			self._regionids = np.repeat(np.arange(self.count), self.counts)
+		return self._regionids
+
+	def voxel_regions(self):
+		"""The region index of every voxel in the flattened volume, -1 if unlabeled."""
+		if self._voxelregions is None:
+			self._voxelregions = np.full(self.nvoxels, -1, dtype=np.int64)
+			self._voxelregions[self.order] = self.regionids()
+		return self._voxelregions
+
+	def averaging_matrix(self):
+		"""
+		The sparse (count, nvoxels) matrix that averages voxels into regions.
+		Its CSR structure is exactly order and offsets.
+		"""
+		if self._averaging_matrix is None:
+			weights = np.zeros(self.count)
+			np.divide(1.0, self.counts, out=weights, where=self.counts > 0)
+			self._averaging_matrix = sparse.csr_matrix((np.repeat(weights, self.counts), self.order, self.offsets), shape=(self.count, self.nvoxels))
+		return self._averaging_matrix
+
+	def check_shape(self, data):
+		"""Raise if data is not in the space of this index."""
+		if data.shape[:3] != self.shape:
+			raise Exception('Data shape %s does not match atlas volume shape %s' % (data.shape, self.shape))
+
+	def region_sum(self, data):
+		"""Sum of a 3D volume in every region, as one bincount."""
+		data = np.asarray(data)
+		self.check_shape(data)
+		return np.bincount(self.regionids(), weights=data.ravel()[self.order], minlength=self.count)
+
+	def region_mean(self, data):
+		"""
+		Mean of data in every region, in one pass over the voxels.
+		data is a 3D volume or a 4D series with the same spatial shape as the index.
+		Return a (count,) vector for 3D data, or a (count, timepoints) matrix for 4D data.
+		Regions without any voxel get nan.
+		"""
+		data = np.asarray(data)
+		self.check_shape(data)
+		if data.ndim == 3:
+			res = self.region_sum(data)
+			res[self.counts == 0] = np.nan
+			np.divide(res, self.counts, out=res, where=self.counts > 0)
+			return res
+		res = self.averaging_matrix() @ data.reshape(self.nvoxels, -1)
+		res[self.counts == 0] = np.nan
+		return res
+
+	def fill_regions(self, values, background = 0, dtype = None):
+		"""
+		Build a volume where the voxels of the ith region take values[i].
+		Voxels outside all regions take background.
+		"""
+		values = np.asarray(values)
+		volume = np.full(self.nvoxels, background, dtype=dtype if dtype is not None else values.dtype)
+		volume[self.order] = np.repeat(values, self.counts)
+		return volume.reshape(self.shape)
+
+@functools.lru_cache(maxsize = None)
+def upper_triangle_indexes(n):
+	"""(rows, cols) of the strict upper triangle of a (n, n) matrix, row-wise, cached and read-only."""
+	rows, cols = np.triu_indices(n, 1)
+	rows.flags.writeable = False
+	cols.flags.writeable = False
+	return rows, cols
+
+def file_stamp(filepath):
+	"""The (mtime_ns, size) stamp of a file, used to check if caches are up to date."""
+	stat = os.stat(filepath)
+	return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
 class Atlas:
 	"""
 	The brain atlas.
@@ -91,6 +243,30 @@ class Atlas:
 		"""Get one volume using volumename."""
 		return self.volumes[volumename]
 
+	def get_voxel_index(self, volumename):
+		"""
+		Get the RegionVoxelIndex of one volume, like '1mm' or '3mm'.
+
+		The index is built lazily and cached on disk next to the nii file, as
+		xxx.voxelindex.npz. The cache is rebuilt when the nii file changes.
+		Within one process the index is kept in memory.
+		"""
+		if not hasattr(self, '_voxelindexes'):
+			self._voxelindexes = {}
+		if volumename not in self._voxelindexes:
+			niifile = self.get_volume(volumename)['niifile']
+			cachefile = path.splitext(niifile)[0] + '.voxelindex.npz'
+			voxelindex = RegionVoxelIndex.load(cachefile, niifile, self.regions)
+			if voxelindex is None:
+				atlasimg = loadsave.load_nii(niifile)
+				voxelindex = RegionVoxelIndex.from_labels(atlasimg.get_data(), self.regions)
+				try:
+					voxelindex.save(cachefile, niifile)
+				except OSError as e:
+					print('Cannot cache voxel index at %s: %s' % (cachefile, e))
+			self._voxelindexes[volumename] = voxelindex
+		return self._voxelindexes[volumename]
+
 	def ticks_to_regions(self, ticks):
 		"""Convert ticks to regions."""
 		if not hasattr(self, '_tickregiondict'):
@@ -105,16 +281,77 @@ class Atlas:
 		indexes = [self._regionindexdict[region] for region in regions]
 		return indexes
 
+	def tick_index_dict(self):
+		"""The tick -> index dict, built once."""
+		if not hasattr(self, '_tickindexdict'):
+			self._tickindexdict = dict([(k, i) for i, k in enumerate(self.ticks)])
+		return self._tickindexdict
+
 	def ticks_to_indexes(self, ticks):
 		"""
 		Convert ticks to indexes.
 		ticks should be a list of tick, like ['L1', 'R2'] etc
 		"""
-		# if not hasattr(self, '_tickindexdict'):
-		# 	self._tickindexdict = dict([(k, i) for i, k in enumerate(self.ticks)])
-		# indexes = [self._tickindexdict[tick] for tick in ticks]
-		# return indexes
-		return [self.ticks.index(region) for region in ticks]
+		tickindexdict = self.tick_index_dict()
+		try:
+			return [tickindexdict[tick] for tick in ticks]
+		except KeyError as e:
+			raise ValueError('%s is not a tick of atlas %s' % (e.args[0], self.name))
+
+	def upper_edges(self):
+		"""
+		(rows, cols) of the strict upper triangle, row-wise, like the xidx, yidx > xidx loops.
+		This is the canonical edge order, edge k connects rows[k] and cols[k]. Do not modify.
+		"""
+		return upper_triangle_indexes(self.count)
+
+	def lower_edges(self):
+		"""
+		(rows, cols) of the strict lower triangle, column-wise, like the colIdx, rowIdx > colIdx loops.
+		Edge k is the same connection as in upper_edges, transposed. Do not modify.
+		"""
+		rows, cols = upper_triangle_indexes(self.count)
+		return cols, rows
+
+	def edge_count(self):
+		"""Number of connections, count*(count-1)/2."""
+		return self.count * (self.count - 1) // 2
+
+	def edges_to_indexes(self, xidxs, yidxs):
+		"""
+		Convert region index pairs to edge indexes in the upper_edges order.
+		Pairs can be in any order, (x, y) and (y, x) give the same edge. Works on arrays.
+		"""
+		xidxs = np.asarray(xidxs)
+		yidxs = np.asarray(yidxs)
+		if np.any(xidxs == yidxs):
+			raise ValueError('A region is not connected to itself')
+		i = np.minimum(xidxs, yidxs)
+		j = np.maximum(xidxs, yidxs)
+		return i * self.count - i * (i + 1) // 2 + (j - i - 1)
+
+	def indexes_to_edges(self, edgeindexes):
+		"""Convert edge indexes to (rows, cols) region indexes."""
+		rows, cols = self.upper_edges()
+		return rows[edgeindexes], cols[edgeindexes]
+
+	def edge_ticks(self):
+		"""The 'L1-L2' labels of all edges in the upper_edges order, built once."""
+		if not hasattr(self, '_edgeticks'):
+			rows, cols = self.upper_edges()
+			self._edgeticks = ['%s-%s' % (self.ticks[x], self.ticks[y]) for x, y in zip(rows, cols)]
+		return self._edgeticks
+
+	def connections_to_edges(self, connections):
+		"""Convert 'L1-L2' connection labels to edge indexes."""
+		xidxs = []
+		yidxs = []
+		for connection in connections:
+			ticks = connection.split('-')
+			xidx, yidx = self.ticks_to_indexes(ticks)
+			xidxs.append(xidx)
+			yidxs.append(yidx)
+		return self.edges_to_indexes(xidxs, yidxs)
 
 	def indexes_to_ticks(self, indexes):
 		"""
@@ -222,12 +459,11 @@ class Atlas:
 		adjustedTicks = []
 		for RSN, nodeList in self.RSNConfig['ticks dict'].items():
 			adjustedTicks += nodeList
+		realposes = self.ticks_to_indexes(adjustedTicks[:self.count])
 		for i in range(self.count):
-			realpos = self.ticks.index(adjustedTicks[i])
-			mat1[i, :] = sqmat[realpos, :]
+			mat1[i, :] = sqmat[realposes[i], :]
 		for i in range(self.count):
-			realpos = self.ticks.index(adjustedTicks[i])
-			mat2[:, i] = mat1[:, realpos]
+			mat2[:, i] = mat1[:, realposes[i]]
 		return mat2
 
 	def adjust_ticks_RSN(self):
@@ -252,9 +488,9 @@ class Atlas:
 		self.check_RSN()
 		vec_adjusted = np.zeros(vec.shape)
 		adjustedTicks, _ = self.adjust_ticks_RSN()
+		realposes = self.ticks_to_indexes(adjustedTicks[:self.count])
 		for i in range(self.count):
-			realpos = self.ticks.index(adjustedTicks[i])
-			vec_adjusted[i] = vec[realpos]
+			vec_adjusted[i] = vec[realposes[i]]
 		return vec_adjusted
 
 	def get_RSN_list(self):
@@ -268,9 +504,9 @@ class Atlas:
 		vec_adjusted = np.zeros(vec.shape)
 		self.set_brainparts('default')
 		adjustedTicks, nodeCount = self.brainparts.get_region_list()
+		realposes = self.ticks_to_indexes(adjustedTicks[:self.count])
 		for i in range(self.count):
-			realpos = self.ticks.index(adjustedTicks[i])
-			vec_adjusted[i] = vec[realpos]
+			vec_adjusted[i] = vec[realposes[i]]
 		return vec_adjusted
 
 brodmann_lr = Atlas(loadsave.load_json(os.path.join(rootconfig.path.atlas, 'brodmann_lr.json')))
@@ -345,28 +581,20 @@ def color_atlas_region(atlasobj, regions, colors, outfilepath, resolution = '1mm
 		print('You must specify colors for each regions to label, or specify a single color')
 		raise Exception('Number of colors and regions not match')
 	atlasImg = loadsave.load_nii(atlasobj.get_volume(resolution)['niifile'])
-	atlasData = atlasImg.get_data()
-	newAtlasData = atlasData.copy()
+	voxelindex = atlasobj.get_voxel_index(resolution)
+	regionColors = np.zeros(atlasobj.count)
 	if type(regions) is list and type(colors) is list:
 		# each color for each region
-		newAtlasData = np.zeros(newAtlasData.shape)
-		for region, color in zip(regions, colors):
-			regionMask = atlasData.copy()
-			regionMask[regionMask != atlasobj.regions[atlasobj.ticks.index(region)]] = 0
-			regionMask[regionMask == atlasobj.regions[atlasobj.ticks.index(region)]] = color
-			newAtlasData += regionMask
+		np.add.at(regionColors, atlasobj.ticks_to_indexes(regions), colors)
+		newAtlasData = voxelindex.fill_regions(regionColors)
 	elif type(regions) is list and type(colors) is int:
 		# one color for each region
-		newAtlasData = np.zeros(newAtlasData.shape)
-		for region in regions:
-			regionMask = atlasData.copy()
-			regionMask[regionMask != atlasobj.regions[atlasobj.ticks.index(region)]] = 0
-			regionMask[regionMask == atlasobj.regions[atlasobj.ticks.index(region)]] = colors
-			newAtlasData += regionMask
+		np.add.at(regionColors, atlasobj.ticks_to_indexes(regions), colors)
+		newAtlasData = voxelindex.fill_regions(regionColors)
 	elif type(regions) is str and type(colors) is int:
 		# one color for one region
-		newAtlasData[newAtlasData != atlasobj.regions[atlasobj.ticks.index(regions)]] = 0
-		newAtlasData[newAtlasData == atlasobj.regions[atlasobj.ticks.index(regions)]] = colors
+		regionColors[atlasobj.ticks_to_indexes([regions])] = colors
+		newAtlasData = voxelindex.fill_regions(regionColors, dtype = atlasImg.get_data_dtype())
 	else:
 		raise Exception('Unsupported combinations. regions as %s, colors as %s.' % (type(regions), type(colors)))
 	newAtlasImg = nib.Nifti1Image(newAtlasData, atlasImg.affine, atlasImg.header)
@@ -378,21 +606,16 @@ def region_overlap_report(regionName, atlasBase, atlasTarget):
 	area in an atlas (base) correspond to in another atlas (target). 
 	The returned list is sorted according to overlap ratio. Each element is a tuple with the region name, counts and ratio
 	"""
-	regionData = atlasBase.regions[atlasBase.ticks.index(regionName)]
-	atlasBaseImg = loadsave.load_nii(atlasBase.get_volume('1mm')['niifile'])
-	atlasTargetImg = loadsave.load_nii(atlasTarget.get_volume('1mm')['niifile'])
-	atlasBaseData = atlasBaseImg.get_data()
-	atlasTargetData = atlasTargetImg.get_data()
-	maskMatrix = atlasTargetData.copy()
-	maskMatrix[atlasBaseData == regionData] = 1
-	maskMatrix[atlasBaseData != regionData] = 0
-	maskedTargetMatrix = np.multiply(atlasTargetData, maskMatrix)
-	unique, counts = np.unique(maskedTargetMatrix, return_counts = True)
+	baseIndex = atlasBase.get_voxel_index('1mm')
+	targetIndex = atlasTarget.get_voxel_index('1mm')
+	regionVoxels = baseIndex.region_voxels(atlasBase.ticks_to_indexes([regionName])[0])
+	targetRegions = targetIndex.voxel_regions()[regionVoxels]
+	overlapCounts = np.bincount(targetRegions[targetRegions >= 0], minlength = atlasTarget.count)
+	regionCounts = atlasTarget.get_volume('1mm')['regioncounts']
 	resultList = []
-	for areaData, count in zip(unique, counts):
-		if areaData == 0:
-			continue
-		descriptionTuple = (atlasTarget.ticks[atlasTarget.regions.index(areaData)], '%d/%s' % (count, atlasTarget.get_volume('1mm')['regioncounts'][atlasTarget.regions.index(areaData)]), float(count)/int(atlasTarget.get_volume('1mm')['regioncounts'][atlasTarget.regions.index(areaData)]))
+	for idx in sorted(np.flatnonzero(overlapCounts), key = lambda i: atlasTarget.regions[i]):
+		count = overlapCounts[idx]
+		descriptionTuple = (atlasTarget.ticks[idx], '%d/%s' % (count, regionCounts[idx]), float(count)/int(regionCounts[idx]))
 		resultList.append(descriptionTuple)
 	resultList = sorted(resultList, key = lambda x: int(x[1].split('/')[0]), reverse = True)
 	return resultList
@@ -61,12 +61,7 @@ class ScoreCorrelationCalculator:
 		The return value, rvec, pvec, contains Pearson's r and p regarding the correlation
 		"""
 		attrData = self.attr_stacked[:, atlasobj.count*self.attrNames.index(attrName):atlasobj.count*(self.attrNames.index(attrName)+1)]
-		rvec = []
-		pvec = []
-		for colIdx in range(attrData.shape[1]):
-			r, p = stats.pearsonr(attrData[:, colIdx], self.scores_stacked[:, self.scoreLoader.scoreNames.index(scoreName)])
-			rvec.append(r)
-			pvec.append(p)
+		rvec, pvec = mattool.pearsonr(attrData, self.scores_stacked[:, self.scoreLoader.scoreNames.index(scoreName)])
 		return rvec, pvec
 
 	def calculateFCScoreCorrelation(self, connections, atlasobj, titlePrefix):
@@ -76,9 +71,7 @@ class ScoreCorrelationCalculator:
 		for scoreName in self.scoreLoader.scoreNames:
 			rmat, pmat = self.calculateCorrelationNet(atlasobj, scoreName)
 			for connection in connections:
-				ticks = connection.split('-')
-				xidx = atlasobj.ticks.index(ticks[0])
-				yidx = atlasobj.ticks.index(ticks[1])
+				xidx, yidx = atlasobj.ticks_to_indexes(connection.split('-'))
 				if pmat[xidx, yidx] > 0.05:
 					continue
 				idx = xidx * atlasobj.count + yidx
@@ -100,8 +93,7 @@ class ScoreCorrelationCalculator:
 		for scoreName in scoreNames:
 			for attrName in self.attrNames:
 				rvec, pvec = self.calculateCorrelationAttr(atlasobj, attrName, scoreName)
-				for region in regions:
-					idx = atlasobj.ticks.index(region)
+				for region, idx in zip(regions, atlasobj.ticks_to_indexes(regions)):
 					if pvec[idx] > 0.05:
 						continue
 					xvec = self.attr_stacked[:, atlasobj.count*self.attrNames.index(attrName)+idx]
@@ -0,0 +1,312 @@
+"""Distributed execution of parabase tasks on several machines.
+
+A coordinator listens on a TCP port (multiprocessing.connection, with an
+authkey), workers on the nodes connect to it and run tasks one at a time.
+The function and args are pickled, so the nodes need the same mmdps and
+the folders on a shared file system, with the same paths.
+
+Workers send a heartbeat while a task runs. If a worker is lost (no message
+within timeout, or the connection breaks), its task is given to another
+worker, up to retries times. The result and the printed output of every task
+are sent back, the output is written to a log file of the coordinator.
+
+Hosts are given as host:processes, separated by commas, like node1:8,node2:8.
+Workers are started on the hosts with ssh, the host local starts them on this
+machine without ssh, as a stand-in for testing.
+
+parabase.run uses this backend with executor='distributed', or env
+MMDPS_EXECUTOR=distributed, on the hosts of env MMDPS_HOSTS, so does Para.
+"""
+
+import os
+import io
+import sys
+import time
+import queue
+import shlex
+import socket
+import threading
+import traceback
+import subprocess
+import contextlib
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+
+from mmdps.util import clock
+from mmdps.proc import parabase
+from mmdps import rootconfig
+
+def parse_hosts(hosts):
+	"""[(host, processes)] of a host:processes,... string, processes is 1 if not given."""
+	ret = []
+	for item in hosts.split(','):
+		item = item.strip()
+		if not item:
+			continue
+		if ':' in item:
+			host, processes = item.rsplit(':', 1)
+			ret.append((host, int(processes)))
+		else:
+			ret.append((item, 1))
+	return ret
+
+def run_task(f, arg):
+	"""Run f(arg), return the result, the exception text or None, and the printed output."""
+	output = io.StringIO()
+	error = None
+	res = None
+	with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+		try:
+			res = f(arg)
+		except Exception:
+			error = traceback.format_exc()
+	return res, error, output.getvalue()
+
+def worker_loop(address, authkey):
+	"""Connect to the coordinator and run its tasks until told to stop."""
+	for attempt in range(10):
+		try:
+			conn = Client(address, authkey = authkey)
+			break
+		except ConnectionRefusedError:
+			time.sleep(1)
+	else:
+		raise Exception('Cannot connect to coordinator %s' % (address,))
+	send_lock = threading.Lock()
+	def send(msg):
+		with send_lock:
+			conn.send(msg)
+	heartbeat = conn.recv()[1]
+	send(('ready', socket.gethostname(), os.getpid()))
+	while True:
+		try:
+			msg = conn.recv()
+		except EOFError:
+			break
+		if msg[0] == 'stop':
+			break
+		i, f, arg = msg[1:]
+		running = threading.Event()
+		running.set()
+		def beat():
+			while running.is_set():
+				time.sleep(heartbeat)
+				if running.is_set():
+					send(('heartbeat', i))
+		beater = threading.Thread(target = beat, daemon = True)
+		beater.start()
+		start_time = time.time()
+		res, error, output = run_task(f, arg)
+		running.clear()
+		send(('result', i, res, error, output, time.time() - start_time))
+	conn.close()
+
+def serve(address, authkey, processes = 1):
+	"""Run processes workers on this machine, return when they stop."""
+	workers = [multiprocessing.Process(target = worker_loop, args = (address, authkey)) for i in range(processes)]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+
+class Coordinator:
+	"""
+	Dispatch tasks to the connected workers.
+
+	heartbeat is the seconds between worker heartbeats, a worker silent for
+	timeout seconds is lost. A task is tried at most 1 + retries times on lost
+	workers. Exceptions raised by tasks are not retried.
+	"""
+	def __init__(self, port = 0, authkey = None, heartbeat = 10, timeout = 60, retries = 2):
+		self.authkey = authkey or os.urandom(16)
+		self.listener = Listener(('', port), authkey = self.authkey)
+		self.host = os.getenv('MMDPS_COORDINATOR_HOST') or socket.getfqdn()
+		self.port = self.listener.address[1]
+		self.heartbeat = heartbeat
+		self.timeout = timeout
+		self.retries = retries
+		self.launched = []
+		self.closed = False
+		self.lock = threading.Lock()
+		self.tasks = queue.Queue()
+		self.workers = 0
+		threading.Thread(target = self.accept, daemon = True).start()
+
+	@property
+	def address(self):
+		"""The address workers connect to."""
+		return (self.host, self.port)
+
+	def launch_local(self, processes = 1):
+		"""Start workers on this machine, without ssh."""
+		process = multiprocessing.Process(target = serve, args = (('localhost', self.port), self.authkey, processes))
+		process.start()
+		self.launched.append(process)
+
+	def launch_ssh(self, host, processes = 1):
+		"""Start workers on host with ssh, the authkey is given on stdin, not on the command line."""
+		python = os.getenv('MMDPS_REMOTE_PYTHON', rootconfig.path.python)
+		runworker = os.path.join(rootconfig.path.tools, 'job_runner', 'runworker.py')
+		remotecmd = ' '.join(shlex.quote(s) for s in [python, runworker, '--connect', '%s:%d' % self.address, '--processes', str(processes)])
+		process = subprocess.Popen(['ssh', '-o', 'BatchMode=yes', host, remotecmd], stdin = subprocess.PIPE)
+		process.stdin.write(self.authkey.hex().encode('ascii') + b'\n')
+		process.stdin.close()
+		self.launched.append(process)
+
+	def launch(self, hosts):
+		"""Start workers on hosts, see parse_hosts."""
+		if type(hosts) is str:
+			hosts = parse_hosts(hosts)
+		for host, processes in hosts:
+			if host == 'local':
+				self.launch_local(processes)
+			else:
+				self.launch_ssh(host, processes)
+
+	def accept(self):
+		while not self.closed:
+			try:
+				conn = self.listener.accept()
+			except (OSError, EOFError, multiprocessing.AuthenticationError):
+				# closed, or a connection with a wrong authkey
+				continue
+			threading.Thread(target = self.serve_worker, args = (conn,), daemon = True).start()
+
+	def serve_worker(self, conn):
+		"""Give tasks to one worker until closed, requeue its task if it is lost."""
+		try:
+			conn.send(('hello', self.heartbeat))
+			hello = conn.recv()
+		except (OSError, EOFError):
+			return
+		name = '%s:%s' % hello[1:]
+		with self.lock:
+			self.workers += 1
+		print('Worker connected:', name)
+		task = None
+		try:
+			while not self.closed:
+				try:
+					task = self.tasks.get(timeout = 1)
+				except queue.Empty:
+					continue
+				i, f, arg, attempt = task
+				conn.send(('task', i, f, arg))
+				while True:
+					if not conn.poll(self.timeout):
+						raise EOFError('no heartbeat')
+					msg = conn.recv()
+					if msg[0] == 'result':
+						break
+				self.results.put((i, name) + tuple(msg[2:]))
+				task = None
+			conn.send(('stop',))
+		except (OSError, EOFError) as e:
+			print('Worker lost: %s, %r' % (name, e))
+			if task is not None:
+				self.retry(task, name)
+		finally:
+			with self.lock:
+				self.workers -= 1
+			conn.close()
+
+	def retry(self, task, name):
+		i, f, arg, attempt = task
+		if attempt < self.retries:
+			self.tasks.put((i, f, arg, attempt + 1))
+		else:
+			self.results.put((i, name, None, 'worker lost %d times' % (attempt + 1), '', 0))
+
+	def run(self, f, argvec, costs = None, quarantine_file = None):
+		"""
+		Run f(arg) for all args on the workers, the most costly first if costs
+		are given. Return the results in the order of argvec. Raise if a task
+		raised an exception, after all tasks finished. The args of failed tasks
+		are written to a quarantine list in the order of argvec, see parabase.write_quarantine.
+		"""
+		argvec = list(argvec)
+		ntotal = len(argvec)
+		order = list(range(ntotal))
+		if costs is not None:
+			order.sort(key = lambda i: -costs[i])
+		self.results = queue.Queue()
+		for i in order:
+			self.tasks.put((i, f, argvec[i], 0))
+		outputs = [None] * ntotal
+		errorList = []
+		failed = []
+		nexceptions = 0
+		from mmdps.proc import job
+		logfile = job.genlogfilename('distributed')
+		print('Begin distributed proc, {} tasks, coordinator {}:{}, log {}, start at {}'.format(ntotal, self.host, self.port, logfile, clock.now()))
+		with open(logfile, 'w') as log:
+			for nfinished in range(1, ntotal + 1):
+				while True:
+					try:
+						i, name, res, error, output, elapsed_time = self.results.get(timeout = 10)
+						break
+					except queue.Empty:
+						if self.workers == 0 and not any(self.is_alive(process) for process in self.launched):
+							raise Exception('All workers are gone, %d tasks not finished' % (ntotal - nfinished + 1))
+				outputs[i] = res
+				log.write('==== arg: %s, worker: %s, res: %s, %1.2f s\n' % (argvec[i], name, res, elapsed_time))
+				log.write(output)
+				if error:
+					log.write(error)
+				log.flush()
+				msg = 'arg: %s, res: %s' % (argvec[i], res)
+				if error:
+					nexceptions += 1
+				if error or (isinstance(res, int) and res != 0):
+					failed.append((i, argvec[i]))
+					errorList.append(msg if not error else 'arg: %s, error: %s' % (argvec[i], error.strip().splitlines()[-1]))
+					print('{} just finished with error on {}. {} left, at {}'.format(errorList[-1], name, ntotal - nfinished, clock.now()))
+				else:
+					print('{} just finished on {} after {:1.2f} s execution. {} left, at {}'.format(msg, name, elapsed_time, ntotal - nfinished, clock.now()))
+		print('End distributed proc, end at {}. {} error.'.format(clock.now(), len(errorList)))
+		if errorList:
+			print('Listing errs')
+			for err in errorList:
+				print(err)
+			parabase.write_quarantine([arg for i, arg in sorted(failed, key = lambda item: item[0])], quarantine_file)
+		if nexceptions:
+			raise Exception('%d tasks raised exceptions or lost their workers, see %s' % (nexceptions, logfile))
+		return outputs
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def is_alive(self, process):
+		if isinstance(process, subprocess.Popen):
+			return process.poll() is None
+		return process.is_alive()
+
+	def close(self):
+		"""Stop the workers and the listener."""
+		self.closed = True
+		self.listener.close()
+		for process in self.launched:
+			if isinstance(process, subprocess.Popen):
+				try:
+					process.wait(timeout = 10)
+				except subprocess.TimeoutExpired:
+					process.terminate()
+			else:
+				process.join(10)
+				if process.is_alive():
+					process.terminate()
+
+def run(f, argvec, hosts = None, costs = None, quarantine_file = None):
+	"""
+	Run f(arg) for all args on workers of hosts, env MMDPS_HOSTS by default.
+	Return the results in the order of argvec.
+	"""
+	hosts = hosts or os.getenv('MMDPS_HOSTS')
+	if not hosts:
+		raise Exception('No hosts to run on, set MMDPS_HOSTS like node1:8,node2:8')
+	with Coordinator() as coordinator:
+		coordinator.launch(hosts)
+		return coordinator.run(f, argvec, costs, quarantine_file)
@@ -3,13 +3,26 @@
 One job is a processing unit. It can run python script, matlab, 
 executable, shell. It can run other jobs, forming a tree.
 It can also run parallel, forming a project.
+
+Jobs run in a folder given to run, without changing the current directory of
+the process, so the children of a BatchJob can run in threads.
+
+A job declaring outputs is skipped by runjob if it is up to date in the folder:
+its outputs exist, and the job config, command and inputs did not change since
+it last succeeded there. This is recorded in .mmdps_jobs.json in the folder.
 """
 
 import os
 import sys
-import warnings
+import json
+import time
+import signal
+import hashlib
 import subprocess
 import shlex
+import argparse
+import threading
+import concurrent.futures
 from collections import OrderedDict
 
 # from ..util import clock, path
@@ -18,41 +31,133 @@ from mmdps.util import clock, path
 from mmdps.util.loadsave import load_json_ordered, load_json
 from mmdps import rootconfig
 
-def genlogfilename(info=''):
-	"""Generate a log file name base on current time and supplied info."""
-	path.makedirs('log')
+def genlogfilename(info='', folder=None):
+	"""Generate a log file name base on current time and supplied info.
+
+	The log folder is in folder, the current directory if None.
+	"""
+	logfolder = os.path.join(folder, 'log') if folder else 'log'
+	path.makedirs(logfolder)
 	timestr = clock.now()
-	return 'log/log_{}_{}.txt'.format(timestr, info)
+	return os.path.join(logfolder, 'log_{}_{}.txt'.format(timestr, info))
 
-def call_logged(cmdlist, info='',isShell=False):
-	"""Call the cmdlist and output the log to a file in log folder."""
-	logfilePath = genlogfilename(info)
-	print('Call_logged %s at %s' % (cmdlist, os.path.join(os.getcwd(), logfilePath)))
+def kill_tree(p):
+	"""Kill the process p and all its children."""
+	if sys.platform == 'win32':
+		subprocess.call(['taskkill', '/F', '/T', '/PID', str(p.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	else:
+		# p leads its own process group, see call_logged. After a grace period
+		# the group is killed, children ignoring SIGTERM included.
+		try:
+			os.killpg(p.pid, signal.SIGTERM)
+		except ProcessLookupError:
+			pass
+		try:
+			p.wait(timeout = 10)
+		except subprocess.TimeoutExpired:
+			pass
+		try:
+			os.killpg(p.pid, signal.SIGKILL)
+		except ProcessLookupError:
+			pass
+	p.wait()
+
+def call_logged(cmdlist, info='',isShell=False, cwd=None, timeout=None):
+	"""Call the cmdlist in cwd and output the log to a file in log folder of cwd.
+
+	If it runs longer than timeout seconds, it is killed with all its children.
+	"""
+	logfilePath = genlogfilename(info, cwd)
+	print('Call_logged %s at %s' % (cmdlist, os.path.abspath(logfilePath)))
+	# a new process group, so that the whole tree can be killed
+	if sys.platform == 'win32':
+		kwargs = dict(creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+	else:
+		kwargs = dict(start_new_session=True)
+	deadline = time.time() + timeout if timeout else None
 	with open(logfilePath, 'w') as f:
 		f.write('Command: \n')
 		f.write(str(cmdlist)+'\n\n')
 		f.flush()
 		if isShell:
-			p = subprocess.Popen(cmdlist, stdout=f, stderr=f, shell=True, executable="/bin/bash")
+			p = subprocess.Popen(cmdlist, stdout=f, stderr=f, shell=True, executable="/bin/bash", cwd=cwd, **kwargs)
 		else:
-			p = subprocess.Popen(cmdlist, stdout=f, stderr=f)
-		while True:
-			try:
-				p.communicate(timeout = 5) # will block until process returned
-				break
-			except subprocess.TimeoutExpired:
-				# print('communicate failed... try again')
-				continue
+			p = subprocess.Popen(cmdlist, stdout=f, stderr=f, cwd=cwd, **kwargs)
+		try:
+			while True:
+				try:
+					# will block until process returned, checking the deadline
+					p.communicate(timeout = 5 if deadline is None else max(min(5, deadline - time.time()), 0))
+					break
+				except subprocess.TimeoutExpired:
+					if deadline is not None and time.time() >= deadline:
+						kill_tree(p)
+						f.write('\nKilled after timeout of {} s\n'.format(timeout))
+						print('Killed "{}" after timeout of {} s'.format(str(cmdlist), timeout))
+						break
+		except KeyboardInterrupt:
+			kill_tree(p)
+			raise
 	retcode = p.returncode
 	if retcode != 0:
-		warnings.warn('Error run "{}", return code is {}'.format(str(cmdlist), retcode))
+		print('Error run "{}", return code is {}, log at {}'.format(str(cmdlist), retcode, os.path.abspath(logfilePath)))
 	return p.returncode
 
-def call_in_wd(cmdlist, wd, info='', isShell=False):
+def call_in_wd(cmdlist, wd, info='', isShell=False, timeout=None):
 	"""Call in supplied working directory."""
-	with ChangeDirectory(wd):
-		retcode = call_logged(cmdlist, info, isShell=isShell)
-	return retcode
+	return call_logged(cmdlist, info, isShell=isShell, cwd=wd, timeout=timeout)
+
+def runjob_parser():
+	"""The argument parser of tools/job_runner/runjob.py, also used for the argv of a configfile BatchJob."""
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--config', help='job config json file', required=True)
+	parser.add_argument('--folder', help='job run in this folder', default=None)
+	parser.add_argument('--force', help='run even if the job is up to date', action='store_true')
+	return parser
+
+def jobfolder(folder=None):
+	"""The absolute folder to run a job in, the current directory if None."""
+	return os.path.abspath(folder) if folder else os.getcwd()
+
+JOB_MANIFEST = '.mmdps_jobs.json'
+manifest_lock = threading.Lock()
+
+def file_fingerprint(file):
+	"""
+	mtime and size of the file, or its sha1 if env MMDPS_JOB_HASH_INPUTS=1.
+	None if the file does not exist.
+	"""
+	if not os.path.isfile(file):
+		return None
+	if os.getenv('MMDPS_JOB_HASH_INPUTS', '0') == '1':
+		sha1 = hashlib.sha1()
+		with open(file, 'rb') as f:
+			for block in iter(lambda: f.read(1 << 20), b''):
+				sha1.update(block)
+		return sha1.hexdigest()
+	st = os.stat(file)
+	return [st.st_mtime_ns, st.st_size]
+
+def load_job_manifest(folder):
+	"""The job name -> signature dict of the jobs succeeded in folder."""
+	manifestfile = os.path.join(folder, JOB_MANIFEST)
+	if not os.path.isfile(manifestfile):
+		return {}
+	try:
+		with open(manifestfile) as f:
+			return json.load(f)
+	except ValueError:
+		return {}
+
+def record_job_manifest(folder, name, signature):
+	"""Record the signature of a job succeeded in folder."""
+	with manifest_lock:
+		manifest = load_job_manifest(folder)
+		manifest[name] = signature
+		manifestfile = os.path.join(folder, JOB_MANIFEST)
+		with open(manifestfile + '.tmp', 'w') as f:
+			json.dump(manifest, f, indent = 4)
+		os.replace(manifestfile + '.tmp', manifestfile)
 
 class ChangeDirectory:
 	"""Change dir context manager.
@@ -79,6 +184,10 @@ class Job:
 
 		The config will become --config CONFIG in argv.
 		wd is the working directory in which the job would be run.
+		depends, inputs and outputs are used by the BatchJob scheduler.
+		timeout is the seconds the job may run (env MMDPS_JOB_TIMEOUT by default),
+		a failed job is tried again retries times, waiting retry_delay seconds
+		the first time and twice as long every next time.
 		"""
 		self.name = name
 		self.typename = type(self).__name__
@@ -89,6 +198,12 @@ class Job:
 			self.argv = ' '.join([shlex.quote(s) for s in self.argv])
 			print(self.argv)
 		self.wd = wd
+		self.depends = None
+		self.inputs = []
+		self.outputs = []
+		self.timeout = None
+		self.retries = 0
+		self.retry_delay = 10
 
 	@classmethod
 	def from_dict(cls, configDict):
@@ -99,6 +214,12 @@ class Job:
 		argv = configDict.get('argv', '')
 		wd = configDict.get('wd', '.')
 		jobobj = cls(name, cmd, config, argv, wd)
+		jobobj.depends = configDict.get('depends', None)
+		jobobj.inputs = configDict.get('inputs', [])
+		jobobj.outputs = configDict.get('outputs', [])
+		jobobj.timeout = configDict.get('timeout', None)
+		jobobj.retries = configDict.get('retries', 0)
+		jobobj.retry_delay = configDict.get('retry_delay', 10)
 		return jobobj
 
 	def to_dict(self):
@@ -110,63 +231,127 @@ class Job:
 		d['config'] = self.config
 		d['argv'] = self.argv
 		d['wd'] = self.wd
+		if self.depends is not None:
+			d['depends'] = self.depends
+		if self.inputs:
+			d['inputs'] = self.inputs
+		if self.outputs:
+			d['outputs'] = self.outputs
+		if self.timeout:
+			d['timeout'] = self.timeout
+		if self.retries:
+			d['retries'] = self.retries
+			d['retry_delay'] = self.retry_delay
 		return d
 
-	def build_fullcmd(self):
+	def build_fullcmd(self, folder='.'):
 		"""Build full command.
 
 		If the cmd is not absolute path, search in path for this cmd.
 		It is similar to matlabpath, so you do not need to specify the
 		full cmd path. Just make sure to avoid name clash.
 		"""
-		cmd = path.fullfile(self.cmd)
+		cmd = path.fullfile(self.cmd, folder)
 		if cmd:
 			return cmd
 		else:
 			return self.cmd
 
-	def build_fullconfig(self):
+	def build_fullconfig(self, folder='.'):
 		"""Build full config.
 
 		Search the config file using path.fullfile.
 		"""
-		config = path.fullfile(self.config)
+		config = path.fullfile(self.config, folder)
 		if config:
 			return config
 		else:
 			return self.config
 
-	def build_rootcmd(self):
+	def build_rootcmd(self, folder='.'):
 		"""Build the root command."""
-		rootcmd = [self.build_fullcmd()]
+		rootcmd = [self.build_fullcmd(folder)]
 		return rootcmd
 
-	def build_cmdlist(self):
+	def build_cmdlist(self, folder='.'):
 		"""Build the command list, including rootcmd and argv."""
-		cmdlist = self.build_rootcmd()
+		cmdlist = self.build_rootcmd(folder)
 		# Split the string using shell-like syntax
 		# given 'mkdir -p abc', return ['mkdir', '-p', 'abc']
 		cmdlist.extend(shlex.split(self.argv))
 		if self.config:
-			cmdlist.extend(['--config', self.build_fullconfig()])
+			cmdlist.extend(['--config', self.build_fullconfig(folder)])
 		return cmdlist
 
-	def run(self):
-		"""Build cmd list and run the job in wd."""
-		cmdlist = self.build_cmdlist()
-		retcode = call_in_wd(cmdlist, self.wd, self.name)
+	def get_timeout(self):
+		return self.timeout or float(os.getenv('MMDPS_JOB_TIMEOUT', 0)) or None
+
+	def call(self, cmdlist, wd, isShell=False):
+		"""Call the cmdlist in wd, with the timeout and retries of the job."""
+		timeout = self.get_timeout()
+		return self.retry(lambda: call_in_wd(cmdlist, wd, self.name, isShell=isShell, timeout=timeout))
+
+	def retry(self, f):
+		"""Call f until it returns 0, at most 1 + retries times."""
+		delay = self.retry_delay
+		for attempt in range(self.retries + 1):
+			retcode = f()
+			if retcode == 0 or attempt == self.retries:
+				return retcode
+			print('Retry %s in %s s, return code %s, %d retries left' % (self.name, delay, retcode, self.retries - attempt))
+			time.sleep(delay)
+			delay *= 2
+
+	def run(self, folder=None):
+		"""Build cmd list and run the job in wd, relative to folder."""
+		folder = jobfolder(folder)
+		cmdlist = self.build_cmdlist(folder)
+		retcode = self.call(cmdlist, os.path.join(folder, self.wd))
 		return retcode
 
+	def signature(self, folder):
+		"""
+		The hash of the job config, the command, and the inputs, the cmd file and
+		the config file. Inputs and outputs are relative to folder.
+		"""
+		cmdlist = self.build_rootcmd(folder) + shlex.split(self.argv)
+		files = [os.path.join(folder, file) for file in self.inputs]
+		files.append(self.build_fullcmd(folder))
+		if type(self.config) is str and self.config:
+			files.append(self.build_fullconfig(folder))
+		d = dict(job = self.to_dict(), cmd = cmdlist, files = [(file, file_fingerprint(file)) for file in files])
+		return hashlib.sha1(json.dumps(d, sort_keys = True).encode('utf-8')).hexdigest()
+
+	def is_up_to_date(self, folder=None):
+		"""Whether the declared outputs exist and nothing changed since the job last succeeded in folder."""
+		if not self.outputs:
+			return False
+		folder = jobfolder(folder)
+		for file in self.inputs:
+			if not os.path.exists(os.path.join(folder, file)):
+				return False
+		for file in self.outputs:
+			if not os.path.exists(os.path.join(folder, file)):
+				return False
+		return load_job_manifest(folder).get(self.name) == self.signature(folder)
+
+	def record_done(self, folder=None):
+		"""Record that the job succeeded in folder, if it declares outputs."""
+		if self.outputs:
+			folder = jobfolder(folder)
+			record_job_manifest(folder, self.name, self.signature(folder))
+
 class ShellJob(Job):
 	"""Shell job."""
 	def __init__(self, name, cmd, config='', argv=None, wd='.'):
 		"""Init the shell job."""
 		super().__init__(name, cmd, config, argv, wd)
 
-	def run(self):
-		"""Build cmd list and run the job in wd."""
-		cmdlist = self.build_cmdlist()
-		retcode = call_in_wd(cmdlist, self.wd, self.name, isShell=True)
+	def run(self, folder=None):
+		"""Build cmd list and run the job in wd, relative to folder."""
+		folder = jobfolder(folder)
+		cmdlist = self.build_cmdlist(folder)
+		retcode = self.call(cmdlist, os.path.join(folder, self.wd), isShell=True)
 		return retcode
 
 class PythonJob(Job):
@@ -180,9 +365,9 @@ class PythonJob(Job):
 		"""Init the python job."""
 		super().__init__(name, cmd, config, argv, wd)
 
-	def build_rootcmd(self):
+	def build_rootcmd(self, folder='.'):
 		"""Override the root cmd to python executable."""
-		rootcmd = [rootconfig.path.python, self.build_fullcmd()]
+		rootcmd = [rootconfig.path.python, self.build_fullcmd(folder)]
 		return rootcmd
 
 class MatlabJob(Job):
@@ -193,38 +378,49 @@ class MatlabJob(Job):
 		The path.searchpathlist will be added to the matlab path by addpath function
 		before the matlab command run. If not configured right, the matlab job cannot
 		find the matlab function.
+		With env MMDPS_MATLAB_MODE=pool, the command runs in a warm MATLAB
+		session, see matlab_pool.
 		"""
 		super().__init__(name, cmd, config, argv, wd)
 
-	def build_matlab_wd(self):
+	def run(self, folder=None):
+		"""Run the matlab cmd in a new MATLAB, or in a session of the pool."""
+		from mmdps.proc import matlab_pool
+		if matlab_pool.mode() != 'pool' or not matlab_pool.pool_available():
+			return super().run(folder)
+		folder = jobfolder(folder)
+		wd = self.build_matlab_wd(folder)
+		timeout = self.get_timeout()
+		return self.retry(lambda: matlab_pool.get_pool().run(self.cmd, wd, self.build_matlab_logfile(folder), timeout))
+
+	def build_matlab_wd(self, folder='.'):
 		"""Build wd, for matlab to cd into."""
-		cwd = os.getcwd()
-		wd = os.path.join(cwd, self.wd)
+		wd = os.path.join(os.path.abspath(folder), self.wd)
 		return wd
 
-	def build_matlab_logfile(self):
+	def build_matlab_logfile(self, folder='.'):
 		"""Build matlab log file."""
-		return genlogfilename('matlab_log')
+		return os.path.abspath(genlogfilename('matlab_log', os.path.join(folder, self.wd)))
 
-	def matlab_path_to_add(self):
+	def matlab_path_to_add(self, folder='.'):
 		"""Build the addpath command to add all paths in path.searchpathlist."""
-		pathlist = path.searchpathlist()
+		pathlist = path.searchpathlist(folder)
 		pathstrlist = ["'{}'".format(p) for p in pathlist]
 		pathmatstr = ','.join(pathstrlist)
 		finalstr = 'addpath(' + pathmatstr + ');'
 		return finalstr
 
-	def build_cmdlist(self):
+	def build_cmdlist(self, folder='.'):
 		"""Build the full command line to run the matlab cmd."""
 		cmdlist = []
 		cmdlist.append(rootconfig.matlab_bin)
 		cmdlist.extend(['-wait', '-nosplash', '-minimize', '-nodesktop', '-logfile',
-						self.build_matlab_logfile(), '-r'])
+						self.build_matlab_logfile(folder), '-r'])
 		realcmd = []
 		#realcmd.append('"')
-		realcmd.append(self.matlab_path_to_add())
+		realcmd.append(self.matlab_path_to_add(folder))
 		realcmd.append("try, ")
-		realcmd.append("cd('{0}');".format(self.build_matlab_wd()))
+		realcmd.append("cd('{0}');".format(self.build_matlab_wd(folder)))
 		realcmd.append(self.cmd)
 		realcmd.append(" ; catch me, fprintf('%s / %s', me.identifier, me.message), exit(-1), end, exit;")
 		#realcmd.append('"')
@@ -238,8 +434,17 @@ class ExecutableJob(Job):
 		super().__init__(name, cmd, config, argv, wd)
 
 class BatchJob(Job):
-	"""Batch job, this is a list of sequentially run jobs."""
-	def __init__(self, name, cmd, config='', argv=None, wd='.'):
+	"""Batch job, this is a list of children jobs.
+
+	A child may declare 'depends', the names of jobs before it in the list,
+	and 'inputs' and 'outputs', files relative to the folder. A child runs after
+	the jobs it depends on and the jobs whose outputs are its inputs. A child
+	declaring neither depends nor inputs runs after the job before it, so a
+	plain list runs one by one. Independent children run concurrently in a
+	pool of 'workers' threads (env MMDPS_JOB_WORKERS). The default is 1, one by
+	one, since a batch job usually runs in every process of a parabase pool.
+	"""
+	def __init__(self, name, cmd, config='', argv=None, wd='.', workers=None):
 		"""Init the batch job.
 
 		If config is str, this is a configfile. If config is list, this list
@@ -252,35 +457,160 @@ class BatchJob(Job):
 			self.configtype = 'joblist'
 		else:
 			raise Exception('Config should be a json file or python list')
+		self.workers = workers
+		# passed to runjob for the children jobs
+		self.force = False
 
-	def run_configfile(self):
-		"""Run config file, use runjob.py."""
-		runBatchPath = os.path.join(rootconfig.path.tools, 'job_runner', 'runjob.py')
-		cmdlist = [sys.executable, runBatchPath]
-		cmdlist.extend(shlex.split(self.argv))
-		if self.config:
-			cmdlist.extend(['--config', self.build_fullconfig()])
-		retcode = call_in_wd(cmdlist, self.wd, self.name)
-		return retcode
+	@classmethod
+	def from_dict(cls, configDict):
+		"""Create the batch job from dict."""
+		jobobj = super().from_dict(configDict)
+		jobobj.workers = configDict.get('workers', None)
+		return jobobj
 
-	def run_joblist(self):
-		"""Run job list, one by one."""
-		jobs = []
-		for jobconfig in self.config:
-			currentJob = create_from_dict(jobconfig)
-			jobs.append(currentJob)
-		for currentJob in jobs:
-			retcode = currentJob.run()
-			if retcode != 0:
-				return retcode
-		return 0
+	def to_dict(self):
+		"""Serialize the job to dict."""
+		d = super().to_dict()
+		if self.workers is not None:
+			d['workers'] = self.workers
+		return d
+
+	def get_workers(self):
+		"""The number of threads to run children jobs, 1 unless workers or env MMDPS_JOB_WORKERS is set."""
+		if self.workers:
+			return self.workers
+		return int(os.getenv('MMDPS_JOB_WORKERS', 1))
 
-	def run(self):
+	def configfile_args(self, folder=None):
+		"""
+		Parse argv and the config file like runjob.py does, see runjob_parser.
+		Raise an exception on arguments runjob.py does not take.
+		"""
+		argv = shlex.split(self.argv)
+		if self.config:
+			argv.extend(['--config', self.build_fullconfig(jobfolder(folder))])
+		args, unknown = runjob_parser().parse_known_args(argv)
+		if unknown:
+			raise Exception('Job %s: unknown arguments %s for a config file' % (self.name, ' '.join(unknown)))
+		return args
+
+	def configfile_job(self, folder=None):
+		"""
+		The job of the config file, the folder to run it in and force, like
+		runjob.py run in wd with argv.
+		"""
+		args = self.configfile_args(folder)
+		wd = os.path.join(jobfolder(folder), self.wd)
+		if args.folder:
+			wd = os.path.join(wd, args.folder)
+		configfile = path.fullfile(args.config, os.path.join(jobfolder(folder), self.wd)) or args.config
+		return create_from_dict(load_json_ordered(configfile)), wd, args.force or self.force
+
+	def run_configfile(self, folder=None):
+		"""Run config file in this process."""
+		currentJob, wd, force = self.configfile_job(folder)
+		print('Runjob File:', self.configfile_args(folder).config)
+		return runjob(currentJob, wd, force)
+
+	def joblist_jobs(self):
+		return [create_from_dict(jobconfig) for jobconfig in self.config]
+
+	def run_joblist(self, folder=None):
+		"""Run job list, concurrently where the dependencies allow."""
+		folder = os.path.join(jobfolder(folder), self.wd)
+		jobs = self.joblist_jobs()
+		deps = job_dependencies(jobs)
+		workers = self.get_workers()
+		if workers <= 1 or all(dep == {i - 1} for i, dep in enumerate(deps) if i > 0):
+			# nothing to run concurrently
+			for currentJob in jobs:
+				retcode = runjob(currentJob, folder, self.force)
+				if retcode != 0:
+					return retcode
+			return 0
+		return run_dag(jobs, deps, workers, folder, self.force)
+
+	def run(self, folder=None):
 		"""Run the job. configfile or joblist."""
 		if self.configtype == 'configfile':
-			return self.run_configfile()
+			return self.run_configfile(folder)
 		else:
-			return self.run_joblist()
+			return self.run_joblist(folder)
+
+	def is_up_to_date(self, folder=None):
+		"""Up to date by its own outputs if declared, else if all children jobs are."""
+		if self.outputs:
+			return super().is_up_to_date(folder)
+		if self.configtype == 'configfile':
+			currentJob, wd, force = self.configfile_job(folder)
+			return not force and currentJob.is_up_to_date(wd)
+		jobs = self.joblist_jobs()
+		folder = os.path.join(jobfolder(folder), self.wd)
+		return len(jobs) > 0 and all(currentJob.is_up_to_date(folder) for currentJob in jobs)
+
+def job_dependencies(jobs):
+	"""
+	The set of indices of the jobs each job depends on, see BatchJob.
+	Jobs only depend on jobs before them in the list.
+	"""
+	names = {}
+	producers = {}
+	deps = []
+	for i, currentJob in enumerate(jobs):
+		dep = set()
+		if currentJob.depends is None and not currentJob.inputs:
+			if i > 0:
+				dep.add(i - 1)
+		for name in currentJob.depends or []:
+			if name not in names:
+				raise Exception('Job %s depends on %s, which is not before it' % (currentJob.name, name))
+			dep.update(names[name])
+		for file in currentJob.inputs:
+			dep.update(producers.get(os.path.normpath(file), []))
+		deps.append(dep)
+		names.setdefault(currentJob.name, []).append(i)
+		for file in currentJob.outputs:
+			producers.setdefault(os.path.normpath(file), []).append(i)
+	return deps
+
+def run_dag(jobs, deps, workers, folder, force=False):
+	"""
+	Run the jobs in folder with a pool of workers threads, each job after the
+	jobs it depends on. The jobs depending on a failed job are not run.
+	Return 0, or the return code of the first failed job.
+	"""
+	remaining = [set(dep) for dep in deps]
+	dependents = [[] for currentJob in jobs]
+	for i, dep in enumerate(deps):
+		for k in dep:
+			dependents[k].append(i)
+	retcode = 0
+	started = set()
+	with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+		running = {}
+		def submit(i):
+			started.add(i)
+			running[pool.submit(runjob, jobs[i], folder, force)] = i
+		for i in range(len(jobs)):
+			if not remaining[i]:
+				submit(i)
+		while running:
+			done, pending = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				i = running.pop(future)
+				jobretcode = future.result()
+				if jobretcode != 0:
+					if retcode == 0:
+						retcode = jobretcode
+					continue
+				for k in dependents[i]:
+					remaining[k].discard(i)
+					if not remaining[k]:
+						submit(k)
+	notrun = [currentJob.name for i, currentJob in enumerate(jobs) if i not in started]
+	if notrun:
+		print('Not run because a dependency failed:', notrun)
+	return retcode
 
 # All the job classes        
 JobClasses = [Job, ShellJob, PythonJob, MatlabJob, ExecutableJob, BatchJob]
@@ -307,13 +637,19 @@ def load_from_file(configfile):
 	configDict = load_json(configfile)
 	return create_from_dict(configDict)
 
-def runjob(currentJob, folder=None):
-	"""Run the job in folder."""
-	if folder:
-		with ChangeDirectory(folder):
-			return currentJob.run()
-	else:
-		return currentJob.run()
+def runjob(currentJob, folder=None, force=False):
+	"""
+	Run the job in folder. Skip it if it is up to date there, unless force.
+	"""
+	if not force and currentJob.is_up_to_date(folder):
+		print('Up to date, skipped: %s in %s' % (currentJob.name, jobfolder(folder)))
+		return 0
+	if isinstance(currentJob, BatchJob):
+		currentJob.force = force
+	retcode = currentJob.run(folder)
+	if retcode == 0:
+		currentJob.record_done(folder)
+	return retcode
 
 def runjob_with_config(jobconfig, folder = None):
 	currentJob = create_from_dict(jobconfig)
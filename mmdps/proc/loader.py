@@ -6,11 +6,13 @@ to config every loader.
 """
 import os
 import json
+import hashlib
 import numpy as np
+from numpy.lib.format import open_memmap
 
 from mmdps import rootconfig
 from mmdps.proc import netattr, atlas
-from mmdps.util.loadsave import load_csvmat, load_txt, load_csv_to_list
+from mmdps.util.loadsave import load_csvmat, load_mat, load_npymat, npymat_path, stack_is_current, load_txt, load_csv_to_list, load_json, save_json
 from mmdps.util import path
 
 class Loader:
@@ -61,7 +63,7 @@ class Loader:
 			csvfile = self.loadfilepath(mriscan, netattrname, csvfilename)
 		else:
 			csvfile = self.loadfilepath(mriscan, netattrname)
-		resmat = load_csvmat(csvfile)
+		resmat = load_mat(csvfile)
 		if type(self.f_preproc) is dict:
 			if mriscan in self.f_preproc:
 				f = self.f_preproc[mriscan]
@@ -90,18 +92,102 @@ class Loader:
 		"""
 		self.f_preproc = f_preproc
 
-	def loadvstack(self, mriscans, netattrname):
+	def loadvstack(self, mriscans, netattrname, cached = False):
 		"""Load all data in every mriscan in mriscans.
 
 		Every feature data for one mriscan is flattened, before vstacked to a matrix.
+		With cached = True, the matrix is a view of the cohort tensor, see loadtensor. Do not change it in place.
 		"""
-		datalist = []
-		for mriscan in mriscans:
+		if cached:
+			tensor = self.loadtensor(mriscans, netattrname)
+			return tensor.reshape((tensor.shape[0], -1))
+		datavstack = None
+		for i, mriscan in enumerate(mriscans):
 			currentData = self.loaddata(mriscan, netattrname)
-			datalist.append(currentData.flatten())
-		datavstack = np.vstack(datalist)
+			if datavstack is None:
+				datavstack = np.empty((len(mriscans), currentData.size))
+			datavstack[i] = currentData.ravel()
 		return datavstack
 
+	def cohort_cachefolder(self):
+		"""The folder for cohort tensors, env MMDPS_COHORT_CACHE or .cohortcache in mainfolder."""
+		return os.environ.get('MMDPS_COHORT_CACHE', os.path.join(self.mainfolder, '.cohortcache'))
+
+	def cohort_cachefile(self, mriscans, netattrname, cachefolder = None):
+		"""The cohort tensor file, named by the hash of (mriscans, atlas, feature)."""
+		if cachefolder is None:
+			cachefolder = self.cohort_cachefolder()
+		key = json.dumps([list(mriscans), self.atlasobj.name, netattrname])
+		return os.path.join(cachefolder, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+	def source_stamps(self, mriscans, netattrname):
+		"""The [file, mtime_ns, size] of every file the cohort tensor is built from."""
+		stamps = []
+		for mriscan in mriscans:
+			csvfile = self.loadfilepath(mriscan, netattrname)
+			for filepath in (csvfile, npymat_path(csvfile)):
+				if os.path.isfile(filepath):
+					st = os.stat(filepath)
+					stamps.append([filepath, st.st_mtime_ns, st.st_size])
+		return stamps
+
+	def loadtensor(self, mriscans, netattrname, cachefolder = None):
+		"""
+		Load the feature of all mriscans as one read-only memory-mapped array,
+		tensor[i] is the data of mriscans[i], like (scans, regions, regions) for nets.
+
+		The tensor is filled in place into a npy file in cachefolder, keyed by
+		(mriscans, atlas, feature). A json manifest records the source files,
+		the tensor is reopened instantly as long as none of them changed.
+		When set_preproc is used, or the cache folder cannot be written, the
+		tensor is built in memory and not cached, and it is writable.
+		"""
+		if self.f_preproc:
+			return self.buildtensor(mriscans, netattrname)
+		try:
+			return self.loadcachedtensor(mriscans, netattrname, cachefolder)
+		except OSError as e:
+			print('Cannot use the cohort cache, load in memory:', e)
+			return self.buildtensor(mriscans, netattrname)
+
+	def buildtensor(self, mriscans, netattrname):
+		"""Load the feature of all mriscans as one array in memory, see loadtensor."""
+		tensor = None
+		for i, mriscan in enumerate(mriscans):
+			currentData = self.loaddata(mriscan, netattrname)
+			if tensor is None:
+				tensor = np.empty((len(mriscans),) + currentData.shape)
+			tensor[i] = currentData
+		if tensor is None:
+			raise Exception('Cannot build a cohort tensor for an empty scan list')
+		return tensor
+
+	def loadcachedtensor(self, mriscans, netattrname, cachefolder = None):
+		tensorfile = self.cohort_cachefile(mriscans, netattrname, cachefolder)
+		manifestfile = os.path.splitext(tensorfile)[0] + '.json'
+		stamps = self.source_stamps(mriscans, netattrname)
+		if os.path.isfile(tensorfile) and os.path.isfile(manifestfile):
+			manifest = load_json(manifestfile)
+			if manifest.get('mriscans') == list(mriscans) and manifest.get('sources') == stamps:
+				return np.load(tensorfile, mmap_mode = 'r')
+		os.makedirs(os.path.dirname(tensorfile), exist_ok = True)
+		if os.path.isfile(manifestfile):
+			os.remove(manifestfile)
+		tmpfile = '%s.%d.tmp' % (tensorfile, os.getpid())
+		tensor = None
+		for i, mriscan in enumerate(mriscans):
+			currentData = self.loaddata(mriscan, netattrname)
+			if tensor is None:
+				tensor = open_memmap(tmpfile, mode = 'w+', dtype = np.float64, shape = (len(mriscans),) + currentData.shape)
+			tensor[i] = currentData
+		if tensor is None:
+			raise Exception('Cannot build a cohort tensor for an empty scan list')
+		tensor.flush()
+		del tensor
+		os.replace(tmpfile, tensorfile)
+		save_json(manifestfile, {'atlas': self.atlasobj.name, 'feature': netattrname, 'mriscans': list(mriscans), 'sources': stamps})
+		return np.load(tensorfile, mmap_mode = 'r')
+
 class AttrLoader(Loader):
 	"""Attribute loader."""
 	def loadSingle(self, mriscan, attrname, csvfilename = None):
@@ -158,8 +244,14 @@ class NetLoader(Loader):
 		net = netattr.Net(netdata, self.atlasobj, mriscan, attrname)
 		return net
 
-	def loadMulti(self, mriscans, attrname = 'BOLD.net'):
-		"""Load a list of nets"""
+	def loadMulti(self, mriscans, attrname = 'BOLD.net', cached = False):
+		"""
+		Load a list of nets.
+		With cached = True, every net.data is a view of one cohort tensor, see loadtensor. Do not change it in place.
+		"""
+		if cached:
+			tensor = self.loadtensor(mriscans, attrname)
+			return [netattr.Net(tensor[i], self.atlasobj, mriscan, attrname) for i, mriscan in enumerate(mriscans)]
 		ret = []
 		for mriscan in mriscans:
 			ret.append(self.loadSingle(mriscan, attrname))
@@ -277,18 +369,16 @@ def load_single_dynamic_attr(scan, atlasobj, attrname, dynamic_conf, rootFolder
 		feature_name = 'BOLD.WD.inter'
 	else:
 		raise Exception('Unknown feature_name %s' % attrname)
-	dynamic_attr = netattr.DynamicAttr(None, atlasobj, window_length, step_size, scan = scan, feature_name = feature_name)
-	start = 0
 	dynamic_foler_path = os.path.join(rootFolder, scan, atlasobj.name, 'bold_net_attr', 'dynamic %d %d' % (step_size, window_length))
+	slicefiles = []
+	start = 0
 	while True:
 		dynamic_attr_filepath = os.path.join(dynamic_foler_path, '%s-%d.%d.csv' % (attrname, start, start + window_length))
-		if os.path.exists(dynamic_attr_filepath):
-			dynamic_attr.append_one_slice(load_csvmat(dynamic_attr_filepath))
-			start += step_size
-		else:
-			# print('loaded %d attrs for %s' % (len(ret[scan]), scan))
+		if not os.path.exists(dynamic_attr_filepath):
 			break
-	return dynamic_attr
+		slicefiles.append(dynamic_attr_filepath)
+		start += step_size
+	return netattr.DynamicAttr.from_slices(map(load_csvmat, slicefiles), atlasobj, window_length, step_size, scan = scan, feature_name = feature_name, num_slices = len(slicefiles))
 
 def load_dynamic_attr(scans, atlasobj, attrname, dynamic_conf, rootFolder = rootconfig.path.feature_root):
 	"""
@@ -318,28 +408,43 @@ def load_single_network(mriscan, atlasobj, mainfolder = rootconfig.path.feature_
 	# l = NetLoader(atlasobj, mainfolder)
 	return NetLoader(atlasobj, mainfolder).loadSingle(mriscan)
 
+def load_networks(scans, atlasobj, attrname = 'BOLD.net', rootFolder = rootconfig.path.feature_root, cached = False):
+	"""
+	Load the networks of scans as a list of Net.
+	With cached = True, they share one memory-mapped cohort tensor cached on disk, see
+	Loader.loadtensor. Their data is then read-only, copy a net before changing it in place,
+	like with setValueAtTicks. Set MMDPS_COHORT_CACHE to a folder you can write if
+	rootFolder is shared.
+	"""
+	if type(atlasobj) is str:
+		atlasobj = atlas.get(atlasobj)
+	return NetLoader(atlasobj, rootFolder).loadMulti(scans, attrname, cached)
+
 def load_single_dynamic_network(scan, atlasobj, dynamic_conf, rootFolder = rootconfig.path.feature_root):
 	"""
-	Return a DynamicNet (net.data[timeIdx, tickIdx, tickIdx])
+	Return a DynamicNet (net.data[tickIdx, tickIdx, timeIdx])
+	The stack corrcoef.npy is used when it is not older than the window csv files,
+	the same rule as load_mat, otherwise the windows are loaded one by one.
 	"""
 	if type(atlasobj) is str:
 		atlasobj = atlas.get(atlasobj)
 	window_length = dynamic_conf[0]
 	step_size = dynamic_conf[1]
-	start = 0
 	dynamic_foler_path = os.path.join(rootFolder, scan, atlasobj.name, 'bold_net', 'dynamic %d %d' % (step_size, window_length))
-	time_slice_count = len(list(os.listdir(dynamic_foler_path))) - 1 # get rid of timeseries.csv
-	dynamic_net = netattr.DynamicNet(np.zeros((atlasobj.count, atlasobj.count, time_slice_count)), atlasobj, window_length, step_size, scan = scan, feature_name = 'BOLD.net')
-	timeIdx = 0
+	slicefiles = []
+	start = 0
 	while True:
 		dynamic_net_filepath = os.path.join(dynamic_foler_path, 'corrcoef-%d.%d.csv' % (start, start+window_length))
-		if os.path.exists(dynamic_net_filepath):
-			time_slice_net = load_csvmat(dynamic_net_filepath)
-			dynamic_net.data[:, :, timeIdx] = time_slice_net
-			timeIdx += 1
-			start += step_size
-		else:
+		if not os.path.exists(dynamic_net_filepath):
 			break
+		slicefiles.append(dynamic_net_filepath)
+		start += step_size
+	stackfile = os.path.join(dynamic_foler_path, 'corrcoef.npy')
+	if stack_is_current(stackfile, slicefiles):
+		return netattr.DynamicNet(load_npymat(stackfile), atlasobj, window_length, step_size, scan = scan, feature_name = 'BOLD.net')
+	dynamic_net = netattr.DynamicNet(np.zeros((atlasobj.count, atlasobj.count, len(slicefiles))), atlasobj, window_length, step_size, scan = scan, feature_name = 'BOLD.net')
+	for timeIdx, dynamic_net_filepath in enumerate(slicefiles):
+		dynamic_net.data[:, :, timeIdx] = load_mat(dynamic_net_filepath)
 	return dynamic_net
 
 def generate_mriscans(namelist, root_folder = rootconfig.path.feature_root, num_scan = 1, accumulate = False):
@@ -0,0 +1,262 @@
+"""Warm MATLAB sessions for MatlabJob.
+
+Starting MATLAB often takes longer than the command a MatlabJob runs. With env
+MMDPS_MATLAB_MODE=pool, MatlabJob runs its command in a MATLAB session that
+stays open, with the search path added once per session:
+	with the MATLAB Engine API for Python (matlab.engine), if installed,
+	else in matlab -nodesktop reading commands from a pipe (not on Windows).
+Up to MMDPS_MATLAB_SESSIONS sessions (1 by default) are started on demand and
+shared by the threads of a process. Para and parabase workers are processes,
+each keeps its own sessions for all its tasks. The BNV plotters use MatlabJob,
+so they share the sessions too.
+
+Variables and figures are cleared before every command. The job folder is not
+added to the path, the command is run after cd into the job wd.
+
+Sessions are closed at exit, in Para and parabase workers too, as long as
+they exit normally. A worker killed by Pool.terminate leaves its -nodesktop
+sessions to exit when their stdin is closed, engine sessions to the engine.
+
+The default mode, process, starts MATLAB for every job.
+"""
+
+import os
+import io
+import sys
+import uuid
+import queue
+import atexit
+import threading
+import multiprocessing.util
+import subprocess
+
+from mmdps.util import path
+from mmdps import rootconfig
+
+def mode():
+	"""process or pool, env MMDPS_MATLAB_MODE."""
+	return os.getenv('MMDPS_MATLAB_MODE', 'process')
+
+def has_engine():
+	try:
+		import matlab.engine
+		return True
+	except ImportError:
+		return False
+
+def pool_available():
+	"""Whether sessions can be started, with the engine, or a pipe on Linux and macOS."""
+	return has_engine() or sys.platform != 'win32'
+
+def addpath_command(pathlist):
+	return 'addpath(' + ','.join("'{}'".format(p) for p in pathlist) + ');'
+
+def eval_command(command):
+	"""command as a MATLAB eval call, so that a syntax error is raised when it runs, and can be caught."""
+	lines = ["'{}'".format(line.replace("'", "''")) for line in command.split('\n')]
+	return 'eval([' + ' char(10) '.join(lines) + ']);'
+
+class ReplSession:
+	"""A matlab -nodesktop process, commands are written to its stdin."""
+	def __init__(self, pathlist, timeout=600):
+		self.token = 'MMDPS_DONE_' + uuid.uuid4().hex
+		self.process = subprocess.Popen([rootconfig.matlab_bin, '-nosplash', '-nodesktop'],
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+			universal_newlines=True, start_new_session=True)
+		self.exited = False
+		self.lines = queue.Queue()
+		threading.Thread(target=self.read, daemon=True).start()
+		log = io.StringIO()
+		if self.eval(addpath_command(pathlist), log, timeout) != 0:
+			raise Exception('MATLAB session failed to start: ' + log.getvalue())
+
+	def read(self):
+		for line in self.process.stdout:
+			self.lines.put(line)
+		self.lines.put(None)
+
+	def alive(self):
+		return not self.exited and self.process.poll() is None
+
+	def eval(self, command, log, timeout=None):
+		"""
+		Run command, write its output to log. Return 0, 1 if it raised an error,
+		-1 if MATLAB exited or the timeout passed, then the session is closed.
+		"""
+		rows = []
+		rows.append('try')
+		rows.append(eval_command(command))
+		rows.append("fprintf('\\n{} 0\\n');".format(self.token))
+		rows.append('catch me')
+		rows.append("fprintf('%s / %s\\n', me.identifier, me.message);")
+		rows.append("fprintf('\\n{} 1\\n');".format(self.token))
+		rows.append('end')
+		try:
+			self.process.stdin.write('\n'.join(rows) + '\n')
+			self.process.stdin.flush()
+		except OSError:
+			self.exited = True
+			return -1
+		from mmdps.proc import job
+		timer = threading.Timer(timeout, job.kill_tree, (self.process,)) if timeout else None
+		if timer:
+			timer.start()
+		try:
+			while True:
+				line = self.lines.get()
+				if line is None:
+					self.exited = True
+					log.write('\nMATLAB exited, or killed after timeout of {} s\n'.format(timeout))
+					return -1
+				if self.token in line:
+					return int(line.split(self.token)[1].split()[0])
+				log.write(line)
+		finally:
+			if timer:
+				timer.cancel()
+				# let a running kill finish
+				timer.join()
+
+	def close(self):
+		if not self.alive():
+			return
+		try:
+			self.process.stdin.write('exit\n')
+			self.process.stdin.flush()
+			self.process.wait(timeout=30)
+		except (OSError, subprocess.TimeoutExpired):
+			from mmdps.proc import job
+			job.kill_tree(self.process)
+
+class EngineSession:
+	"""A MATLAB started with matlab.engine."""
+	def __init__(self, pathlist, timeout=None):
+		import matlab.engine
+		self.engine = matlab.engine.start_matlab('-nosplash -nodesktop')
+		self.engine.eval(addpath_command(pathlist), nargout=0)
+		self.closed = False
+
+	def alive(self):
+		return not self.closed
+
+	def eval(self, command, log, timeout=None):
+		"""Run command, write its output to log. Return 0, 1 if it raised an error, -1 if the timeout passed."""
+		import matlab.engine
+		out = io.StringIO()
+		code = 0
+		try:
+			future = self.engine.eval(command, nargout=0, stdout=out, stderr=out, background=True)
+			future.result(timeout=timeout)
+		except (matlab.engine.MatlabExecutionError, SyntaxError) as e:
+			out.write('{}\n'.format(e))
+			code = 1
+		except TimeoutError:
+			future.cancel()
+			out.write('\nKilled after timeout of {} s\n'.format(timeout))
+			self.close()
+			code = -1
+		except matlab.engine.EngineError as e:
+			out.write('\nMATLAB exited: {}\n'.format(e))
+			self.closed = True
+			code = -1
+		log.write(out.getvalue())
+		return code
+
+	def close(self):
+		if not self.closed:
+			self.closed = True
+			try:
+				self.engine.quit()
+			except Exception:
+				pass
+
+class MatlabPool:
+	"""
+	Up to size MATLAB sessions, started when needed. A session runs one
+	command at a time, a dead session is replaced on the next command.
+	"""
+	def __init__(self, size=None):
+		self.size = size or int(os.getenv('MMDPS_MATLAB_SESSIONS', 1))
+		self.pid = os.getpid()
+		self.lock = threading.Lock()
+		# idle sessions, None is a free slot of a closed session
+		self.idle = queue.Queue()
+		self.started = 0
+		self.sessions = []
+
+	def start_session(self):
+		pathlist = path.searchpathlist()[1:]
+		if has_engine():
+			session = EngineSession(pathlist)
+		else:
+			session = ReplSession(pathlist)
+		with self.lock:
+			self.sessions.append(session)
+		return session
+
+	def acquire(self):
+		with self.lock:
+			start = self.idle.empty() and self.started < self.size
+			if start:
+				self.started += 1
+		if not start:
+			session = self.idle.get()
+			if session is not None:
+				return session
+		try:
+			return self.start_session()
+		except Exception:
+			self.idle.put(None)
+			raise
+
+	def release(self, session):
+		if session.alive():
+			self.idle.put(session)
+		else:
+			with self.lock:
+				self.sessions.remove(session)
+			self.idle.put(None)
+
+	def run(self, command, wd, logfile, timeout=None):
+		"""Run command in wd on an idle session, the output goes to logfile. Return 0 if succeeded."""
+		print('Call_matlab_pool %s at %s' % (command, logfile))
+		session = self.acquire()
+		try:
+			with open(logfile, 'w') as log:
+				log.write('Command: \n{}\n\n'.format(command))
+				fullcmd = "clearvars; close all force; cd('{}');\n{}".format(wd, command)
+				retcode = session.eval(fullcmd, log, timeout)
+		finally:
+			self.release(session)
+		if retcode != 0:
+			print('Error run matlab "{}", return code is {}, log at {}'.format(command, retcode, logfile))
+		return retcode
+
+	def close(self):
+		"""Close the sessions started by this process."""
+		if os.getpid() != self.pid:
+			return
+		with self.lock:
+			sessions = list(self.sessions)
+			self.sessions = []
+		for session in sessions:
+			session.close()
+
+pool = None
+pool_lock = threading.Lock()
+
+def get_pool():
+	"""The pool of this process, a forked process gets a new one."""
+	global pool
+	with pool_lock:
+		if pool is None or pool.pid != os.getpid():
+			pool = MatlabPool()
+			# atexit does not run in multiprocessing workers, their finalizers do
+			multiprocessing.util.Finalize(pool, pool.close, exitpriority=10)
+		return pool
+
+def close_pool():
+	if pool is not None:
+		pool.close()
+
+atexit.register(close_pool)
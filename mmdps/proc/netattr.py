@@ -13,7 +13,7 @@ from pathlib import Path
 # from ..util.loadsave import save_csvmat, load_csvmat
 from mmdps.proc import atlas
 from mmdps.util import dataop, path
-from mmdps.util.loadsave import save_csvmat, load_csvmat
+from mmdps.util.loadsave import save_csvmat, load_csvmat, save_npymat, npymat_path
 
 class Mat:
 	"""
@@ -32,6 +32,10 @@ class Mat:
 		self.scan = scan
 		self.feature_name = feature_name
 
+	def save(self, outfile):
+		"""Save the data as one binary npy file, like corrcoef.npy for a dynamic net."""
+		save_npymat(npymat_path(outfile), self.data)
+
 class Attr(Mat):
 	"""
 	Attr is an attribute. It is a one dimensional vector.
@@ -62,8 +66,13 @@ class Attr(Mat):
 		return Attr(subdata, subatlasobj, self.name)
 
 	def save(self, outfile, addticks=True):
-		"""Save the attr, can add ticks defined in atlasobj."""
-		if addticks is False:
+		"""
+		Save the attr, can add ticks defined in atlasobj.
+		If outfile ends with .npy, the data is saved as binary without ticks.
+		"""
+		if outfile.endswith('.npy'):
+			save_npymat(outfile, self.data)
+		elif addticks is False:
 			save_csvmat(outfile, self.data)
 		else:
 			path.makedirs_file(outfile)
@@ -99,7 +108,106 @@ class Attr(Mat):
 			processed_original_community.append(origin[idx])
 		self.data = new
 
-class DynamicAttr(Mat):
+class DynamicMat(Mat):
+	"""
+	DynamicMat is the core of DynamicAttr and DynamicNet, whose last axis is time.
+
+	Slices appended with append_one_slice go into a buffer that grows by doubling,
+	so building T slices copies O(T) values. data is always the filled part of the
+	buffer. Use reserve, or from_slices with a known length, to allocate once.
+	"""
+	def __init__(self, data, atlasobj, window_length, step_size, scan = None, feature_name = None):
+		super().__init__(data, atlasobj, scan, feature_name)
+		self.window_length = window_length
+		self.step_size = step_size
+
+	@property
+	def data(self):
+		if self._buffer is None:
+			return self._data
+		return self._buffer[..., :self._length]
+
+	@data.setter
+	def data(self, data):
+		self._data = data
+		self._buffer = None
+		self._length = 0
+
+	@classmethod
+	def from_slices(cls, slices, atlasobj, window_length, step_size, scan = None, feature_name = None, num_slices = None):
+		"""
+		Build from an iterable of slices, which can be a generator loading them one by one.
+		The buffer is allocated once when num_slices is given or slices has a length.
+		"""
+		if feature_name is None:
+			obj = cls(None, atlasobj, window_length, step_size, scan)
+		else:
+			obj = cls(None, atlasobj, window_length, step_size, scan, feature_name)
+		if num_slices is None and hasattr(slices, '__len__'):
+			num_slices = len(slices)
+		for data in slices:
+			if num_slices is not None and obj._buffer is None:
+				obj.reserve(num_slices, data)
+			obj.append_one_slice(data)
+		return obj
+
+	def reserve(self, num_slices, like = None):
+		"""
+		Make room for num_slices slices in total, like is a slice giving the shape and dtype
+		when there is no data yet.
+		"""
+		current = self.data
+		if current is None:
+			if like is None:
+				raise Exception('reserve needs a slice (like) to know the slice shape')
+			like = np.asarray(like)
+			shape, dtype, length = like.shape, like.dtype, 0
+		else:
+			shape, dtype, length = current.shape[:-1], current.dtype, current.shape[-1]
+		if self._buffer is not None and self._buffer.shape[-1] >= num_slices:
+			return
+		buffer = np.empty(shape + (max(num_slices, length),), dtype = dtype)
+		if length > 0:
+			buffer[..., :length] = current
+		self._buffer = buffer
+		self._length = length
+		self._data = None
+
+	def append_one_slice(self, data):
+		"""
+		Append one slice to the end of the time axis.
+		The appended slice should align with current data, or be used to create original data.
+		"""
+		data = np.asarray(data)
+		if self._buffer is None or self._length == self._buffer.shape[-1]:
+			length = 0 if self.data is None else self.data.shape[-1]
+			self.reserve(max(2 * length, 16), data)
+		if self._buffer.dtype != np.result_type(self._buffer.dtype, data.dtype):
+			self._buffer = self._buffer.astype(np.result_type(self._buffer.dtype, data.dtype))
+		self._buffer[..., self._length] = np.reshape(data, self._buffer.shape[:-1])
+		self._length += 1
+
+	def compact(self):
+		"""Drop the unused room of the buffer."""
+		if self._buffer is not None:
+			self.data = self.data.copy()
+
+	@property
+	def num_slices(self):
+		return 0 if self.data is None else self.data.shape[-1]
+
+	def get_slice(self, idx):
+		"""The slice at time idx, a view of data."""
+		return self.data[..., idx]
+
+	def iter_slices(self, start = 0, stop = None):
+		"""Iterate over slice views from start to stop, without copies."""
+		data = self.data
+		stop = data.shape[-1] if stop is None else stop
+		for idx in range(start, stop):
+			yield data[..., idx]
+
+class DynamicAttr(DynamicMat):
 	"""
 	DynamicAttr is the dynamic version of Attr.
 
@@ -108,9 +216,7 @@ class DynamicAttr(Mat):
 	resulting in a 2-D matrix. (num_regions X num_time_points)
 	"""
 	def __init__(self, data, atlasobj, window_length, step_size, scan = None, feature_name = None):
-		super().__init__(data, atlasobj, scan, feature_name)
-		self.window_length = window_length
-		self.step_size = step_size
+		super().__init__(data, atlasobj, window_length, step_size, scan, feature_name)
 
 	def normalize(self):
 		if np.max(self.data) < 1.1:
@@ -120,21 +226,8 @@ class DynamicAttr(Mat):
 			for yidx in range(self.data.shape[1]):
 				self.data[xidx, yidx] = normalize_feature(self.data[xidx, yidx], self.feature_name, self.atlasobj)
 
-	def append_one_slice(self, data):
-		"""
-		This function appends one slice of attributes to current dynamic attributes.
-		The appended slice should align with current data, or be used to create original data.
-		:param data: a np (n,) array
-		:return: nothing
-		"""
-		data = np.reshape(data, (data.shape[0], 1))
-		if self.data is None:
-			self.data = data
-		else:
-			self.data = np.concatenate((self.data, data), axis = 1)
-
 	def get_dynamic_at_tick(self, tick):
-		tickIdx = self.atlasobj.ticks.index(tick)
+		tickIdx = self.atlasobj.ticks_to_indexes([tick])[0]
 		return self.data[tickIdx, :]
 
 class Net(Mat):
@@ -157,19 +250,17 @@ class Net(Mat):
 		to an np.array. The elements are selected column-wise, without main diag
 		Specify selectedAreas to return connections within those areas
 		"""
-		if selectedAreas is None:
-			selectedAreas = self.atlasobj.ticks
 		n = self.data.shape[0]
+		rows, cols = self.atlasobj.lower_edges()
 		ret = np.zeros((1, int(n*(n-1)/2)))
-		counter = 0
-		for colIdx in range(n):
-			if self.atlasobj.ticks[colIdx] not in selectedAreas:
-				continue
-			for rowIdx in range(colIdx + 1, n):
-				if self.atlasobj.ticks[rowIdx] not in selectedAreas:
-					continue
-				ret[0, counter] = self.data[rowIdx, colIdx]
-				counter += 1
+		if selectedAreas is None:
+			values = self.data[rows, cols]
+		else:
+			selectedAreas = set(selectedAreas)
+			selected = np.array([tick in selectedAreas for tick in self.atlasobj.ticks[:n]], dtype = bool)
+			keep = selected[rows] & selected[cols]
+			values = self.data[rows[keep], cols[keep]]
+		ret[0, :len(values)] = values
 		return ret
 
 	def setDataFromList(self, valueList):
@@ -179,12 +270,9 @@ class Net(Mat):
 		The input valueList is assumed to be a one-dimensional list
 		"""
 		n = self.atlasobj.count
+		rows, cols = self.atlasobj.lower_edges()
 		self.data = np.zeros((n, n))
-		counter = 0
-		for colIdx in range(n):
-			for rowIdx in range(colIdx + 1, n):
-				self.data[rowIdx, colIdx] = valueList[counter]
-				counter += 1
+		self.data[rows, cols] = np.asarray(valueList)[:len(rows)]
 		self.data += np.transpose(self.data)
 		self.data += np.eye(n)
 
@@ -199,13 +287,9 @@ class Net(Mat):
 		with the subnetwork specified by areas in the subAreaList argument
 		"""
 		newnet = Net(self.data.copy(), self.atlasobj, self.scan)
-		mask = np.zeros(self.data.shape)
-		indexList = [self.atlasobj.ticks.index(area) for area in subAreaList]
-		for xidx in range(self.atlasobj.count):
-			for yidx in range(self.atlasobj.count):
-				if xidx in indexList and yidx in indexList:
-					mask[xidx, yidx] = 1
-		newnet.data = np.multiply(self.data, mask)
+		selected = np.zeros(self.atlasobj.count, dtype = bool)
+		selected[self.atlasobj.ticks_to_indexes(subAreaList)] = True
+		newnet.data = np.multiply(self.data, np.outer(selected, selected))
 		return newnet
 
 	def gensub(self, subatlasname, subindexes):
@@ -215,8 +299,13 @@ class Net(Mat):
 		return Net(subdata, subatlasobj, self.name)
 
 	def save(self, outfile, addticks=True):
-		"""Save the net, can add ticks defined in atlasobj."""
-		if addticks is False:
+		"""
+		Save the net, can add ticks defined in atlasobj.
+		If outfile ends with .npy, the data is saved as binary without ticks.
+		"""
+		if outfile.endswith('.npy'):
+			save_npymat(outfile, self.data)
+		elif addticks is False:
 			save_csvmat(outfile, self.data)
 		else:
 			path.makedirs_file(outfile)
@@ -237,10 +326,7 @@ class Net(Mat):
 		abs(FC) < threshold --> FC = 0
 		"""
 		newnet = Net(self.data.copy(), self.atlasobj, self.scan)
-		for xidx in range(self.atlasobj.count):
-			for yidx in range(self.atlasobj.count):
-				if abs(self.data[xidx, yidx]) < threshold:
-					newnet.data[xidx, yidx] = 0
+		newnet.data[np.abs(self.data) < threshold] = 0
 		return newnet
 
 	def binarize(self, threshold):
@@ -271,41 +357,25 @@ class Net(Mat):
 			tmp_list[roi_list] = 1
 			roi_list = tmp_list.astype(bool)
 		newnet = Net(self.data.copy(), self.atlasobj, self.scan, self.feature_name)
-		for xidx in range(self.atlasobj.count):
-			for yidx in range(xidx + 1, self.atlasobj.count):
-				if roi_list[xidx] and roi_list[yidx]:
-					continue
-				newnet.data[xidx, yidx] = 0
-				newnet.data[yidx, xidx] = 0
+		roi_list = np.asarray(roi_list, dtype = bool)
+		keep = np.outer(roi_list, roi_list)
+		np.fill_diagonal(keep, True)
+		newnet.data[~keep] = 0
 		return newnet
 
 	def setValueAtTicks(self, xtick, ytick, value):
-		self.data[self.atlasobj.ticks.index(xtick), self.atlasobj.ticks.index(ytick)] = value
-		self.data[self.atlasobj.ticks.index(ytick), self.atlasobj.ticks.index(xtick)] = value
+		xidx, yidx = self.atlasobj.ticks_to_indexes([xtick, ytick])
+		self.data[xidx, yidx] = value
+		self.data[yidx, xidx] = value
 
-class DynamicNet(Mat):
+class DynamicNet(DynamicMat):
 	"""
 	DynamicNet is the dynamic version of Net. It is stored as a 3-dimensional
 	data array (loc x, loc y, time). One can obtain the network at a given time
 	slice by using data[:, :, idx]
 	"""
 	def __init__(self, data, atlasobj, window_length, step_size, scan = None, feature_name = 'BOLD.net'):
-		super().__init__(data, atlasobj, scan, feature_name)
-		self.step_size = step_size
-		self.window_length = window_length
-
-	def append_one_slice(self, data):
-		"""
-		This function appends one slice of network to current dynamic networks.
-		The appended slice should align with current data, or be used to create original data.
-		:param data: a np (n, n) array
-		:return: nothing
-		"""
-		data = np.reshape(data, (data.shape[0], data.shape[1], 1))
-		if self.data is None:
-			self.data = data
-		else:
-			self.data = np.concatenate((self.data, data), axis = 2)
+		super().__init__(data, atlasobj, window_length, step_size, scan, feature_name)
 
 	def loadDynamicNets(self, loadPath):
 		"""
@@ -345,8 +415,7 @@ def averageAttr(attr_list, result_scan = None):
 	result = zero_attr(atlasobj)
 	result.feature_name = attr_list[0].feature_name
 	result.scan = result_scan
-	for idx in range(atlasobj.count):
-		result.data[idx] = np.average([attr.data[idx] for attr in attr_list])
+	result.data = np.average(np.stack([attr.data for attr in attr_list]), axis = 0)
 	return result
 
 def normalize_feature(feature_value, feature_name, atlasobj):
@@ -373,10 +442,22 @@ def normalize_features(feature_list, feature_name, atlasobj):
 def networks_comparisons(network_list_A, network_list_B, comparison_method):
 	"""
 	comparison_method should be stats_utils.twoSampleTTest or stats_utils.pairedTTest
+	The tests in stats_utils.EDGEWISE_TESTS (or their names) run on all connections at once.
 	"""
+	from mmdps.util import stats_utils
 	atlasobj = network_list_A[0].atlasobj
 	stat_network = zero_net(atlasobj)
 	p_network = one_net(atlasobj)
+	method = stats_utils.edgewise_method_name(comparison_method)
+	if method is not None:
+		rows, cols, edgesA = stats_utils.upper_edges(stats_utils.stack_data(network_list_A), atlasobj)
+		_, _, edgesB = stats_utils.upper_edges(stats_utils.stack_data(network_list_B), atlasobj)
+		t, tp = stats_utils.edgewise_test(edgesA, edgesB, method)
+		stat_network.data[rows, cols] = t
+		stat_network.data[cols, rows] = t
+		p_network.data[rows, cols] = tp
+		p_network.data[cols, rows] = tp
+		return stat_network, p_network
 	for xidx in range(atlasobj.count):
 		for yidx in range(xidx+1, atlasobj.count):
 			# print(atlasobj.ticks[xidx], atlasobj.ticks[yidx]) 'L32' - 'L32'
@@ -391,15 +472,21 @@ def networks_comparisons(network_list_A, network_list_B, comparison_method):
 def attr_comparisons(attr_list_A, attr_list_B, comparison_method, correction_method = None):
 	"""
 	Comparison is performed by A - B
+	The tests in stats_utils.EDGEWISE_TESTS (or their names) run on all regions at once.
 	"""
+	from mmdps.util import stats_utils
 	atlasobj = attr_list_A[0].atlasobj
 	stat_attr = zero_attr(atlasobj)
 	p_attr = zero_attr(atlasobj)
-	for idx in range(atlasobj.count):
-		t, tp = comparison_method([attr.data[idx] for attr in attr_list_A], 
-								  [attr.data[idx] for attr in attr_list_B])
-		stat_attr.data[idx] = t
-		p_attr.data[idx] = tp
+	method = stats_utils.edgewise_method_name(comparison_method)
+	if method is not None:
+		stat_attr.data, p_attr.data = stats_utils.edgewise_test(stats_utils.stack_data(attr_list_A), stats_utils.stack_data(attr_list_B), method)
+	else:
+		for idx in range(atlasobj.count):
+			t, tp = comparison_method([attr.data[idx] for attr in attr_list_A], 
+									  [attr.data[idx] for attr in attr_list_B])
+			stat_attr.data[idx] = t
+			p_attr.data[idx] = tp
 	if correction_method is not None:
 		_, p_attr.data = correction_method(p_attr.data)
 	return stat_attr, p_attr
@@ -410,11 +497,12 @@ def FC_values(network):
 	Return a list of dict, whose keys are connection ticks ('L1-L2') and FC value (as %1.4f)
 	"""
 	atlasobj = network.atlasobj
+	rows, cols = atlasobj.upper_edges()
+	values = network.data[rows, cols]
+	edgeTicks = atlasobj.edge_ticks()
 	ret = []
-	for xidx in range(atlasobj.count):
-		for yidx in range(xidx + 1, atlasobj.count):
-			if network.data[xidx, yidx] != 0:
-				ret.append(dict(connection = '%s-%s' % (atlasobj.ticks[xidx], atlasobj.ticks[yidx]), FC = '%1.4f' % (network.data[xidx, yidx])))
+	for edgeIdx in np.flatnonzero(values != 0):
+		ret.append(dict(connection = edgeTicks[edgeIdx], FC = '%1.4f' % (values[edgeIdx])))
 	return ret
 
 def FC_count(FC_list):
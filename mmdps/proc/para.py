@@ -74,28 +74,37 @@ class Para:
 		d['RunMode'] = self.runmode
 		return d
 
-	def run_seq(self, jobobj, folders):
+	def run_seq(self, jobobj, folders, force=False):
 		"""Run all jobs sequentially."""
 		for folder in folders:
-			b = job.runjob(jobobj, folder)
+			b = job.runjob(jobobj, folder, force)
 			if b != 0:
 				return b
 
-	def run_para(self, jobobj, folders):
+	def run_para(self, jobobj, folders, force=False):
 		"""
 		Run all jobs in parallel.
 		folders is a list of folder names
+		Runs on other machines with env MMDPS_EXECUTOR=distributed, see parabase.run.
 		"""
-		f = functools.partial(job.runjob, jobobj)
+		f = functools.partial(job.runjob, jobobj, force=force)
 		return parabase.run(f, folders)
 		#return parabase.run_simple(f, folders)
 
-	def run(self):
+	def outdated_folders(self, jobobj, folders):
+		"""The folders in which the job is not up to date, see job.runjob."""
+		outdated = [folder for folder in folders if not jobobj.is_up_to_date(folder)]
+		if len(outdated) < len(folders):
+			print('Up to date, skipped %d of %d folders' % (len(folders) - len(outdated), len(folders)))
+		return outdated
+
+	def run(self, force=False):
 		"""Run the para.
 		finalfolders is the constructed folder in which to run the job in parallel,
 		Or sequential if configured that way.
 		Env MMDPS_NEWLIST_TXT will override folderlist.
 		Env MMDPS_SECONDLIST_TXT will override secondlist.
+		Folders in which the job is up to date are skipped, unless force.
 		"""
 		if self.folderlist == 'listdir':
 			originalfolders = path.clean_listdir(self.mainfolder)
@@ -119,11 +128,15 @@ class Para:
 			finalfolders = folders
 		currentJob = job.create_from_dict(loadsave.load_json(path.fullfile(self.jobconfig)))
 		if self.runmode == 'FirstOnly':
-			return self.run_seq(currentJob, finalfolders[0:1])
+			finalfolders = finalfolders[0:1]
+		if not force:
+			finalfolders = self.outdated_folders(currentJob, finalfolders)
+		if self.runmode == 'FirstOnly':
+			return self.run_seq(currentJob, finalfolders, force)
 		if self.runmode == 'Parallel':
-			return self.run_para(currentJob, finalfolders)
+			return self.run_para(currentJob, finalfolders, force)
 		if self.runmode == 'Sequential':
-			return self.run_seq(currentJob, finalfolders)
+			return self.run_seq(currentJob, finalfolders, force)
 		else:
 			print('Error: no such runmode as', self.runmode)
 			return None
@@ -12,6 +12,11 @@ allfuncs.append(plot_line.run)
 allfuncs.append(plot_bnv.run)
 allfuncs.append(plot_circos.run)
 parabase.run_callfunc(allfuncs)
+
+run hands tasks to free processes one at a time, so long tasks do not
+hold up short ones packed in the same chunk. Give cost hints to start the
+longest tasks first, and memory hints with a memory budget to cap how many
+tasks run together.
 """
 
 import multiprocessing
@@ -23,109 +28,202 @@ import queue
 # from ..util import clock
 from mmdps.util import clock
 
-class FWrap:
-	"""Wrap the function in an object. Put run arg in the q when done."""
-	def __init__(self, f, q):
-		"""Init the FWrap using function to run and queue."""
-		self.f = f
-		self.q = q
+def cgroup_cpu_quota():
+	"""The cpu limit of the cgroup (v2 cpu.max or v1 cfs quota), None if not limited."""
+	try:
+		with open('/sys/fs/cgroup/cpu.max') as f:
+			quota, period = f.read().split()[:2]
+		if quota != 'max':
+			return int(quota) / int(period)
+	except (OSError, ValueError):
+		pass
+	try:
+		with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+			quota = int(f.read())
+		with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+			period = int(f.read())
+		if quota > 0:
+			return quota / period
+	except (OSError, ValueError):
+		pass
+	return None
 
-	def run(self, arg):
-		"""Run the function. Put the run arg to q when finished calling f."""
-		return_dict = dict(start_time = time.time())
-		res = self.f(arg)
-		return_dict['message'] = 'arg: %s, res: %s' % (arg, res)
-		self.q.put(return_dict)
-		return res
+def usable_cpu_count():
+	"""The cpus this process can use, by cpu affinity and cgroup quota."""
+	try:
+		cpu_count = len(os.sched_getaffinity(0))
+	except AttributeError:
+		# no affinity on Windows and macOS
+		cpu_count = os.cpu_count() or 1
+	quota = cgroup_cpu_quota()
+	if quota:
+		cpu_count = min(cpu_count, max(int(quota), 1))
+	return cpu_count
 
 def get_processes(processes):
 	"""Get how many processes to use when run things in parallel.
 
+	The default is the usable cpu count, see usable_cpu_count.
 	Set env MMDPS_CPU_COUNT=n to force the cpu count to n. n is an integer.
 	"""
 	if processes:
 		return processes
 	else:
-		cpu_count = os.cpu_count()
-		cpu_count = cpu_count // 2
-		if cpu_count == 0:
-			cpu_count = 1
-		cpu_count = int(os.getenv('MMDPS_CPU_COUNT', cpu_count))
+		cpu_count = int(os.getenv('MMDPS_CPU_COUNT', usable_cpu_count()))
 		print('Processes count:', cpu_count)
 		return cpu_count
 
+def parse_size(size):
+	"""Bytes of a size like 512M or 64G, ints are bytes."""
+	if isinstance(size, (int, float)):
+		return int(size)
+	size = size.strip().upper().rstrip('B')
+	units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+	if size and size[-1] in units:
+		return int(float(size[:-1]) * units[size[-1]])
+	return int(size)
+
+def get_mem_budget(mem_budget=None):
+	"""Bytes of memory the tasks running together may use, env MMDPS_MEM_BUDGET. None if no budget."""
+	mem_budget = mem_budget or os.getenv('MMDPS_MEM_BUDGET')
+	if mem_budget:
+		return parse_size(mem_budget)
+	return None
+
+def get_hints(argvec, hints):
+	"""Per task hints, a list or a function of arg. None if no hints."""
+	if hints is None:
+		return None
+	if callable(hints):
+		return [hints(arg) for arg in argvec]
+	if len(hints) != len(argvec):
+		raise Exception('%d hints for %d tasks' % (len(hints), len(argvec)))
+	return list(hints)
+
+def write_quarantine(args, quarantine_file=None):
+	"""
+	Write the args of the failed tasks, one per line, to quarantine_file, env
+	MMDPS_QUARANTINE_FILE, or log/quarantine_<time>.txt. Return the file.
+	"""
+	quarantine_file = quarantine_file or os.getenv('MMDPS_QUARANTINE_FILE')
+	if not quarantine_file:
+		os.makedirs('log', exist_ok=True)
+		quarantine_file = os.path.join('log', 'quarantine_{}.txt'.format(clock.now()))
+	with open(quarantine_file, 'w') as f:
+		for arg in args:
+			f.write('{}\n'.format(arg))
+	print('Quarantine list of {} failed tasks at {}'.format(len(args), os.path.abspath(quarantine_file)))
+	return quarantine_file
+
+class TimedCall:
+	"""Call the function in a worker, return the result and the seconds it took."""
+	def __init__(self, f):
+		self.f = f
+
+	def __call__(self, arg):
+		start_time = time.time()
+		res = self.f(arg)
+		return res, time.time() - start_time
+
 def run1(f, argvec, processes=None):
 	"""Run function f len(argvec) times, each time use one arg in argvec."""
+	return run(f, argvec, processes)
+
+def run(f, argvec, processes=None, costs=None, memory=None, mem_budget=None, executor=None, quarantine_file=None):
+	"""Run function f len(argvec) times, each time use one arg in argvec.
+
+	Tasks are given to free processes one at a time, the most costly first
+	if costs hints are given (like seconds, a list or a function of arg).
+	memory hints (bytes) keep the tasks running together within mem_budget,
+	see get_mem_budget, a task over the budget runs alone.
+	executor is local, or distributed to run on the hosts of env MMDPS_HOSTS,
+	see mmdps.proc.distributed. Env MMDPS_EXECUTOR by default.
+	The args of failed tasks, with a nonzero return code or an exception, are
+	written to a quarantine list at the end, in the order of argvec, see write_quarantine.
+	Return the results in the order of argvec.
+	"""
+	argvec = list(argvec)
+	costs = get_hints(argvec, costs)
+	executor = executor or os.getenv('MMDPS_EXECUTOR', 'local')
+	if executor == 'distributed':
+		from mmdps.proc import distributed
+		return distributed.run(f, argvec, costs=costs, quarantine_file=quarantine_file)
+	elif executor != 'local':
+		raise Exception('Unknown executor %s, should be local or distributed' % executor)
 	processes = get_processes(processes)
-	with multiprocessing.Pool(processes) as p:
-		m = multiprocessing.Manager()
-		q = m.Queue()
-		fwrap = FWrap(f, q)
-		result = p.map_async(fwrap.run, argvec)
-		ntotal = len(argvec)
-		print('Begin proc, {} cpus, {} left, start at {}'.format(processes, ntotal, clock.now()))
-		nfinished = 0
-		while True:
-			if result.ready():
-				break
-			else:
-				res = q.get()
-				nfinished += 1
-				print('{} just finished. {} left, at {}'.format(res, ntotal-nfinished, clock.now()))
-		print('End proc, end at {}'.format(clock.now()))
-		outputs = result.get()
-		return outputs
-
-def run(f, argvec, processes=None):
-	"""Run function f len(argvec) times, each time use one arg in argvec."""
-	processes = get_processes(processes)
+	ntotal = len(argvec)
+	memory = get_hints(argvec, memory) or [0] * ntotal
+	mem_budget = get_mem_budget(mem_budget)
+	if costs is None:
+		pending = list(range(ntotal))
+	else:
+		pending = sorted(range(ntotal), key=lambda i: -costs[i])
+	outputs = [None] * ntotal
+	done = queue.Queue()
+	running = {}
+	exceptions = []
+	errorList = []
+	failed = []
 	estimated_task_time_cost = -1
+	timed_f = TimedCall(f)
 	with multiprocessing.Pool(processes) as pool:
-		manager = multiprocessing.Manager()
-		managerQueue = manager.Queue()
-		fwrap = FWrap(f, managerQueue)
-		result = pool.map_async(fwrap.run, argvec)
-		ntotal = len(argvec)
-		nError = 0
-		errorList = []
 		print('Begin proc, {} cpus, {} left, start at {}'.format(processes, ntotal, clock.now()))
 		nfinished = 0
-		while True:
-			if result.ready():
-				break
-			else:
-				try:
-					ret = managerQueue.get(timeout=1)
-				except queue.Empty:
+		while pending or running:
+			# start the first pending tasks fitting in the free processes and memory
+			pos = 0
+			while pos < len(pending) and len(running) < processes:
+				i = pending[pos]
+				if running and mem_budget is not None and sum(running.values()) + memory[i] > mem_budget:
+					pos += 1
 					continue
-				else:
-					nfinished += 1
-					elapsed_time = time.time() - ret['start_time']
-					if estimated_task_time_cost < 0:
-						estimated_task_time_cost = elapsed_time
-					else:
-						estimated_task_time_cost = 0.75 * estimated_task_time_cost + 0.25 * elapsed_time
-					res = ret['message']
-					retCode = int(res[res.find('res: ') + 5:])
-					if retCode != 0:
-						nError += 1
-						errorList.append(res)
-						print('{} just finished with error after {:1.2f} s execution. {} left, at {}. Estimated time left: {} (HMS)'.format(res, elapsed_time, ntotal-nfinished, clock.now(), str(datetime.timedelta(seconds = (ntotal-nfinished) * estimated_task_time_cost))))
-					else:
-						print('{} just finished after {:1.2f} s execution. {} left, at {}. Estimated time left: {} (HMS)'.format(res, elapsed_time, ntotal-nfinished, clock.now(), str(datetime.timedelta(seconds = (ntotal-nfinished) * estimated_task_time_cost))))
-		print('End proc, end at {}. {} error.'.format(clock.now(), nError))
-		if nError != 0:
-			print('Listing errs')
-			for err in errorList:
-				print(err)
-		outputs = result.get()
-		# print(outputs) # a list of return codes, should be all zero
-		return outputs
-
-def run_simple(f, argvec, processes=None):
-	"""Same as run, without progress reporting."""
+				pending.pop(pos)
+				running[i] = memory[i]
+				pool.apply_async(timed_f, (argvec[i],),
+					callback=lambda ret, i=i: done.put((i, ret, None)),
+					error_callback=lambda e, i=i: done.put((i, None, e)))
+			i, ret, e = done.get()
+			del running[i]
+			nfinished += 1
+			if e is not None:
+				exceptions.append(e)
+				failed.append((i, argvec[i]))
+				res = 'arg: %s, exception: %r' % (argvec[i], e)
+				errorList.append(res)
+				print('{} just finished with exception. {} left, at {}.'.format(res, ntotal-nfinished, clock.now()))
+				continue
+			outputs[i], elapsed_time = ret
+			if estimated_task_time_cost < 0:
+				estimated_task_time_cost = elapsed_time
+			else:
+				estimated_task_time_cost = 0.75 * estimated_task_time_cost + 0.25 * elapsed_time
+			time_left = str(datetime.timedelta(seconds = (ntotal-nfinished) * estimated_task_time_cost / processes))
+			res = 'arg: %s, res: %s' % (argvec[i], outputs[i])
+			if isinstance(outputs[i], int) and outputs[i] != 0:
+				errorList.append(res)
+				failed.append((i, argvec[i]))
+				print('{} just finished with error after {:1.2f} s execution. {} left, at {}. Estimated time left: {} (HMS)'.format(res, elapsed_time, ntotal-nfinished, clock.now(), time_left))
+			else:
+				print('{} just finished after {:1.2f} s execution. {} left, at {}. Estimated time left: {} (HMS)'.format(res, elapsed_time, ntotal-nfinished, clock.now(), time_left))
+	print('End proc, end at {}. {} error.'.format(clock.now(), len(errorList)))
+	if errorList:
+		print('Listing errs')
+		for err in errorList:
+			print(err)
+		write_quarantine([arg for i, arg in sorted(failed, key=lambda item: item[0])], quarantine_file)
+	if exceptions:
+		raise exceptions[0]
+	# a list of return codes, should be all zero
+	return outputs
+
+def run_simple(f, argvec, processes=None, initializer=None, initargs=()):
+	"""Same as run, without progress reporting.
+
+	initializer(*initargs) is called once in every process, use it to send
+	large data shared by all tasks once per process instead of in every arg.
+	"""
 	processes = get_processes(processes)
-	with multiprocessing.Pool(processes) as p:
+	with multiprocessing.Pool(processes, initializer, initargs) as p:
 		result = p.map(f, argvec)
 		return result
 
@@ -0,0 +1,178 @@
+"""Permutation inference on networks.
+
+Group labels (or signs, for paired data) are shuffled in batches, and the
+t statistics of all connections are computed for a whole batch at once.
+Batches are spread over processes with parabase.
+
+Two kinds of inference are provided:
+max_stat_fwe: connection level, family-wise error corrected by the max statistic.
+nbs: network-based statistic, component level, corrected by the max component size.
+
+The result is reproducible with a seed, whatever the processes count is,
+because every batch has its own child of one np.random.SeedSequence. It
+depends on batch_size though, the same seed with another batch_size draws
+other permutations.
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from mmdps.proc import netattr, parabase
+from mmdps.util import stats_utils
+
+PERMUTATION_TESTS = ('ttest_ind', 'ttest_rel')
+
+def batch_tstats(edgesA, edgesB, method, rng, num_permutations):
+	"""
+	The t statistics of num_permutations shuffles, shape (num_permutations, connections).
+	ttest_ind shuffles group labels, ttest_rel flips the sign of the paired differences.
+	Constant connections give nan.
+	"""
+	with np.errstate(invalid = 'ignore', divide = 'ignore'):
+		if method == 'ttest_ind':
+			nA, nB = edgesA.shape[0], edgesB.shape[0]
+			X = np.vstack((edgesA, edgesB))
+			X = X - X.mean(axis = 0)
+			X2 = X * X
+			base = np.zeros(nA + nB)
+			base[:nA] = 1
+			G = rng.permuted(np.tile(base, (num_permutations, 1)), axis = 1)
+			sumA = G @ X
+			sumsqA = G @ X2
+			sumB = X.sum(axis = 0) - sumA
+			sumsqB = X2.sum(axis = 0) - sumsqA
+			meanA = sumA / nA
+			meanB = sumB / nB
+			pooled = (sumsqA - nA * meanA * meanA + sumsqB - nB * meanB * meanB) / (nA + nB - 2)
+			return (meanA - meanB) / np.sqrt(pooled * (1.0 / nA + 1.0 / nB))
+		elif method == 'ttest_rel':
+			D = edgesA - edgesB
+			n = D.shape[0]
+			signs = rng.choice(np.array([-1.0, 1.0]), size = (num_permutations, n))
+			mean = signs @ D / n
+			var = ((D * D).sum(axis = 0) - n * mean * mean) / (n - 1)
+			return mean / np.sqrt(var / n)
+	raise Exception('Unknown permutation test %s, should be one of %s' % (method, PERMUTATION_TESTS))
+
+def observed_tstats(edgesA, edgesB, method):
+	"""The t statistics of the real labels."""
+	stat, _ = stats_utils.edgewise_test(edgesA, edgesB, method)
+	return stat
+
+def components(stat, rows, cols, count, threshold):
+	"""
+	The connected components of connections with abs(stat) > threshold.
+	Return the component label of every supra-threshold connection (-1 for the others),
+	and the size (number of connections) of every component.
+	"""
+	supra = np.abs(np.nan_to_num(stat)) > threshold
+	edgeLabels = np.full(stat.shape, -1)
+	if not supra.any():
+		return edgeLabels, np.zeros(0, dtype = int)
+	adjacency = sparse.coo_matrix((np.ones(supra.sum()), (rows[supra], cols[supra])), shape = (count, count))
+	_, nodeLabels = csgraph.connected_components(adjacency, directed = False)
+	edgeLabels[supra] = nodeLabels[rows[supra]]
+	sizes = np.bincount(edgeLabels[supra], minlength = nodeLabels.max() + 1)
+	return edgeLabels, sizes
+
+# the data shared by all batches of a worker process, see init_batches
+batch_data = {}
+
+def init_batches(edgesA, edgesB, method, threshold, rows, cols, count):
+	"""Keep the data of all batches in this process, sent once instead of with every batch."""
+	batch_data.update(edgesA = edgesA, edgesB = edgesB, method = method, threshold = threshold, rows = rows, cols = cols, count = count)
+
+def permutation_batch(args):
+	"""
+	Run one batch of permutations, in a worker process set up by init_batches.
+	args is (seedseq, num_permutations).
+	Return the max abs t, and the max component size if threshold is given, of every permutation.
+	"""
+	seedseq, num_permutations = args
+	edgesA, edgesB, method = batch_data['edgesA'], batch_data['edgesB'], batch_data['method']
+	threshold, rows, cols, count = batch_data['threshold'], batch_data['rows'], batch_data['cols'], batch_data['count']
+	rng = np.random.default_rng(seedseq)
+	tstats = batch_tstats(edgesA, edgesB, method, rng, num_permutations)
+	maxStats = np.nanmax(np.abs(np.nan_to_num(tstats)), axis = 1)
+	if threshold is None:
+		return maxStats, None
+	maxSizes = np.zeros(num_permutations, dtype = int)
+	for i in range(num_permutations):
+		_, sizes = components(tstats[i], rows, cols, count, threshold)
+		if len(sizes) > 0:
+			maxSizes[i] = sizes.max()
+	return maxStats, maxSizes
+
+def run_permutations(netListA, netListB, method = 'ttest_ind', num_permutations = 10000, seed = None, processes = None, batch_size = 100, threshold = None):
+	"""
+	Run num_permutations shuffles of the two groups.
+	Return (rows, cols, observed t, max abs t of every permutation, max component size of every permutation or None).
+	"""
+	if method not in PERMUTATION_TESTS:
+		raise Exception('Unknown permutation test %s, should be one of %s' % (method, PERMUTATION_TESTS))
+	rows, cols, edgesA = stats_utils.upper_edges(stats_utils.stack_data(netListA))
+	_, _, edgesB = stats_utils.upper_edges(stats_utils.stack_data(netListB))
+	if method == 'ttest_rel' and edgesA.shape != edgesB.shape:
+		raise Exception('Paired test %s needs the same subjects in both groups' % method)
+	edgesA = np.ascontiguousarray(edgesA, dtype = np.float64)
+	edgesB = np.ascontiguousarray(edgesB, dtype = np.float64)
+	count = netListA[0].data.shape[0]
+	batchSizes = [batch_size] * (num_permutations // batch_size)
+	if num_permutations % batch_size:
+		batchSizes.append(num_permutations % batch_size)
+	seedseqs = np.random.SeedSequence(seed).spawn(len(batchSizes))
+	argvec = list(zip(seedseqs, batchSizes))
+	initargs = (edgesA, edgesB, method, threshold, rows, cols, count)
+	if processes == 1:
+		init_batches(*initargs)
+		try:
+			results = [permutation_batch(args) for args in argvec]
+		finally:
+			batch_data.clear()
+	else:
+		results = parabase.run_simple(permutation_batch, argvec, processes, init_batches, initargs)
+	maxStats = np.concatenate([r[0] for r in results])
+	maxSizes = None if threshold is None else np.concatenate([r[1] for r in results])
+	return rows, cols, observed_tstats(edgesA, edgesB, method), maxStats, maxSizes
+
+def max_stat_fwe(netListA, netListB, method = 'ttest_ind', num_permutations = 10000, sigLevel = 0.05, seed = None, processes = None, batch_size = 100):
+	"""
+	Connection level permutation test of A - B, FWE corrected by the max statistic.
+	Return stat_net (t), p_net (corrected p) and mask_net (1 where corrected p < sigLevel).
+	"""
+	atlasobj = netListA[0].atlasobj
+	rows, cols, stat, maxStats, _ = run_permutations(netListA, netListB, method, num_permutations, seed, processes, batch_size)
+	sortedMax = np.sort(maxStats)
+	exceed = len(sortedMax) - np.searchsorted(sortedMax, np.abs(np.nan_to_num(stat)), side = 'left')
+	p = (exceed + 1.0) / (len(sortedMax) + 1.0)
+	p[np.isnan(stat)] = 1
+	stat_net = netattr.zero_net(atlasobj)
+	p_net = netattr.one_net(atlasobj)
+	mask_net = netattr.zero_net(atlasobj)
+	stat_net.data[rows, cols] = stat_net.data[cols, rows] = stat
+	p_net.data[rows, cols] = p_net.data[cols, rows] = p
+	mask_net.data[rows, cols] = mask_net.data[cols, rows] = p < sigLevel
+	return stat_net, p_net, mask_net
+
+def nbs(netListA, netListB, threshold, method = 'ttest_ind', num_permutations = 10000, seed = None, processes = None, batch_size = 100):
+	"""
+	Network-based statistic of A - B.
+	Connections with abs(t) > threshold form components, and every component is
+	tested against the max component size (in connections) of the permutations.
+	Return a list of (mask_net, size, p), biggest component first.
+	"""
+	atlasobj = netListA[0].atlasobj
+	rows, cols, stat, _, maxSizes = run_permutations(netListA, netListB, method, num_permutations, seed, processes, batch_size, threshold)
+	edgeLabels, sizes = components(stat, rows, cols, atlasobj.count, threshold)
+	ret = []
+	for label in np.argsort(-sizes, kind = 'stable'):
+		if sizes[label] == 0:
+			continue
+		inComponent = edgeLabels == label
+		mask_net = netattr.zero_net(atlasobj)
+		mask_net.data[rows[inComponent], cols[inComponent]] = 1
+		mask_net.data[cols[inComponent], rows[inComponent]] = 1
+		p = (np.sum(maxSizes >= sizes[label]) + 1.0) / (len(maxSizes) + 1.0)
+		ret.append((mask_net, int(sizes[label]), p))
+	return ret
@@ -71,6 +71,67 @@ def save_csvmat(matfile, mat, delimiter = ','):
     os.makedirs(os.path.dirname(os.path.abspath(matfile)), exist_ok=True)
     np.savetxt(matfile, mat, delimiter=delimiter)
 
+def feature_format():
+    """Which formats save_mat writes, set by env MMDPS_FEATURE_FORMAT.
+
+    'both' (default) writes the csv and the binary .npy sidecar,
+    'npy' writes the binary file only, 'csv' writes the csv only.
+    Keep csv when matlab steps read the matrix with csvread.
+    """
+    fmt = os.environ.get('MMDPS_FEATURE_FORMAT', 'both')
+    if fmt not in ('both', 'npy', 'csv'):
+        raise Exception('Unknown MMDPS_FEATURE_FORMAT %s, should be both, npy or csv' % fmt)
+    return fmt
+
+def npymat_path(matfile):
+    """The binary sidecar of a matrix file, like bold_net/corrcoef.csv -> bold_net/corrcoef.npy."""
+    return os.path.splitext(matfile)[0] + '.npy'
+
+def load_npymat(matfile, mmap_mode = None):
+    """Load a matrix saved as npy. Use mmap_mode='r' to map it instead of reading it."""
+    return np.load(matfile, mmap_mode = mmap_mode, allow_pickle = False)
+
+def save_npymat(matfile, mat):
+    """Save a matrix as npy. The file is written aside and renamed into place."""
+    os.makedirs(os.path.dirname(os.path.abspath(matfile)), exist_ok=True)
+    tmpfile = '%s.%d.tmp' % (matfile, os.getpid())
+    with open(tmpfile, 'wb') as f:
+        np.save(f, np.asarray(mat), allow_pickle = False)
+    os.replace(tmpfile, matfile)
+
+def load_mat(matfile, delimiter = ',', mmap_mode = None):
+    """
+    Load a feature matrix, written by save_mat or by other tools as csv.
+    The binary .npy sidecar is used when it exists and is not older than the csv,
+    otherwise the csv is parsed with load_csvmat.
+    """
+    npyfile = npymat_path(matfile)
+    if os.path.isfile(npyfile) and (not os.path.isfile(matfile) or os.path.getmtime(npyfile) >= os.path.getmtime(matfile)):
+        return load_npymat(npyfile, mmap_mode)
+    return load_csvmat(matfile, delimiter)
+
+def stack_is_current(stackfile, matfiles):
+    """
+    Whether the npy file of stacked matrices, like a dynamic corrcoef.npy, exists
+    and is not older than any of matfiles, the same rule as load_mat for a sidecar.
+    """
+    if not os.path.isfile(stackfile):
+        return False
+    mtimes = [os.path.getmtime(matfile) for matfile in matfiles if os.path.isfile(matfile)]
+    return not mtimes or os.path.getmtime(stackfile) >= max(mtimes)
+
+def save_mat(matfile, mat, delimiter = ','):
+    """
+    Save a feature matrix as csv and/or its binary .npy sidecar, see feature_format.
+    If matfile is a .npy file, only the binary file is written.
+    """
+    npyfile = npymat_path(matfile)
+    fmt = feature_format()
+    if npyfile != matfile and fmt in ('both', 'csv'):
+        save_csvmat(matfile, mat, delimiter)
+    if npyfile == matfile or fmt in ('both', 'npy'):
+        save_npymat(npyfile, mat)
+
 def load_rawtext(textfile):
     with open(textfile) as f:
         return f.read()
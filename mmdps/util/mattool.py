@@ -2,6 +2,7 @@
 
 """
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy import stats
 
 
@@ -14,11 +15,131 @@ def pearsonr(xmat, yvec):
     """
     nrow, ncol = xmat.shape
     assert nrow == yvec.shape[0]
-    rs = np.zeros(ncol)
-    ps = np.zeros(ncol)
-    for i in range(ncol):
-        x = xmat[:, i]
-        y = yvec
-        r, p = stats.pearsonr(x, y)
-        rs[i], ps[i] = r, p
-    return rs, ps
+    rs, ps = corr(xmat, yvec)
+    return rs[:, 0], ps[:, 0]
+
+def rank_columns(mat):
+    """Rank every column of mat, ties get the average rank like scipy.stats.rankdata."""
+    return stats.rankdata(mat, axis=0)
+
+def residualize(mat, covariates):
+    """Residuals of every column of mat after least squares on [1, covariates]."""
+    covariates = np.asarray(covariates, dtype=np.float64).reshape((mat.shape[0], -1))
+    if np.isnan(covariates).any():
+        raise Exception('Covariates contain nan, drop those subjects first')
+    design = np.hstack((np.ones((mat.shape[0], 1)), covariates))
+    beta, _, _, _ = np.linalg.lstsq(design, mat, rcond=None)
+    return mat - design @ beta
+
+def _as_columns(mat):
+    mat = np.asarray(mat, dtype=np.float64)
+    if mat.ndim == 1:
+        mat = mat[:, np.newaxis]
+    return mat
+
+def _pearson_columns(xmat, ymat, df):
+    """r of every column pair of xmat and ymat, p from the t distribution with df degrees of freedom."""
+    x = xmat - xmat.mean(axis=0)
+    y = ymat - ymat.mean(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x /= np.sqrt((x * x).sum(axis=0))
+        y /= np.sqrt((y * y).sum(axis=0))
+        r = np.clip(x.T @ y, -1, 1)
+        t = r * np.sqrt(df / (1 - r * r))
+    p = 2 * stats.t.sf(np.abs(t), df)
+    return r, p
+
+def _tie_sizes(mat):
+    """For every subject, how many subjects in the same column share its value (itself included)."""
+    return (mat[:, np.newaxis, :] == mat[np.newaxis, :, :]).sum(axis=1)
+
+def _kendall_columns(xmat, ymat):
+    """
+    Kendall's tau-b of every column pair, with the asymptotic p value of
+    scipy.stats.kendalltau(method='asymptotic').
+    Pair signs of y are computed once, x is processed in chunks of columns.
+    """
+    n = xmat.shape[0]
+    iu, ju = np.triu_indices(n, 1)
+    tot = n * (n - 1) // 2
+    m = n * (n - 1)
+
+    def tie_terms(mat):
+        t = _tie_sizes(mat)
+        return (t - 1).sum(axis=0) / 2, ((t - 1) * (t - 2)).sum(axis=0), ((t - 1) * (2 * t + 5)).sum(axis=0)
+
+    ysign = np.sign(ymat[iu] - ymat[ju])
+    ytie, y0, y1 = tie_terms(ymat)
+    r = np.empty((xmat.shape[1], ymat.shape[1]))
+    p = np.empty((xmat.shape[1], ymat.shape[1]))
+    chunk = max(1, 2 ** 22 // max(tot, n * n))
+    for start in range(0, xmat.shape[1], chunk):
+        x = xmat[:, start:start + chunk]
+        con_minus_dis = np.sign(x[iu] - x[ju]).T @ ysign
+        xtie, x0, x1 = tie_terms(x)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            r[start:start + chunk] = con_minus_dis / np.sqrt(np.outer(tot - xtie, tot - ytie))
+            var = ((m * (2 * n + 5) - x1[:, np.newaxis] - y1) / 18
+                   + 2 * np.outer(xtie, ytie) / m
+                   + np.outer(x0, y0) / (9 * m * (n - 2)))
+            z = con_minus_dis / np.sqrt(var)
+        p[start:start + chunk] = 2 * stats.norm.sf(np.abs(z))
+    return np.clip(r, -1, 1), p
+
+def corr(xmat, ymat, method='pearson', covariates=None):
+    """Correlate every column of xmat with every column of ymat.
+
+    xmat is (subjects, features), like vstacked attrs or connections,
+    ymat is (subjects,) or (subjects, scores).
+    method is 'pearson', 'spearman' (ranked once, then pearson) or 'kendall' (tau-b).
+    covariates, (subjects,) or (subjects, k) like age and gender, gives the partial
+    correlation: both sides are residualized on them, and the p value uses n - 2 - k
+    degrees of freedom. Not supported for kendall.
+    Return r, p of shape (features, scores). Constant columns get nan.
+    """
+    xmat = _as_columns(xmat)
+    ymat = _as_columns(ymat)
+    n = xmat.shape[0]
+    if ymat.shape[0] != n:
+        raise Exception('xmat has %d subjects but ymat has %d' % (n, ymat.shape[0]))
+    if method == 'kendall':
+        if covariates is not None:
+            raise Exception('Partial correlation is not supported for kendall')
+        return _kendall_columns(xmat, ymat)
+    if method == 'spearman':
+        xmat = rank_columns(xmat)
+        ymat = rank_columns(ymat)
+    elif method != 'pearson':
+        raise Exception('Unknown correlation method %s, should be pearson, spearman or kendall' % method)
+    df = n - 2
+    if covariates is not None:
+        covariates = np.asarray(covariates, dtype=np.float64).reshape((n, -1))
+        xmat = residualize(xmat, covariates)
+        ymat = residualize(ymat, covariates)
+        df -= covariates.shape[1]
+    return _pearson_columns(xmat, ymat, df)
+
+def sliding_corrcoef(ts, window_length, step_size=1):
+    """Sliding window correlation of the rows in ts.
+
+    ts is a (regions, timepoints) matrix. Windows start at 0, step_size, 2*step_size...
+    as long as the whole window fits, and window k equals
+    np.corrcoef(ts[:, start:start + window_length]).
+    All windows are standardized at once on a strided view, and the whole stack
+    of correlation matrices is one batched matrix product.
+    Return a (regions, regions, windows) array. Constant windows get nan, like np.corrcoef.
+    """
+    x = np.asarray(ts, dtype=np.float64)
+    nregion = x.shape[0]
+    # (windows, regions, window_length), a view into x
+    windows = sliding_window_view(x, window_length, axis=1)[:, ::step_size].transpose(1, 0, 2)
+    z = windows - windows.mean(axis=2, keepdims=True)
+    norm = np.sqrt(np.einsum('wij,wij->wi', z, z))
+    valid = norm > 0
+    norm[~valid] = np.nan
+    z /= norm[:, :, np.newaxis]
+    r = np.matmul(z, z.transpose(0, 2, 1))
+    np.clip(r, -1, 1, out=r)
+    diag = np.arange(nregion)
+    r[:, diag, diag] = np.where(valid, 1.0, np.nan)
+    return r.transpose(1, 2, 0)
@@ -48,9 +48,9 @@ def path_tovar(pathlist):
 	"""Path list joined to path environment variable."""
 	return os.path.pathsep.join(pathlist)
 
-def defaultpathlist():
-	"""The default search path."""
-	return [os.path.abspath('.'), rootconfig.path.tools, os.path.join(rootconfig.path.tools, 'ui_programs')]
+def defaultpathlist(folder='.'):
+	"""The default search path, folder is the current directory by default."""
+	return [os.path.abspath(folder), rootconfig.path.tools, os.path.join(rootconfig.path.tools, 'ui_programs')]
 
 def builtinpathlist():
 	"""The built-in search path.
@@ -67,9 +67,9 @@ def projectpathlist():
 	pathvar = os.getenv('MMDPS_PROJECTPATH', '')
 	return path_tolist(pathvar)
 
-def searchpathlist():
+def searchpathlist(folder='.'):
 	"""The full path list for searching."""
-	defaultlist = defaultpathlist()
+	defaultlist = defaultpathlist(folder)
 	builtinlist = builtinpathlist()
 	pathvarlist = projectpathlist()
 	searchpaths = []
@@ -83,16 +83,18 @@ def searchpathlist():
 	searchpaths.append(os.path.join(rootconfig.path.root, 'tools', 'job_runner'))
 	return searchpaths
 
-def getfilepath(filename):
-	"""Search the file in all search paths, return the full path."""
-	if os.path.isfile(filename):
-		return os.path.abspath(filename)
-	pathlist = searchpathlist()
+def getfilepath(filename, folder='.'):
+	"""Search the file in all search paths, return the full path.
+	Relative files are relative to folder.
+	"""
+	if os.path.isfile(os.path.join(folder, filename)):
+		return os.path.abspath(os.path.join(folder, filename))
+	pathlist = searchpathlist(folder)
 	return findfile(filename, pathlist)
 
-def fullfile(filename):
+def fullfile(filename, folder='.'):
 	"""Search the file and return the full path in all search paths."""
-	return getfilepath(filename)
+	return getfilepath(filename, folder)
 
 def findfile(filename, pathlist):
 	"""Find the file in pathlist."""
@@ -29,32 +29,32 @@ def mean_confidence_interval(data, confidence = 0.95):
 	h = se * scipy.stats.t.ppf((1+confidence)/2., n-1)
 	return m, m-h, m+h
 
-def twoSampleTTest(a, b):
+def twoSampleTTest(a, b, axis = 0):
 	"""
 	https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.ttest_ind.html
 	"""
-	t, p = scipy.stats.ttest_ind(a, b)
+	t, p = scipy.stats.ttest_ind(a, b, axis = axis)
 	return (t, p)
 
-def non_parametric_two_sample_test(a, b):
+def non_parametric_two_sample_test(a, b, axis = 0):
 	"""
 	https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.mannwhitneyu.html
 	"""
-	stat, p = scipy.stats.mannwhitneyu(a, b)
+	stat, p = scipy.stats.mannwhitneyu(a, b, axis = axis)
 	return stat, p
 
-def non_parametric_paired_test(a, b):
+def non_parametric_paired_test(a, b, axis = 0):
 	"""
 	https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.wilcoxon.html
 	"""
-	stat, p = scipy.stats.wilcoxon(a, b)
+	stat, p = scipy.stats.wilcoxon(a, b, axis = axis)
 	return stat, p
 
-def pairedTTest(a, b):
+def pairedTTest(a, b, axis = 0):
 	"""
 	https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.ttest_rel.html
 	"""
-	t, p = scipy.stats.ttest_rel(a, b)
+	t, p = scipy.stats.ttest_rel(a, b, axis = axis)
 	return (t, p)
 
 def permutation_test(a, b, num_rounds = 10000):
@@ -77,6 +77,25 @@ def correlation_Kendall(a, b):
 	tao, taop = scipy.stats.kendalltau(a, b)
 	return tao, taop
 
+# Batched versions of the correlations above, see mattool.corr.
+# kendall uses the asymptotic p value there, while scipy.stats.kendalltau uses
+# the exact p value for small samples, so correlation_Kendall is not batched,
+# only the name 'kendall' is.
+CORRELATION_METHODS = {
+	'pearson': correlation_Pearson,
+	'spearman': correlation_Spearman,
+	'kendall': correlation_Kendall,
+}
+
+def correlation_method_name(correlation_method):
+	"""The CORRELATION_METHODS name of a correlation function or name, None if it cannot be batched."""
+	if correlation_method in CORRELATION_METHODS:
+		return correlation_method
+	for name, f in CORRELATION_METHODS.items():
+		if f is correlation_method and name != 'kendall':
+			return name
+	return None
+
 def FDR_correction(p_list, sigLevel = 0.05):
 	reject, pvals_corrected, _, _ = multitest.multipletests(p_list, sigLevel, method='fdr_bh')
 	return reject, pvals_corrected
@@ -85,6 +104,136 @@ def bonferroni_correction(p_list, sigLevel = 0.05):
 	reject, pvals_corrected, _, _ = multitest.multipletests(p_list, sigLevel, method='bonferroni')
 	return reject, pvals_corrected
 
+# Edge-wise engine. Every test below runs on all columns of (subjects, features)
+# arrays in one call, instead of once per connection.
+EDGEWISE_TESTS = {
+	'ttest_ind': twoSampleTTest,
+	'ttest_rel': pairedTTest,
+	'mannwhitneyu': non_parametric_two_sample_test,
+	'wilcoxon': non_parametric_paired_test,
+}
+
+PAIRED_TESTS = ('ttest_rel', 'wilcoxon')
+
+def edgewise_method_name(comparison_method):
+	"""The EDGEWISE_TESTS name of a comparison function or name, None if it cannot run edge-wise."""
+	if comparison_method in EDGEWISE_TESTS:
+		return comparison_method
+	for name, f in EDGEWISE_TESTS.items():
+		if f is comparison_method:
+			return name
+	return None
+
+def stack_data(matList):
+	"""Stack the data of a list of Net or Attr (or arrays) into one (subjects, ...) array."""
+	return np.stack([getattr(m, 'data', m) for m in matList])
+
+def upper_edges(stack, atlasobj = None):
+	"""
+	Take the upper triangle connections of a (subjects, n, n) stack.
+	Return (rows, cols, edges), edges is (subjects, n*(n-1)/2) in the order of
+	the nested xidx < yidx loops, the cached atlasobj.upper_edges() if given.
+	"""
+	if atlasobj is not None:
+		rows, cols = atlasobj.upper_edges()
+	else:
+		rows, cols = np.triu_indices(stack.shape[1], 1)
+	return rows, cols, stack[:, rows, cols]
+
+def cohen_d(a, b, paired = False):
+	"""
+	Cohen's d of A - B along axis 0, pooled sd for two samples,
+	sd of the differences for paired samples. nan where the sd is 0.
+	"""
+	a = np.asarray(a, dtype = np.float64)
+	b = np.asarray(b, dtype = np.float64)
+	with np.errstate(invalid = 'ignore', divide = 'ignore'):
+		if paired:
+			diff = a - b
+			return diff.mean(axis = 0) / diff.std(axis = 0, ddof = 1)
+		na, nb = a.shape[0], b.shape[0]
+		pooled = ((na - 1) * a.var(axis = 0, ddof = 1) + (nb - 1) * b.var(axis = 0, ddof = 1)) / (na + nb - 2)
+		return (a.mean(axis = 0) - b.mean(axis = 0)) / np.sqrt(pooled)
+
+def correct_pvalues(p, correction = 'fdr_bh', sigLevel = 0.05):
+	"""
+	Multiple comparison correction of an array of p values of any shape.
+	correction is a statsmodels multipletests method, like 'fdr_bh' or 'bonferroni',
+	or None for uncorrected p < sigLevel.
+	nan p values (constant features) are never rejected, but they count in the
+	number of tests, as when all p values are given to multipletests. With
+	fdr_bh, statsmodels then returns nan for all pvals_corrected.
+	Return reject, pvals_corrected in the shape of p.
+	"""
+	p = np.asarray(p, dtype = np.float64)
+	if correction is None:
+		with np.errstate(invalid = 'ignore'):
+			reject = p < sigLevel
+		return reject, p.copy()
+	if p.size == 0:
+		return np.zeros(p.shape, dtype = bool), p.copy()
+	reject, corrected, _, _ = multitest.multipletests(p.ravel(), sigLevel, method = correction)
+	return reject.reshape(p.shape), corrected.reshape(p.shape)
+
+def edgewise_test(a, b, method = 'ttest_ind'):
+	"""
+	Run one of EDGEWISE_TESTS on every column of a (subjects A, ...) and b (subjects B, ...).
+	Return stat, p, in the shape of a[0].
+	"""
+	if method not in EDGEWISE_TESTS:
+		raise Exception('Unknown edgewise test %s, should be one of %s' % (method, list(EDGEWISE_TESTS)))
+	if method in PAIRED_TESTS and a.shape != b.shape:
+		raise Exception('Paired test %s needs the same subjects in both groups' % method)
+	if method == 'wilcoxon':
+		return _edgewise_wilcoxon(a, b)
+	with np.errstate(invalid = 'ignore', divide = 'ignore'):
+		stat, p = EDGEWISE_TESTS[method](a, b, axis = 0)
+	return np.asarray(stat, dtype = np.float64), np.asarray(p, dtype = np.float64)
+
+def _edgewise_wilcoxon(a, b):
+	"""
+	scipy switches the whole batch to a slow permutation test when any column has
+	zero differences, so those columns are tested on their own.
+	Columns with no difference at all give stat 0, p 1, like scipy does.
+	"""
+	a = np.asarray(a, dtype = np.float64)
+	b = np.asarray(b, dtype = np.float64)
+	shape = a.shape[1:]
+	a = a.reshape((a.shape[0], -1))
+	b = b.reshape((b.shape[0], -1))
+	zeros = (a == b)
+	stat = np.zeros(a.shape[1])
+	p = np.ones(a.shape[1])
+	for cols in (np.flatnonzero(~zeros.any(axis = 0)), np.flatnonzero(zeros.any(axis = 0) & ~zeros.all(axis = 0))):
+		if len(cols) > 0:
+			with np.errstate(invalid = 'ignore', divide = 'ignore'):
+				stat[cols], p[cols] = non_parametric_paired_test(a[:, cols], b[:, cols], axis = 0)
+	return stat.reshape(shape), p.reshape(shape)
+
+def compare_connections(netListA, netListB, method = 'ttest_ind', correction = None, sigLevel = 0.05):
+	"""
+	Compare every connection (upper triangle) between two lists of networks, A - B.
+	method is one of EDGEWISE_TESTS, correction is None, 'fdr_bh', 'bonferroni', etc.
+	Return rows, cols, stat, p, effect size (Cohen's d), reject, all arrays over the connections.
+	"""
+	atlasobj = getattr(netListA[0], 'atlasobj', None)
+	rows, cols, edgesA = upper_edges(stack_data(netListA), atlasobj)
+	_, _, edgesB = upper_edges(stack_data(netListB), atlasobj)
+	stat, p = edgewise_test(edgesA, edgesB, method)
+	effect = cohen_d(edgesA, edgesB, paired = method in PAIRED_TESTS)
+	reject, _ = correct_pvalues(p, correction, sigLevel)
+	return rows, cols, stat, p, effect, reject
+
+def _sigdiff_list(netListA, netListB, method, correction, sigLevel, with_stats = True):
+	"""The significant connection tuples of compare_connections, printing the discover rate like before."""
+	rows, cols, stat, p, _, reject = compare_connections(netListA, netListB, method, correction, sigLevel)
+	if with_stats:
+		ret = [(int(rows[i]), int(cols[i]), stat[i], p[i]) for i in np.flatnonzero(reject)]
+	else:
+		ret = [(int(rows[i]), int(cols[i])) for i in np.flatnonzero(reject)]
+	print('SigDiff connections: %d. Discover rate: %1.4f with sigLevel: %1.4f' % (len(ret), float(len(ret))/len(p), sigLevel))
+	return ret
+
 def filter_sigdiff_connections(netListA, netListB, sigLevel = 0.05):
 	"""
 	This function returns a list of significant different connections
@@ -94,20 +243,7 @@ def filter_sigdiff_connections(netListA, netListB, sigLevel = 0.05):
 	connections, and take out those that are significant.
 	A connection is represented by a 4-element-tuple of idx, t-val and p-val
 	"""
-	ret = []
-	atlasobj = netListA[0].atlasobj
-	totalTests = 0
-	for xidx in range(atlasobj.count):
-		for yidx in range(xidx + 1, atlasobj.count):
-			# perform t-test
-			t, p = scipy.stats.ttest_ind(
-				[a.data[xidx, yidx] for a in netListA], 
-				[b.data[xidx, yidx] for b in netListB])
-			totalTests += 1
-			if p < sigLevel:
-				ret.append((xidx, yidx, t, p))
-	print('SigDiff connections: %d. Discover rate: %1.4f with sigLevel: %1.4f' % (len(ret), float(len(ret))/totalTests, sigLevel))
-	return ret
+	return _sigdiff_list(netListA, netListB, 'ttest_ind', None, sigLevel)
 
 def filter_sigdiff_connections_Bonferroni(netListA, netListB, sigLevel = 0.05):
 	"""
@@ -123,25 +259,7 @@ def filter_sigdiff_connections_FDR(netListA, netListB, sigLevel = 0.05):
 	"""
 	This function performs 2 sample t-test on each connection using BH FDR correction.
 	"""
-	ret = []
-	atlasobj = netListA[0].atlasobj
-	totalTests = 0
-	conn_p_list = [] # a list of tuples (xidx, yidx, 0.001) etc
-	for xidx in range(atlasobj.count):
-		for yidx in range(xidx + 1, atlasobj.count):
-			# perform t-test
-			t, p = scipy.stats.ttest_ind(
-				[a.data[xidx, yidx] for a in netListA], 
-				[b.data[xidx, yidx] for b in netListB])
-			totalTests += 1
-			conn_p_list.append((xidx, yidx, p))
-	# FDR correction
-	reject, pvals_corrected, _, _ = multitest.multipletests([a[2] for a in conn_p_list], sigLevel, method = 'fdr_bh')
-	for idx in range(len(reject)):
-		if reject[idx]:
-			ret.append((conn_p_list[idx][0], conn_p_list[idx][1]))
-	print('SigDiff connections: %d. Discover rate: %1.4f with sigLevel: %1.4f' % (len(ret), float(len(ret))/totalTests, sigLevel))
-	return ret
+	return _sigdiff_list(netListA, netListB, 'ttest_ind', 'fdr_bh', sigLevel, with_stats = False)
 
 def sigdiff_connections_after_treatment(netListA, netListB, sigLevel = 0.05):
 	"""
@@ -151,54 +269,24 @@ def sigdiff_connections_after_treatment(netListA, netListB, sigLevel = 0.05):
 	difference in FC after treatment.
 	A connection is represented by a 4-element-tuple of idx, t-val and p-val
 	"""
-	ret = []
-	atlasobj = netListA[0].atlasobj
-	totalTests = 0
-	for xidx in range(atlasobj.count):
-		for yidx in range(xidx + 1, atlasobj.count):
-			# perform t-test
-			t, p = scipy.stats.ttest_rel(
-				[a.data[xidx, yidx] for a in netListA], 
-				[b.data[xidx, yidx] for b in netListB])
-			totalTests += 1
-			if p < sigLevel:
-				ret.append((xidx, yidx, t, p))
-	print('SigDiff connections: %d. Discover rate: %1.4f with sigLevel: %1.4f' % (len(ret), float(len(ret))/totalTests, sigLevel))
-	return ret
+	return _sigdiff_list(netListA, netListB, 'ttest_rel', None, sigLevel)
 
 def sigdiff_connections_after_treatment_FDR(netListA, netListB, sigLevel = 0.05):
 	"""
 	This function performs paired t-test on each connection using BH FDR correction
 	"""
-	ret = []
-	atlasobj = netListA[0].atlasobj
-	totalTests = 0
-	conn_p_list = [] # a list of tuples (xidx, yidx, 0.001) etc
-	for xidx in range(atlasobj.count):
-		for yidx in range(xidx + 1, atlasobj.count):
-			# perform t-test
-			t, p = scipy.stats.ttest_rel(
-				[a.data[xidx, yidx] for a in netListA], 
-				[b.data[xidx, yidx] for b in netListB])
-			totalTests += 1
-			conn_p_list.append((xidx, yidx, p))
-	# FDR correction
-	reject, pvals_corrected, _, _ = multitest.multipletests([a[2] for a in conn_p_list], sigLevel, method = 'fdr_bh')
-	for idx in range(len(reject)):
-		if reject[idx]:
-			ret.append((conn_p_list[idx][0], conn_p_list[idx][1]))
-	print('SigDiff connections: %d. Discover rate: %1.4f with sigLevel: %1.4f' % (len(ret), float(len(ret))/totalTests, sigLevel))
-	return ret
+	return _sigdiff_list(netListA, netListB, 'ttest_rel', 'fdr_bh', sigLevel, with_stats = False)
 
 def get_sub_network_connections(sub_network_list, atlasobj):
 	"""
 	This function takes in a list of sub_network nodes and return all 
 	connections (without auto-connections) within the sub_network
 	"""
+	indexes = atlasobj.ticks_to_indexes(sub_network_list)
 	ret = []
-	for xnode in sub_network_list:
-		for ynode in sub_network_list:
-			ret.append((atlasobj.ticks.index(xnode), atlasobj.ticks.index(ynode)))
+	for xidx in indexes:
+		for yidx in indexes:
+			ret.append((xidx, yidx))
 	return ret
 
 def filter_sigdiff_connections_old(netListA, netListB, sigLevel = 0.05):
@@ -229,9 +229,8 @@ class CircosLink:
 
 	def get_mask(self):
 		mask = np.zeros(self.net.data.shape, dtype=bool)
-		threshold = self.threshold
-		mask[np.abs(self.net.data) > threshold] = True
-		mask = np.triu(mask, 1)
+		rows, cols = self.net.atlasobj.upper_edges()
+		mask[rows, cols] = np.abs(self.net.data[rows, cols]) > self.threshold
 		return mask
 
 	def get_line(self, chrA, idxA, chrB, idxB):
@@ -278,14 +277,15 @@ class CircosLink:
 	def write(self, outfullpath):
 		with open(outfullpath, 'w') as f:
 			self.mask = self.get_mask()
-			for chrA in self.chrdict['all']:
-				for idxA in range(chrA.count):
-					for chrB in self.chrdict['all']:
-						for idxB in range(chrB.count):
-							line = self.get_line(chrA, idxA, chrB, idxB)
-							if line:
-								f.write(line)
-								f.write('\n')
+			# all bands in chromosome order, only the masked pairs produce a line
+			bands = [(chro, idx) for chro in self.chrdict['all'] for idx in range(chro.count)]
+			bandindexes = [chro.indexes[idx] for chro, idx in bands]
+			bandmask = self.mask[np.ix_(bandindexes, bandindexes)]
+			for p, q in zip(*np.nonzero(bandmask)):
+				line = self.get_line(bands[p][0], bands[p][1], bands[q][0], bands[q][1])
+				if line:
+					f.write(line)
+					f.write('\n')
 
 class CircosValue:
 	def __init__(self, attr, valuerange = None, cmap_str = None, colormap = None):
@@ -5,21 +5,21 @@ and store them somewhere proper.
 
 import os
 import numpy as np
-import multiprocessing, queue
 
-from mmdps.proc import atlas, parabase
+from mmdps.proc import atlas, parabase, netattr
 from mmdps.util.loadsave import load_nii, save_csvmat
-from mmdps.util import loadsave
+from mmdps.util import loadsave, mattool
 
 class CalcDynamic:
-	def __init__(self, atlasobj, volumename, img, outfolder, windowLength = 100, stepsize = 3):
+	def __init__(self, atlasobj, volumename, img, outfolder, windowLength = 100, stepsize = 3, scan = None):
 		"""
 		volumename = '3mm' is the name of the atlas volume
 		img is the nii file loaded using load_nii function
 		"""
 		self.img = img
+		self.scan = scan
 		self.atlasobj = atlasobj
-		self.atlasimg = load_nii(atlasobj.get_volume(volumename)['niifile'])
+		self.voxelindex = atlasobj.get_voxel_index(volumename)
 		self.outfolder = outfolder
 		self.stepsize = stepsize
 		self.windowLength = windowLength
@@ -28,28 +28,35 @@ class CalcDynamic:
 		return os.path.join(self.outfolder, *p)
 
 	def gen_timeseries(self):
-		data = self.img.get_data()
-		atdata = self.atlasimg.get_data()
-		timepoints = data.shape[3]
-		timeseries = np.empty((self.atlasobj.count, timepoints))
-		for i, region in enumerate(self.atlasobj.regions):
-			regiondots = data[atdata==region, :]
-			regionts = np.mean(regiondots, axis=0)
-			timeseries[i, :] = regionts
-		return timeseries
+		return self.voxelindex.region_mean(self.img.get_data())
 
-	def gen_net(self):
-		ts = self.gen_timeseries()
-		save_csvmat(self.outpath('timeseries.csv'), ts)
-		timepoints = ts.shape[1] # number of total timepoints
-		start = 0
-		while start + self.windowLength <= timepoints:
-			tscorr = np.corrcoef(ts[:, start:start + self.windowLength])
-			save_csvmat(self.outpath('corrcoef_%d_%d.csv' % (start, start + self.windowLength)), tscorr)
-			start += self.stepsize
+	def gen_net(self, ts = None):
+		"""
+		Compute the networks of all windows at once, without touching the disk.
+		Return a netattr.DynamicNet, data[:, :, k] is the network of the kth window.
+		"""
+		if ts is None:
+			ts = self.gen_timeseries()
+		data = mattool.sliding_corrcoef(ts, self.windowLength, self.stepsize)
+		return netattr.DynamicNet(data, self.atlasobj, self.windowLength, self.stepsize, scan = self.scan)
+
+	def save_net(self, ts, dynamic_net):
+		"""
+		Save the timeseries and all windows stacked in corrcoef.npy in outfolder.
+		One corrcoef-start.end.csv per window is also written unless MMDPS_FEATURE_FORMAT is npy.
+		This is the layout of loader.load_single_dynamic_network.
+		"""
+		loadsave.save_mat(self.outpath('timeseries.csv'), ts)
+		if loadsave.feature_format() != 'npy':
+			for timeIdx in range(dynamic_net.data.shape[2]):
+				start = timeIdx * self.stepsize
+				save_csvmat(self.outpath('corrcoef-%d.%d.csv' % (start, start + self.windowLength)), dynamic_net.data[:, :, timeIdx])
+		# the stack last, it is used only when not older than the csv files
+		dynamic_net.save(self.outpath('corrcoef.npy'))
 
 	def run(self):
-		self.gen_net()
+		ts = self.gen_timeseries()
+		self.save_net(ts, self.gen_net(ts))
 
 def func(args):
 	subject = args[0]
@@ -59,10 +66,10 @@ def func(args):
 	volumename = '3mm'
 	atlasobj = atlas.get(atlasname)
 	work_path = 'D:/Research/xuquan_FMRI/Dynamic_tfMRI_work/'
-	outfolder = os.path.join(work_path, subject, atlasname, 'bold_net', 'dynamic_%d_%d' % (stepsize, windowLength))
+	outfolder = os.path.join(work_path, subject, atlasname, 'bold_net', 'dynamic %d %d' % (stepsize, windowLength))
 	img = load_nii(os.path.join(work_path, subject, 'pBOLD.nii'))
 	os.makedirs(outfolder, exist_ok = True)
-	c = CalcDynamic(atlasobj, volumename, img, outfolder, windowLength, stepsize)
+	c = CalcDynamic(atlasobj, volumename, img, outfolder, windowLength, stepsize, scan = subject)
 	c.run()
 
 if __name__ == '__main__':
@@ -75,27 +82,6 @@ if __name__ == '__main__':
 	for subject in subjectList:
 		for atlasname in atlasList:
 			taskList.append((subject, atlasname, windowLength, stepsize))
-	taskCount = len(taskList)
-	totalResult = []
-	pool = multiprocessing.Pool(processes = 4)
-	manager = multiprocessing.Manager()
-	managerQueue = manager.Queue()
-	fwrap = parabase.FWrap(func, managerQueue)
-	result = pool.map_async(fwrap.run, taskList)
-	nfinished = 0
-	while True:
-		if result.ready():
-			break
-		else:
-			try:
-				res = managerQueue.get(timeout=1)
-			except queue.Empty:
-				continue
-			else:
-				nfinished += 1
-				print('finished one, %d left' % (taskCount - nfinished))
-	print('End proc')
-	totalResult.append(result.get())
-	pool.close()
-	pool.join()
+	# parabase.run reports the progress of every task
+	totalResult = parabase.run(func, taskList, 4)
 	print(totalResult)
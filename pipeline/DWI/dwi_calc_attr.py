@@ -1,7 +1,7 @@
 import os
 import dwi_niicalc as niicalc
 from mmdps.proc import atlas
-from mmdps.util.loadsave import load_nii, save_csvmat
+from mmdps.util.loadsave import load_nii, save_mat
 
 def calc_attr(theattr):
     img = load_nii('../iso2.0_dtifitresult_{}.nii.gz'.format(theattr))
@@ -9,7 +9,7 @@ def calc_attr(theattr):
     atlasname = atlasobj.name
     atlasimg = load_nii(os.path.join('nativespace', 'wtemplate_2.nii.gz'))
     res = niicalc.calc_region_mean(img, atlasobj, atlasimg)
-    save_csvmat(os.path.join('nativespace', 'mean{}.csv'.format(theattr)), res)
+    save_mat(os.path.join('nativespace', 'mean{}.csv'.format(theattr)), res)
     
     
 if __name__ == '__main__':
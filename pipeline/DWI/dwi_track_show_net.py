@@ -3,7 +3,7 @@ import pickle
 from dipy.io import pickles
 import numpy as np
 from mmdps.proc import atlas
-from mmdps.util.loadsave import save_csvmat
+from mmdps.util.loadsave import save_mat
 import os
 
 class Struct:
@@ -18,8 +18,8 @@ def gen_net_csv():
     atlasobj = atlas.get(atlasname)
     idx = atlasobj.regions
     realM = M[idx][:,idx]
-    save_csvmat('dwinetraw.csv', realM)
-    save_csvmat('dwinet.csv', np.log1p(realM))
+    save_mat('dwinetraw.csv', realM)
+    save_mat('dwinet.csv', np.log1p(realM))
     return realM
 
 if __name__ == '__main__':
@@ -8,7 +8,9 @@ if __name__ == '__main__':
 	parser.add_argument('--modal', help = 'specific modal to export', default = None)
 	parser.add_argument('--database', help = 'True/False. Whether export features to MMDPDatabase (MongoDB Database)', default = False)
 	parser.add_argument('--datasource', help = 'datasource for MMDPDatabase', default = None)
-	parser.add_argument('--force', help = 'True/False. If overwrite existing feature record', default = False)
+	parser.add_argument('--force', help = 'True/False. If overwrite existing feature record, and export features not changed since the last export', default = False)
+	parser.add_argument('--backend', help = 'feature backend, mongodb or local', default = None)
+	parser.add_argument('--processes', help = 'number of export processes', type = int, default = None)
 
 	args = parser.parse_args()
 
@@ -26,6 +28,6 @@ if __name__ == '__main__':
 	if args.force:
 		print('Force mode. Will overwrite existing features')
 
-	exporter = feature_exporter.MRIScanProcExporter(main_config, data_config, args.modal, args.database, args.datasource, args.force)
+	exporter = feature_exporter.MRIScanProcExporter(main_config, data_config, args.modal, args.database, args.datasource, args.force, args.backend, args.processes)
 	exporter.run()
 	print('Feature export completed.')
@@ -1,13 +1,12 @@
 import os
 import t1_niicalc as niicalc
 from mmdps.proc import atlas
-from mmdps.util.loadsave import load_nii, save_csvmat
+from mmdps.util.loadsave import load_nii, save_mat
 
 if __name__ == '__main__':
     img = load_nii('../grey.hdr')
     curatlas = atlas.getbywd()
-    atlasimg = load_nii(curatlas.get_volume('1mm')['niifile'])
-    res = niicalc.calc_binary_density(img, curatlas, atlasimg)
-    save_csvmat(os.path.join('t1mean', 'greydensity.csv'), res)
+    res = niicalc.calc_binary_density(img, curatlas, volumename='1mm')
+    save_mat(os.path.join('t1mean', 'greydensity.csv'), res)
     
     
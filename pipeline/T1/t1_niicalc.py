@@ -2,34 +2,31 @@ import os
 import numpy as np
 import nibabel as nib
 
+from mmdps.proc import atlas
 from mmdps.util import path
 
-def calc_region_mean(img, atlasobj, atlasimg):
-    timg = atlasimg
+def get_voxel_index(atlasobj, atlasimg, volumename):
+    """
+    The voxel index to reduce regions with.
+    Use the cached atlas volume index, unless a (native space) atlasimg is given.
+    """
+    if atlasimg is None:
+        return atlasobj.get_voxel_index(volumename)
+    return atlas.RegionVoxelIndex.from_labels(atlasimg.get_data(), atlasobj.regions)
+
+def calc_region_mean(img, atlasobj, atlasimg=None, volumename='1mm'):
     data = img.get_data()
-    tdata = timg.get_data()
-    regionmeans = np.empty(atlasobj.count)
-    print(data.shape, tdata.shape)
-    for i, region in enumerate(atlasobj.regions):
-        regiondots = data[tdata==region]
-        regionmean = np.mean(regiondots)
-        regionmeans[i] = regionmean
-    return regionmeans
+    voxelindex = get_voxel_index(atlasobj, atlasimg, volumename)
+    print(data.shape, voxelindex.shape)
+    return voxelindex.region_mean(data)
 
-def calc_binary_density(img, atlasobj, atlasimg):
-    timg = atlasimg
+def calc_binary_density(img, atlasobj, atlasimg=None, volumename='1mm'):
     data = img.get_data()
-    tdata = timg.get_data()
+    voxelindex = get_voxel_index(atlasobj, atlasimg, volumename)
     threshold = 0.5
     data[data <= threshold * 255] = 0
     path.makedirs('t1mean')
     nib.save(img, 't1mean/thres_{}.nii.gz'.format(threshold))
     data[data > threshold] = 1
-    res = np.empty(atlasobj.count)
-    for i, region in enumerate(atlasobj.regions):
-        regiondots = data[tdata==region]
-        regioncount = regiondots.shape[0]
-        ndots = np.sum(regiondots)
-        res[i] = ndots / regioncount
-    return res
+    return voxelindex.region_mean(data)
     
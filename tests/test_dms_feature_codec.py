@@ -0,0 +1,30 @@
+"""
+This script is used to test the binary feature codec
+"""
+import pickle
+import numpy as np
+from mmdps.dms import feature_codec
+
+def test_round_trip():
+	rng = np.random.RandomState(0)
+	net = rng.normal(size = (10, 10))
+	net = net + net.T
+	net[0, 0] = np.nan
+	attr = rng.normal(size = 10)
+	for value in (net, attr, rng.normal(size = (4, 10, 10))):
+		for compression in (None, 'zlib'):
+			decoded = feature_codec.decode(feature_codec.encode(value, compression = compression))
+			assert decoded.dtype == value.dtype
+			assert np.array_equal(decoded, value, equal_nan = True)
+			decoded[...] = 0
+	# the symmetric net only stores its upper triangle
+	assert len(feature_codec.encode(net)) < net.nbytes * 0.6
+	packed = feature_codec.decode(feature_codec.encode(net, float32 = True))
+	assert packed.dtype == np.float32
+	assert np.allclose(packed, net, equal_nan = True)
+	# records from before are pickles
+	assert np.array_equal(feature_codec.decode(pickle.dumps(attr)), attr)
+	assert feature_codec.decode(feature_codec.encode_any({'a': 1})) == {'a': 1}
+
+if __name__ == '__main__':
+	test_round_trip()
@@ -0,0 +1,56 @@
+"""
+This script is used to test exporting features saved as npy only, MMDPS_FEATURE_FORMAT=npy
+"""
+import os
+import tempfile
+import numpy as np
+from mmdps.dms import feature_exporter
+from mmdps.proc import atlas, netattr
+from mmdps.util import loadsave
+
+atlasobj = atlas.get('brodmann_lrce')
+
+def dataconfig(is_dynamic, out_file_name):
+	return dict(dynamic = dict(is_dynamic = is_dynamic, window_length = 10, step_size = 2),
+		nets = {'BOLD.net': dict(modal = 'BOLD', file = 'bold_net/corrcoef', file_type = '.csv', out_file_name = out_file_name)}, attrs = {})
+
+def test_export_npy_only():
+	n = atlasobj.count
+	fmt = os.environ.get('MMDPS_FEATURE_FORMAT')
+	os.environ['MMDPS_FEATURE_FORMAT'] = 'npy'
+	try:
+		with tempfile.TemporaryDirectory() as tmpdir:
+			mainconfig = dict(output_folder = os.path.join(tmpdir, 'out'), input_folders = dict(BOLD = os.path.join(tmpdir, 'in')))
+			static = np.random.rand(n, n)
+			loadsave.save_mat(os.path.join(tmpdir, 'in', 'scan1', atlasobj.name, 'bold_net', 'corrcoef.csv'), static)
+			dynamic = np.random.rand(n, n, 4)
+			netattr.DynamicNet(dynamic, atlasobj, 10, 2).save(os.path.join(tmpdir, 'in_dynamic', 'scan1', atlasobj.name, 'bold_net', 'corrcoef.npy'))
+			# folder exporter
+			exporter = feature_exporter.MRIScanProcMRIScanAtlasExporter('scan1', atlasobj.name, mainconfig, dataconfig(False, 'bold_net'))
+			exporter.run()
+			assert np.array_equal(loadsave.load_mat(os.path.join(tmpdir, 'out', 'scan1', atlasobj.name, 'bold_net.csv')), static)
+			assert len(exporter.exported) == 1
+			dynamic_mainconfig = dict(output_folder = os.path.join(tmpdir, 'out'), input_folders = dict(BOLD = os.path.join(tmpdir, 'in_dynamic')))
+			exporter = feature_exporter.MRIScanProcMRIScanAtlasExporter('scan1', atlasobj.name, dynamic_mainconfig, dataconfig(True, 'bold_net/dynamic 2 10/corrcoef'))
+			exporter.run()
+			assert np.array_equal(np.load(os.path.join(tmpdir, 'out', 'scan1', atlasobj.name, 'bold_net', 'dynamic 2 10', 'corrcoef.npy')), dynamic)
+			# database exporter
+			db_exporter = feature_exporter.MRIScanProcMMDPDatabaseExporter('scan1', atlasobj.name, mainconfig, dataconfig(False, 'bold_net'), 'test', backend = 'local', mdb = local_backend(tmpdir))
+			db_exporter.run()
+			assert np.array_equal(db_exporter.mdb.get_static_net('scan1', atlasobj.name).data, static)
+			db_exporter = feature_exporter.MRIScanProcMMDPDatabaseExporter('scan1', atlasobj.name, dynamic_mainconfig, dataconfig(True, 'bold_net'), 'test', backend = 'local', mdb = db_exporter.mdb)
+			db_exporter.run()
+			assert np.array_equal(db_exporter.mdb.get_dynamic_net('scan1', atlasobj.name, 10, 2).data, dynamic)
+			db_exporter.mdb.conn.close()
+	finally:
+		if fmt is None:
+			del os.environ['MMDPS_FEATURE_FORMAT']
+		else:
+			os.environ['MMDPS_FEATURE_FORMAT'] = fmt
+
+def local_backend(tmpdir):
+	from mmdps.dms import local_database
+	return local_database.LocalDatabase('test', os.path.join(tmpdir, 'featuredb'))
+
+if __name__ == '__main__':
+	test_export_npy_only()
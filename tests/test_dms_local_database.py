@@ -0,0 +1,37 @@
+"""
+This script is used to test the local feature backend, no database server needed
+"""
+import tempfile
+import numpy as np
+from mmdps.dms import local_database, feature_backend
+from mmdps.proc import atlas, netattr
+
+atlasobj = atlas.get('brodmann_lrce')
+
+def test_local_database():
+	n = atlasobj.count
+	with tempfile.TemporaryDirectory() as tmpdir:
+		db = local_database.LocalDatabase('test', tmpdir)
+		db.save_static_net(netattr.Net(np.eye(n), atlasobj, 'scan1', 'BOLD.net'))
+		try:
+			db.save_static_net(netattr.Net(np.eye(n), atlasobj, 'scan1', 'BOLD.net'))
+			assert False
+		except feature_backend.MultipleRecordException:
+			pass
+		db.save_static_net(netattr.Net(2 * np.eye(n), atlasobj, 'scan1', 'BOLD.net'), overwrite = True)
+		assert db.get_static_net('scan1', atlasobj.name).data[0, 0] == 2
+		data = np.random.rand(n, n, 6)
+		db.save_dynamic_net(netattr.DynamicNet(data, atlasobj, 10, 1, 'scan1'))
+		assert np.allclose(db.get_dynamic_net('scan1', atlasobj.name, 10, 1, start = 2, stop = 4).data, data[:, :, 2:4])
+		values = db.load_static_values('SN', ['scan1', 'scan2'], atlasobj.name, 'BOLD.net')
+		assert list(values.keys()) == ['scan1']
+		db.remove_static_net('scan1', atlasobj.name, 'BOLD.net')
+		try:
+			db.get_static_net('scan1', atlasobj.name)
+			assert False
+		except feature_backend.NoRecordFoundException:
+			pass
+		db.conn.close()
+
+if __name__ == '__main__':
+	test_local_database()
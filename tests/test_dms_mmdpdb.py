@@ -0,0 +1,52 @@
+"""
+This script is used to test that the local feature cache of MMDPDatabase sees writes of other processes.
+Needs a redis server.
+"""
+import os
+import tempfile
+import multiprocessing
+import numpy as np
+from mmdps.dms import mmdpdb, feature_exporter, feature_backend
+from mmdps.dms.local_database import LocalDatabase
+from mmdps.proc import atlas, netattr
+
+atlasobj = atlas.get('brodmann_lrce')
+
+def export_net(data_source, folder, value):
+	"""Overwrite the net like the exporter in a worker process does, in a spawned process without the listeners of the test."""
+	mdb = LocalDatabase(data_source, folder)
+	batch = {('SN', True): [netattr.Net(value, atlasobj, 'scan1', 'BOLD.net')]}
+	feature_exporter.flush_batch(mdb, batch, feature_backend.create_cache('redis'))
+	mdb.conn.close()
+
+def test_write_in_other_process():
+	n = atlasobj.count
+	data_source = 'test_mmdpdb_%d' % os.getpid()
+	folder = os.environ.get('MMDPS_LOCAL_FEATURE_DB')
+	with tempfile.TemporaryDirectory() as tmpdir:
+		os.environ['MMDPS_LOCAL_FEATURE_DB'] = tmpdir
+		try:
+			old = np.random.rand(n, n)
+			new = np.random.rand(n, n)
+			database = mmdpdb.MMDPDatabase(data_source, backend = 'local', cache = 'redis', local_cache_bytes = 1 << 20)
+			database.mdb.save_static_net(netattr.Net(old, atlasobj, 'scan1', 'BOLD.net'))
+			assert np.array_equal(database.get_feature('scan1', atlasobj, 'BOLD.net').data, old)
+			assert np.array_equal(database.get_feature('scan1', atlasobj, 'BOLD.net').data, old)
+			assert database.local_cache.cache_stats()['hits'] == 1
+			process = multiprocessing.get_context('spawn').Process(target = export_net, args = (data_source, tmpdir, new))
+			process.start()
+			process.join()
+			assert process.exitcode == 0
+			assert np.array_equal(database.get_feature('scan1', atlasobj, 'BOLD.net').data, new)
+			assert database.local_cache.cache_stats()['stale'] == 1
+			database.rdb.datadb.delete(feature_backend.static_key(data_source, 'scan1', atlasobj.name, 'BOLD.net', {}),
+				database.rdb.generate_write_count_key(data_source, atlasobj.name, 'BOLD.net'))
+			database.mdb.conn.close()
+		finally:
+			if folder is None:
+				del os.environ['MMDPS_LOCAL_FEATURE_DB']
+			else:
+				os.environ['MMDPS_LOCAL_FEATURE_DB'] = folder
+
+if __name__ == '__main__':
+	test_write_in_other_process()
@@ -0,0 +1,28 @@
+"""
+This script is used to test the distributed executor with local workers
+"""
+import os
+import tempfile
+from mmdps.proc import distributed
+
+def square(x):
+	print('square of', x)
+	return x * x
+
+def test_local_workers():
+	assert distributed.parse_hosts('node1:8, node2') == [('node1', 8), ('node2', 1)]
+	with tempfile.TemporaryDirectory() as tmpdir:
+		cwd = os.getcwd()
+		os.chdir(tmpdir)
+		try:
+			with distributed.Coordinator(heartbeat = 1, timeout = 10) as coordinator:
+				coordinator.launch('local:2')
+				assert coordinator.run(square, [1, 2, 3], costs = [1, 3, 2]) == [1, 4, 9]
+			logfile = [file for file in os.listdir('log') if file.endswith('distributed.txt')][0]
+			with open(os.path.join('log', logfile)) as f:
+				assert 'square of 3' in f.read()
+		finally:
+			os.chdir(cwd)
+
+if __name__ == '__main__':
+	test_local_workers()
@@ -0,0 +1,178 @@
+"""
+This script is used to test running the children of a batch job by their dependencies
+"""
+import os
+import json
+import time
+import sys
+import tempfile
+import multiprocessing
+from mmdps.proc import job, matlab_pool
+from mmdps import rootconfig
+
+def shelljob(name, cmd, **kwargs):
+	d = dict(name = name, typename = 'ShellJob', cmd = cmd)
+	d.update(kwargs)
+	return d
+
+def test_batch_dependencies():
+	config = dict(name = 'batch', typename = 'BatchJob', workers = 2, config = [
+		shelljob('a', 'echo a > a.txt', outputs = ['a.txt']),
+		shelljob('b', 'echo b > b.txt', depends = [], outputs = ['b.txt']),
+		shelljob('c', 'cat a.txt b.txt > c.txt', inputs = ['a.txt', 'b.txt']),
+		shelljob('d', 'exit 3', depends = []),
+		shelljob('e', 'echo e > e.txt', depends = ['d']),
+	])
+	batch = job.create_from_dict(config)
+	jobs = [job.create_from_dict(c) for c in config['config']]
+	assert job.job_dependencies(jobs) == [set(), set(), {0, 1}, set(), {3}]
+	with tempfile.TemporaryDirectory() as tmpdir:
+		assert batch.run(tmpdir) == 3
+		with open(os.path.join(tmpdir, 'c.txt')) as f:
+			assert f.read().split() == ['a', 'b']
+		assert not os.path.isfile(os.path.join(tmpdir, 'e.txt'))
+	# a plain list runs one by one
+	jobs = [job.create_from_dict(shelljob(name, 'true')) for name in 'xyz']
+	assert job.job_dependencies(jobs) == [set(), {0}, {1}]
+
+def test_up_to_date():
+	with tempfile.TemporaryDirectory() as tmpdir:
+		with open(os.path.join(tmpdir, 'in.txt'), 'w') as f:
+			f.write('1')
+		currentJob = job.create_from_dict(shelljob('copy', 'cat in.txt >> out.txt', inputs = ['in.txt'], outputs = ['out.txt']))
+		assert not currentJob.is_up_to_date(tmpdir)
+		assert job.runjob(currentJob, tmpdir) == 0
+		assert currentJob.is_up_to_date(tmpdir)
+		# skipped
+		assert job.runjob(currentJob, tmpdir) == 0
+		with open(os.path.join(tmpdir, 'out.txt')) as f:
+			assert f.read() == '1'
+		job.runjob(currentJob, tmpdir, force = True)
+		with open(os.path.join(tmpdir, 'in.txt'), 'w') as f:
+			f.write('22')
+		assert not currentJob.is_up_to_date(tmpdir)
+		job.runjob(currentJob, tmpdir)
+		with open(os.path.join(tmpdir, 'out.txt')) as f:
+			assert f.read() == '1122'
+
+def test_configfile_argv():
+	with tempfile.TemporaryDirectory() as tmpdir:
+		os.makedirs(os.path.join(tmpdir, 'sub'))
+		with open(os.path.join(tmpdir, 'inner.json'), 'w') as f:
+			json.dump(shelljob('touch', 'echo x >> out.txt', outputs = ['out.txt']), f)
+		batch = job.create_from_dict(dict(name = 'batch', typename = 'BatchJob', config = 'inner.json', argv = '--folder sub --force'))
+		assert batch.run(tmpdir) == 0
+		# --force runs it again though it is up to date
+		assert not batch.is_up_to_date(tmpdir)
+		assert batch.run(tmpdir) == 0
+		with open(os.path.join(tmpdir, 'sub', 'out.txt')) as f:
+			assert f.read().split() == ['x', 'x']
+		batch = job.create_from_dict(dict(name = 'batch', typename = 'BatchJob', config = 'inner.json', argv = '--folder sub --retries 2'))
+		try:
+			batch.run(tmpdir)
+			assert False
+		except Exception as e:
+			assert '--retries' in str(e)
+
+def process_gone(pid, timeout = 10):
+	"""Whether pid exits within timeout, a killed orphan may stay a zombie until it is reaped."""
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		try:
+			with open('/proc/%d/stat' % pid) as f:
+				if f.read().rsplit(')', 1)[1].split()[0] == 'Z':
+					return True
+		except FileNotFoundError:
+			return True
+		except OSError:
+			# no /proc
+			try:
+				os.kill(pid, 0)
+			except ProcessLookupError:
+				return True
+		time.sleep(0.1)
+	return False
+
+def test_timeout_and_retries():
+	with tempfile.TemporaryDirectory() as tmpdir:
+		# the child sleep is killed with the shell
+		currentJob = job.create_from_dict(shelljob('hang', 'sleep 60 & echo $! > child.txt; wait', timeout = 1))
+		start_time = time.time()
+		assert currentJob.run(tmpdir) != 0
+		assert time.time() - start_time < 5
+		with open(os.path.join(tmpdir, 'child.txt')) as f:
+			child = int(f.read())
+		assert process_gone(child)
+		# a child ignoring SIGTERM is killed too
+		currentJob = job.create_from_dict(shelljob('stubborn', "(trap '' TERM; sleep 60) & echo $! > child.txt; wait", timeout = 1))
+		assert currentJob.run(tmpdir) != 0
+		with open(os.path.join(tmpdir, 'child.txt')) as f:
+			assert process_gone(int(f.read()))
+		# fails the first time only
+		currentJob = job.create_from_dict(shelljob('flaky', 'test -f flag || { touch flag; exit 1; }', retries = 2, retry_delay = 0))
+		assert currentJob.run(tmpdir) == 0
+
+FAKE_MATLAB = '''#!{}
+import sys, re, time
+block = []
+for line in sys.stdin:
+	line = line.rstrip('\\n')
+	if line == 'exit':
+		open(sys.argv[0] + '.closed', 'w').close()
+		break
+	block.append(line)
+	if line == 'end':
+		text = '\\n'.join(block)
+		block = []
+		token = re.search(r'(MMDPS_DONE_\\w+) 0', text).group(1)
+		if 'pause' in text:
+			time.sleep(1000)
+		print('ran', flush = True)
+		print('%s %d' % (token, 'error(' in text), flush = True)
+'''
+
+def run_in_worker(args):
+	fake, tmpdir = args
+	rootconfig.matlab_bin = fake
+	os.environ['MMDPS_MATLAB_MODE'] = 'pool'
+	return job.MatlabJob('ok', 'disp(1)').run(tmpdir)
+
+def test_matlab_pool():
+	if sys.platform == 'win32' or matlab_pool.has_engine():
+		return
+	with tempfile.TemporaryDirectory() as tmpdir:
+		fake = os.path.join(tmpdir, 'matlab')
+		with open(fake, 'w') as f:
+			f.write(FAKE_MATLAB.format(sys.executable))
+		os.chmod(fake, 0o755)
+		matlab_bin = rootconfig.matlab_bin
+		rootconfig.matlab_bin = fake
+		os.environ['MMDPS_MATLAB_MODE'] = 'pool'
+		# a worker closes its sessions when it exits
+		pool = multiprocessing.Pool(1)
+		assert pool.apply(run_in_worker, ((fake, tmpdir),)) == 0
+		pool.close()
+		pool.join()
+		assert os.path.isfile(fake + '.closed')
+		try:
+			assert job.MatlabJob('ok', 'disp(1)').run(tmpdir) == 0
+			session = matlab_pool.get_pool().sessions[0]
+			assert job.MatlabJob('fail', 'error(1)').run(tmpdir) == 1
+			slow = job.MatlabJob('slow', 'pause(inf)')
+			slow.timeout = 1
+			assert slow.run(tmpdir) == -1
+			assert not session.alive()
+			# a new session replaces the killed one
+			assert job.MatlabJob('ok', 'disp(1)').run(tmpdir) == 0
+			assert matlab_pool.get_pool().sessions[0] is not session
+		finally:
+			matlab_pool.close_pool()
+			rootconfig.matlab_bin = matlab_bin
+			del os.environ['MMDPS_MATLAB_MODE']
+
+if __name__ == '__main__':
+	test_batch_dependencies()
+	test_up_to_date()
+	test_configfile_argv()
+	test_timeout_and_retries()
+	test_matlab_pool()
@@ -0,0 +1,28 @@
+"""
+This script is used to test building dynamic nets and attrs slice by slice
+"""
+import numpy as np
+from mmdps.proc import netattr
+
+def test_dynamic_builders():
+	slices = np.random.RandomState(0).normal(size = (40, 5, 5))
+	dNet = netattr.DynamicNet(None, None, 10, 1)
+	for data in slices:
+		dNet.append_one_slice(data)
+	assert dNet.data.shape == (5, 5, 40)
+	assert np.array_equal(dNet.data, np.moveaxis(slices, 0, 2))
+	assert np.array_equal(dNet.get_slice(3), slices[3])
+	dNet.compact()
+	assert dNet.data.shape == (5, 5, 40)
+	# from a generator with a known length, allocated once
+	dAttr = netattr.DynamicAttr.from_slices((s[0] for s in slices), None, 10, 1, num_slices = len(slices))
+	assert dAttr.data.shape == (5, 40)
+	assert np.array_equal(dAttr.data, slices[:, 0, :].T)
+	assert dAttr.feature_name is None and dNet.feature_name == 'BOLD.net'
+	assert len(list(dAttr.iter_slices(10, 20))) == 10
+	# appending to existing data
+	dAttr.append_one_slice(np.ones(5))
+	assert dAttr.num_slices == 41 and np.all(dAttr.data[:, -1] == 1)
+
+if __name__ == '__main__':
+	test_dynamic_builders()
@@ -0,0 +1,54 @@
+"""
+This script is used to test the parabase scheduler
+"""
+import os
+import time
+import tempfile
+from mmdps.proc import parabase
+
+def started(arg):
+	return time.time()
+
+def span(arg):
+	start = time.time()
+	time.sleep(0.3)
+	return start, time.time()
+
+def fail(arg):
+	if arg == 2:
+		raise ValueError(arg)
+	return 0
+
+def test_run_order():
+	# one process, so the tasks run in the scheduled order, the most costly first
+	costs = [1, 5, 3, 4]
+	outputs = parabase.run(started, ['a', 'b', 'c', 'd'], 1, costs = costs)
+	assert [costs[i] for i in sorted(range(4), key = lambda i: outputs[i])] == [5, 4, 3, 1]
+	with tempfile.TemporaryDirectory() as tmpdir:
+		quarantine_file = os.path.join(tmpdir, 'quarantine.txt')
+		# the two 600 byte tasks do not fit in the budget together
+		spans = parabase.run(span, [0, 1, 2], 2, memory = [600, 600, 100], mem_budget = '1K', quarantine_file = quarantine_file)
+		assert spans[0][1] <= spans[1][0] or spans[1][1] <= spans[0][0]
+		assert not os.path.isfile(quarantine_file)
+		try:
+			parabase.run(fail, [1, 2, 3], 2, quarantine_file = quarantine_file)
+			assert False
+		except ValueError:
+			pass
+
+def test_quarantine():
+	with tempfile.TemporaryDirectory() as tmpdir:
+		quarantine_file = os.path.join(tmpdir, 'quarantine.txt')
+		assert parabase.run(abs, [0, -2, 0, 3], 2, quarantine_file = quarantine_file) == [0, 2, 0, 3]
+		with open(quarantine_file) as f:
+			assert f.read().split() == ['-2', '3']
+
+def test_sizes():
+	assert parabase.parse_size('64G') == 64 << 30
+	assert parabase.parse_size('512mb') == 512 << 20
+	assert parabase.usable_cpu_count() >= 1
+
+if __name__ == '__main__':
+	test_run_order()
+	test_quarantine()
+	test_sizes()
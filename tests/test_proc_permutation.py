@@ -0,0 +1,55 @@
+"""
+This script is used to test the permutation engine on synthetic groups
+"""
+import numpy as np
+import scipy.stats
+from mmdps.proc import permutation
+
+class FakeAtlas:
+	def __init__(self, count):
+		self.count = count
+
+class FakeNet:
+	def __init__(self, data, atlasobj):
+		self.data = data
+		self.atlasobj = atlasobj
+
+def random_nets(randomState, atlasobj, count, shift):
+	nets = []
+	for i in range(count):
+		data = randomState.normal(size = (atlasobj.count, atlasobj.count))
+		data = (data + data.T) / 2
+		data[:6, :6] += shift
+		nets.append(FakeNet(data, atlasobj))
+	return nets
+
+def test_batch_tstats():
+	randomState = np.random.RandomState(0)
+	a = randomState.normal(size = (10, 30))
+	b = randomState.normal(size = (12, 30))
+	tstats = permutation.batch_tstats(a, b, 'ttest_ind', np.random.default_rng(1), 3)
+	groups = np.random.default_rng(1).permuted(np.tile(np.r_[np.ones(10), np.zeros(12)], (3, 1)), axis = 1)
+	x = np.vstack((a, b))
+	for i in range(3):
+		assert np.allclose(tstats[i], scipy.stats.ttest_ind(x[groups[i] == 1], x[groups[i] == 0]).statistic)
+
+def test_max_stat_and_nbs():
+	randomState = np.random.RandomState(0)
+	atlasobj = FakeAtlas(40)
+	netListA = random_nets(randomState, atlasobj, 15, 1.5)
+	netListB = random_nets(randomState, atlasobj, 15, 0)
+	stat_net, p_net, mask_net = permutation.max_stat_fwe(netListA, netListB, num_permutations = 500, seed = 3, processes = 1)
+	assert mask_net.data[:6, :6].sum() > 0
+	assert mask_net.data[6:, 6:].sum() == 0
+	_, p_net_again, _ = permutation.max_stat_fwe(netListA, netListB, num_permutations = 500, seed = 3, processes = 1, batch_size = 100)
+	assert np.array_equal(p_net.data, p_net_again.data)
+	# the same with two processes, for the same seed and batch_size
+	_, p_net_para, _ = permutation.max_stat_fwe(netListA, netListB, num_permutations = 500, seed = 3, processes = 2, batch_size = 100)
+	assert np.array_equal(p_net.data, p_net_para.data)
+	components = permutation.nbs(netListA, netListB, 3.0, num_permutations = 500, seed = 3, processes = 1)
+	mask, size, p = components[0]
+	assert p < 0.05 and mask.data[:6, :6].sum() == 2 * size
+
+if __name__ == '__main__':
+	test_batch_tstats()
+	test_max_stat_and_nbs()
@@ -0,0 +1,23 @@
+"""
+This script is used to test the csv/npy feature matrix round trip
+"""
+import os, time, tempfile
+import numpy as np
+from mmdps.util import loadsave
+
+def test_save_load_mat():
+	mat = np.random.RandomState(0).normal(size = (6, 6))
+	with tempfile.TemporaryDirectory() as tmpdir:
+		csvfile = os.path.join(tmpdir, 'bold_net', 'corrcoef.csv')
+		loadsave.save_mat(csvfile, mat)
+		assert os.path.isfile(csvfile)
+		assert os.path.isfile(loadsave.npymat_path(csvfile))
+		assert np.array_equal(loadsave.load_mat(csvfile), mat)
+		# a csv rewritten by other tools is newer than the sidecar, and wins
+		time.sleep(0.01)
+		loadsave.save_csvmat(csvfile, mat + 1)
+		os.utime(csvfile, (time.time() + 10, time.time() + 10))
+		assert np.allclose(loadsave.load_mat(csvfile), mat + 1)
+
+if __name__ == '__main__':
+	test_save_load_mat()
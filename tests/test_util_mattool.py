@@ -0,0 +1,42 @@
+"""
+This script is used to test the matrix tools against their per-window/per-column references
+"""
+import numpy as np
+import scipy.stats
+from mmdps.util import mattool
+
+def test_sliding_corrcoef():
+	ts = np.random.RandomState(0).normal(size = (20, 120))
+	ts[3, 40:60] = 1 # a constant window gives nan, like np.corrcoef
+	for windowLength, stepSize in [(10, 1), (30, 7), (15, 20)]:
+		dynamicData = mattool.sliding_corrcoef(ts, windowLength, stepSize)
+		starts = range(0, ts.shape[1] - windowLength + 1, stepSize)
+		assert dynamicData.shape == (20, 20, len(starts))
+		for timeIdx, start in enumerate(starts):
+			with np.errstate(invalid = 'ignore', divide = 'ignore'):
+				expected = np.corrcoef(ts[:, start:start + windowLength])
+			assert np.allclose(dynamicData[:, :, timeIdx], expected, equal_nan = True)
+
+def test_corr():
+	randomState = np.random.RandomState(0)
+	xmat = randomState.normal(size = (25, 12))
+	xmat[:, 3] = np.round(xmat[:, 3]) # ties
+	ymat = np.c_[randomState.normal(size = 25), np.round(randomState.normal(size = 25))]
+	references = [('pearson', scipy.stats.pearsonr), ('spearman', scipy.stats.spearmanr), ('kendall', lambda a, b: scipy.stats.kendalltau(a, b, method = 'asymptotic'))]
+	for method, f in references:
+		r, p = mattool.corr(xmat, ymat, method)
+		assert r.shape == (12, 2)
+		for i in range(12):
+			for k in range(2):
+				expected = f(xmat[:, i], ymat[:, k])
+				assert np.allclose([r[i, k], p[i, k]], [expected[0], expected[1]])
+	covariates = np.c_[randomState.normal(size = 25), randomState.randint(0, 2, 25)]
+	r, p = mattool.corr(xmat, ymat[:, 0], 'pearson', covariates)
+	xres = mattool.residualize(xmat, covariates)
+	yres = mattool.residualize(ymat[:, :1], covariates)[:, 0]
+	for i in range(12):
+		assert np.isclose(r[i, 0], np.corrcoef(xres[:, i], yres)[0, 1])
+
+if __name__ == '__main__':
+	test_sliding_corrcoef()
+	test_corr()
@@ -0,0 +1,42 @@
+"""
+This script is used to test the edge-wise statistics against per-connection scipy calls
+"""
+import numpy as np
+import scipy.stats
+from mmdps.util import stats_utils
+
+class FakeNet:
+	def __init__(self, data):
+		self.data = data
+
+def random_nets(randomState, count, n):
+	nets = []
+	for i in range(count):
+		data = randomState.normal(size = (n, n))
+		data = (data + data.T) / 2
+		data[0, 1] = data[1, 0] = 0.5 # a constant connection
+		nets.append(FakeNet(data))
+	return nets
+
+def test_compare_connections():
+	randomState = np.random.RandomState(0)
+	netListA = random_nets(randomState, 12, 8)
+	netListB = random_nets(randomState, 12, 8)
+	for a, b in zip(netListA[:3], netListB[:3]):
+		b.data[0, 2] = b.data[2, 0] = a.data[0, 2] # some zero differences
+	for method, f in [('ttest_ind', scipy.stats.ttest_ind), ('ttest_rel', scipy.stats.ttest_rel), ('mannwhitneyu', scipy.stats.mannwhitneyu), ('wilcoxon', scipy.stats.wilcoxon)]:
+		rows, cols, stat, p, effect, reject = stats_utils.compare_connections(netListA, netListB, method)
+		for i in range(1, len(rows)):
+			# rows[0], cols[0] is the constant connection, checked below
+			with np.errstate(invalid = 'ignore', divide = 'ignore'):
+				expectedStat, expectedP = f([a.data[rows[i], cols[i]] for a in netListA], [b.data[rows[i], cols[i]] for b in netListB])
+			assert np.allclose(stat[i], expectedStat, equal_nan = True)
+			assert np.allclose(p[i], expectedP, equal_nan = True)
+		assert np.isnan(p[0]) or p[0] == 1
+	sig = stats_utils.filter_sigdiff_connections(netListA, netListB, 0.5)
+	assert all(p < 0.5 for xidx, yidx, t, p in sig)
+	reject, corrected = stats_utils.correct_pvalues(np.array([0.001, np.nan, 0.04, 0.5]), 'fdr_bh')
+	assert list(reject) == [True, False, False, False] and np.isnan(corrected[1])
+
+if __name__ == '__main__':
+	test_compare_connections()
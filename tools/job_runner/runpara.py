@@ -9,12 +9,13 @@ from mmdps.util import path
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--config', help='para config json file', required=True)
+	parser.add_argument('--force', help='run even in folders where the job is up to date', action='store_true')
 	args = parser.parse_args()
 	configpath = path.fullfile(args.config)
 	print('Runpara: configpath', configpath)
 	configDict = load_json(configpath)
 	currentPara = para.load(configDict)
-	currentPara.run()
+	currentPara.run(args.force)
 	sys.stdin.close()
 	sys.stdout.close()
 	sys.stderr.close()
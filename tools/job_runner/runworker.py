@@ -0,0 +1,17 @@
+"""Run distributed workers on this machine, see mmdps.proc.distributed.
+
+The authkey of the coordinator is read from stdin, in hex.
+"""
+
+import sys
+import argparse
+from mmdps.proc import distributed
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--connect', help='coordinator host:port', required=True)
+	parser.add_argument('--processes', help='number of workers', type=int, default=1)
+	args = parser.parse_args()
+	host, port = args.connect.rsplit(':', 1)
+	authkey = bytes.fromhex(sys.stdin.readline().strip())
+	distributed.serve((host, int(port)), authkey, args.processes)